@@ -4,7 +4,9 @@ from kivy.uix.screenmanager import Screen, SlideTransition
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.button import Button
-from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.properties import StringProperty
 from kivy.clock import Clock
 import logging
 import threading
@@ -12,6 +14,42 @@ import os
 
 # Import the backend class
 from vpn_status import VPNStatusChecker
+from vpn_peer_delta import PeerDiffer, peer_key
+from vpn_throughput import PeerRateTracker, format_rate
+from vpn_user_index import VPNUserIndex
+from user_management import UserManager
+
+# Path to the custom font, resolved once for every row
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf')
+
+class VPNConnectionRow(BoxLayout):
+    """
+    A single row of the active connections list.
+    RecycleView reuses rows and only assigns the texts of the peer it shows.
+    """
+    user_text = StringProperty('')
+    ip_text = StringProperty('')
+    endpoint_text = StringProperty('')
+    handshake_text = StringProperty('')
+    rate_text = StringProperty('')
+
+    def __init__(self, **kwargs):
+        super(VPNConnectionRow, self).__init__(orientation='vertical', padding=10, spacing=5, **kwargs)
+
+        # User, IP Address, Endpoint, Latest Handshake and throughput labels
+        for prop in ('user_text', 'ip_text', 'endpoint_text', 'handshake_text', 'rate_text'):
+            label = Label(
+                text=getattr(self, prop),
+                font_size='16sp',
+                color=(1, 1, 1, 1),
+                halign='left',
+                valign='middle',
+                size_hint=(1, 0.2),
+                font_name=FONT_PATH
+            )
+            label.bind(size=label.setter('text_size'))
+            self.bind(**{prop: label.setter('text')})
+            self.add_widget(label)
 
 class ActiveVPNScreen(Screen):
     """
@@ -23,9 +61,16 @@ class ActiveVPNScreen(Screen):
         # Initialize the backend
         self.vpn_status_checker = VPNStatusChecker()
 
-        # Path to the custom font
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        font_path = os.path.join(current_dir, 'fonts', 'SixtyFourConvergence.ttf')
+        # Tracks which peers are displayed so only changed rows are updated
+        self.peer_differ = PeerDiffer()
+        self.row_index = {}
+
+        # Throughput rates computed from the transfer counters of every snapshot
+        self.rate_tracker = PeerRateTracker()
+        self.vpn_status_checker.snapshot_service.add_listener(self.rate_tracker.ingest)
+
+        # Maps peers to the usernames of their PiVPN client profiles
+        self.user_index = VPNUserIndex(UserManager().config_dir)
 
         # Create the main layout
         layout = BoxLayout(orientation='vertical', padding=50, spacing=20)
@@ -36,23 +81,40 @@ class ActiveVPNScreen(Screen):
             font_size='24sp',
             color=(1, 1, 1, 1),
             size_hint=(1, 0.1),
-            font_name=font_path
+            font_name=FONT_PATH
         )
         layout.add_widget(title_label)
 
-        # Add a ScrollView to display the list of active connections
-        self.scroll_view = ScrollView(size_hint=(1, 0.8))
-        self.connections_layout = BoxLayout(orientation='vertical', size_hint_y=None, spacing=10)
-        self.connections_layout.bind(minimum_height=self.connections_layout.setter('height'))
-        self.scroll_view.add_widget(self.connections_layout)
-        layout.add_widget(self.scroll_view)
+        # Placeholder shown when there are no connections
+        self.no_connection_label = Label(
+            text='',
+            font_size='18sp',
+            color=(1, 1, 1, 1),
+            size_hint=(1, 0.1),
+            font_name=FONT_PATH
+        )
+        layout.add_widget(self.no_connection_label)
+
+        # Add a RecycleView to display the list of active connections.
+        # Only the visible rows exist as widgets; the list itself lives in its data.
+        self.connections_view = RecycleView(size_hint=(1, 0.7), viewclass=VPNConnectionRow)
+        connections_layout = RecycleBoxLayout(
+            orientation='vertical',
+            size_hint_y=None,
+            default_size=(None, 160),
+            default_size_hint=(1, None),
+            spacing=10
+        )
+        connections_layout.bind(minimum_height=connections_layout.setter('height'))
+        self.connections_view.add_widget(connections_layout)
+        layout.add_widget(self.connections_view)
 
         # Add a Back button to return to the Home Screen
         back_button = Button(
             text='Back',
             size_hint=(0.3, 0.1),
             pos_hint={'center_x': 0.5},
-            font_name=font_path
+            font_name=FONT_PATH
         )
         back_button.bind(on_press=self.go_back)
         layout.add_widget(back_button)
@@ -93,85 +155,73 @@ class ActiveVPNScreen(Screen):
         """
         self.is_fetching = True
         active_connections = self.vpn_status_checker.get_active_vpn_clients()
-        Clock.schedule_once(lambda dt: self.display_connections(active_connections), 0)
+        # Pick up new or changed client configs off the UI thread
+        self.user_index.refresh_if_stale()
+        # Rates are computed here too, so the UI thread only compares strings
+        rate_texts = {}
+        for connection in active_connections:
+            key = peer_key(connection)
+            rate_texts[key] = self.rate_text(key)
+        Clock.schedule_once(lambda dt: self.display_connections(active_connections, rate_texts), 0)
         self.is_fetching = False
 
-    def display_connections(self, connections):
+    def display_connections(self, connections, rate_texts):
         """
         Displays the list of active VPN connections in the UI.
+        Only the data of peers that were added, removed or changed is touched,
+        and RecycleView re-renders just the visible rows whose data changed.
+        `rate_texts` maps peer keys to their rate text.
         """
-        self.connections_layout.clear_widgets()
-
-        if connections:
-            for connection in connections:
-                # Create a BoxLayout for each connection to display multiple details
-                connection_box = BoxLayout(orientation='vertical', size_hint_y=None, height=100, padding=10, spacing=5)
-
-                # Display IP Address
-                ip_label = Label(
-                    text=f"IP Address: {connection['ip_address']}",
-                    font_size='16sp',
-                    color=(1, 1, 1, 1),
-                    halign='left',
-                    valign='middle',
-                    size_hint=(1, 0.3),
-                    font_name=os.path.join(
-                        os.path.dirname(os.path.abspath(__file__)),
-                        'fonts',
-                        'SixtyFourConvergence.ttf'
-                    )
-                )
-                ip_label.bind(size=ip_label.setter('text_size'))
-                connection_box.add_widget(ip_label)
-
-                # Display Endpoint
-                endpoint_label = Label(
-                    text=f"Endpoint: {connection['endpoint']}",
-                    font_size='16sp',
-                    color=(1, 1, 1, 1),
-                    halign='left',
-                    valign='middle',
-                    size_hint=(1, 0.3),
-                    font_name=os.path.join(
-                        os.path.dirname(os.path.abspath(__file__)),
-                        'fonts',
-                        'SixtyFourConvergence.ttf'
-                    )
-                )
-                endpoint_label.bind(size=endpoint_label.setter('text_size'))
-                connection_box.add_widget(endpoint_label)
-
-                # Display Latest Handshake
-                handshake_label = Label(
-                    text=f"Last Handshake: {connection['latest_handshake']}",
-                    font_size='16sp',
-                    color=(1, 1, 1, 1),
-                    halign='left',
-                    valign='middle',
-                    size_hint=(1, 0.3),
-                    font_name=os.path.join(
-                        os.path.dirname(os.path.abspath(__file__)),
-                        'fonts',
-                        'SixtyFourConvergence.ttf'
-                    )
-                )
-                handshake_label.bind(size=handshake_label.setter('text_size'))
-                connection_box.add_widget(handshake_label)
-
-                self.connections_layout.add_widget(connection_box)
-        else:
-            no_connection_label = Label(
-                text='No active VPN connections.',
-                font_size='18sp',
-                color=(1, 1, 1, 1),
-                size_hint=(1, 0.2),
-                font_name=os.path.join(
-                    os.path.dirname(os.path.abspath(__file__)),
-                    'fonts',
-                    'SixtyFourConvergence.ttf'
-                )
-            )
-            self.connections_layout.add_widget(no_connection_label)
+        delta = self.peer_differ.update(connections)
+        data = self.connections_view.data
+
+        if delta.removed:
+            # Rebuild the list without the removed peers in one assignment
+            data[:] = [item for item in data if item['key'] not in delta.removed]
+            self.row_index = {item['key']: index for index, item in enumerate(data)}
+
+        for key, connection in delta.changed.items():
+            index = self.row_index[key]
+            data[index] = self.connection_row_data(connection, rate_texts)
+
+        # Rates move on every poll even when the counters of a peer did not change
+        for key, index in self.row_index.items():
+            if key not in delta.changed:
+                rate_text = rate_texts.get(key, data[index]['rate_text'])
+                if data[index]['rate_text'] != rate_text:
+                    data[index] = dict(data[index], rate_text=rate_text)
+
+        if delta.added:
+            new_rows = [self.connection_row_data(connection, rate_texts) for connection in delta.added.values()]
+            start = len(data)
+            data.extend(new_rows)
+            for offset, item in enumerate(new_rows):
+                self.row_index[item['key']] = start + offset
+
+        self.no_connection_label.text = '' if data else 'No active VPN connections.'
+
+    def connection_row_data(self, connection, rate_texts):
+        """
+        Returns the RecycleView data item for a VPN connection.
+        """
+        key = peer_key(connection)
+        username = self.user_index.lookup(connection.public_key, connection.ip_address)
+        return {
+            'key': key,
+            'user_text': f"User: {username or 'Unknown'}",
+            'ip_text': f"IP Address: {connection.ip_address}",
+            'endpoint_text': f"Endpoint: {connection.endpoint}",
+            'handshake_text': f"Last Handshake: {connection.handshake_time}",
+            'rate_text': rate_texts[key]
+        }
+
+    def rate_text(self, key):
+        """
+        Returns the 1-minute receive and transmit rates of a peer for display.
+        """
+        rates = self.rate_tracker.get_rate(key, 60)
+        rx, tx = rates if rates else (None, None)
+        return f"RX: {format_rate(rx)}  TX: {format_rate(tx)}"
 
     def go_back(self, instance):
         """
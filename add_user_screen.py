@@ -6,9 +6,13 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.image import Image
 from kivy.clock import Clock
 from kivy.uix.popup import Popup
+from kivy.uix.filechooser import FileChooserListView
+from kivy.graphics.texture import Texture
 import logging
 import threading
+import time
 import os
+import re
 
 # Import the backend classes
 from user_management import UserManager
@@ -39,7 +43,7 @@ class AddUserScreen(Screen):
 
         # Add a prompt label with custom font
         prompt_label = Label(
-            text='Enter username for your VPN client profile',
+            text='Enter username(s) for your VPN client profile',
             font_size='20sp',
             color=(0, 0, 0, 1),  # Black text
             font_name=font_path,
@@ -49,7 +53,7 @@ class AddUserScreen(Screen):
 
         # Add TextInput for username with custom styling
         self.username_input = TextInput(
-            hint_text='Username',
+            hint_text='Username (or several, separated by commas)',
             multiline=False,
             size_hint=(0.6, 0.2),
             pos_hint={'center_x': 0.5},
@@ -72,6 +76,28 @@ class AddUserScreen(Screen):
         )
         submit_button.bind(on_press=self.submit_username)
         layout.add_widget(submit_button)
+        self.submit_button = submit_button
+
+        # Add Import CSV button for provisioning many users at once
+        import_button = Button(
+            text='Import CSV',
+            size_hint=(0.3, 0.2),
+            pos_hint={'center_x': 0.5},
+            font_name=font_path,
+            font_size='18sp'
+        )
+        import_button.bind(on_press=self.choose_csv_file)
+        layout.add_widget(import_button)
+
+        # Progress of bulk provisioning
+        self.progress_label = Label(
+            text='',
+            font_size='16sp',
+            color=(0, 0, 0, 1),
+            font_name=font_path,
+            size_hint=(1, 0.1)
+        )
+        layout.add_widget(self.progress_label)
 
         # Add Back button to return to Home Screen
         back_button = Button(
@@ -92,8 +118,13 @@ class AddUserScreen(Screen):
         Handles the submission of the username.
         Validates input and provides feedback.
         """
-        username = self.username_input.text.strip()
-        if username:
+        usernames = [name for name in re.split(r'[,\s]+', self.username_input.text) if name]
+        if len(usernames) > 1:
+            logging.debug(f"Usernames entered: {usernames}")
+            instance.disabled = True
+            threading.Thread(target=self.process_add_users, args=(usernames, instance), daemon=True).start()
+        elif usernames:
+            username = usernames[0]
             logging.debug(f"Username entered: {username}")
             # Disable the submit button to prevent multiple clicks
             instance.disabled = True
@@ -108,24 +139,94 @@ class AddUserScreen(Screen):
         Processes adding a user in the backend.
         Runs in a separate thread to prevent UI blocking.
         """
-        # Call the backend to add the user
-        result = self.user_manager.add_user(username)
+        started = time.perf_counter()
+        try:
+            # Call the backend to add the user
+            result = self.user_manager.add_user(username)
 
-        if result['success']:
-            # Read the VPN config file contents
-            config_file_path = os.path.join(self.user_manager.config_dir, f"{username}.conf")
-            if os.path.exists(config_file_path):
-                with open(config_file_path, 'r') as config_file:
-                    config_data = config_file.read()
-
-                # Generate QR code
-                qr_image_path = self.qr_generator.generate_qr_code(username, config_data)
-                result['qr_image_path'] = qr_image_path
+            if result['success']:
+                # The native backend returns the config it just wrote; otherwise read the file
+                config_data = result.get('config_data') or self.user_manager.read_user_config(username)
+                if config_data is not None:
+                    # Render the QR code to raw pixels; the texture is made on the main thread
+                    qr_started = time.perf_counter()
+                    result['qr_buffer'] = self.qr_generator.generate_qr_buffer(username, config_data)
+                    result['timings'] = {'started': started, 'qr_started': qr_started}
+        except Exception as e:
+            logging.exception(f"Adding user {username} failed")
+            result = {'success': False, 'message': f"Failed to add user {username}: {e}"}
+        finally:
+            # Schedule the UI update on the main thread; it re-enables the submit button
+            Clock.schedule_once(lambda dt: self.handle_backend_response(result, submit_button), 0)
+
+    def process_add_users(self, usernames, submit_button, csv_path=None):
+        """
+        Provisions several users, then renders their QR codes in a process pool.
+        Runs in a separate thread and streams progress to the progress label.
+        """
+        def provision_progress(done, total, username, user_result):
+            status = 'added' if user_result['success'] else 'failed'
+            self.show_progress(f"Provisioning {done} of {total}: {username} {status}")
+
+        def qr_progress(done, total, username, qr_image_path):
+            self.show_progress(f"QR codes {done} of {total}")
+
+        result = {'success': False, 'message': "Adding users failed."}
+        try:
+            if csv_path:
+                result = self.user_manager.add_users_from_csv(csv_path, provision_progress)
             else:
-                logging.error(f"Config file for user '{username}' not found.")
+                result = self.user_manager.add_users(usernames, provision_progress)
 
-        # Schedule the UI update on the main thread
-        Clock.schedule_once(lambda dt: self.handle_backend_response(result, submit_button), 0)
+            added = [username for username, user_result in result.get('results', {}).items() if user_result['success']]
+            configs = []
+            for username in added:
+                config_data = self.user_manager.read_user_config(username)
+                if config_data is not None:
+                    configs.append((username, config_data))
+            qr_image_paths = self.qr_generator.generate_qr_codes(configs, qr_progress)
+            if self.qr_generator.save_named_copies(qr_image_paths):
+                result['message'] += f" QR codes saved to {self.qr_generator.qr_image_dir}."
+        except Exception as e:
+            logging.exception("Adding users failed")
+            result = dict(result, success=False, message=f"{result['message']} Error: {e}")
+        finally:
+            # Always clear the progress and re-enable the submit button
+            self.show_progress('')
+            Clock.schedule_once(lambda dt: self.handle_backend_response(result, submit_button), 0)
+
+    def show_progress(self, text):
+        """
+        Shows bulk provisioning progress. Safe to call from worker threads.
+        """
+        Clock.schedule_once(lambda dt: setattr(self.progress_label, 'text', text), 0)
+
+    def choose_csv_file(self, instance):
+        """
+        Lets the user pick a CSV file of usernames to provision.
+        """
+        popup_content = BoxLayout(orientation='vertical', padding=20, spacing=20)
+        file_chooser = FileChooserListView(filters=['*.csv'], path=os.path.expanduser('~'))
+        popup_content.add_widget(file_chooser)
+
+        import_button = Button(text='Import', size_hint=(1, 0.15), font_size='18sp')
+        popup_content.add_widget(import_button)
+
+        popup = Popup(title='Import users from CSV', content=popup_content, size_hint=(0.9, 0.9))
+
+        def start_import(button):
+            if not file_chooser.selection:
+                return
+            popup.dismiss()
+            self.submit_button.disabled = True
+            threading.Thread(
+                target=self.process_add_users,
+                args=([], self.submit_button, file_chooser.selection[0]),
+                daemon=True
+            ).start()
+
+        import_button.bind(on_press=start_import)
+        popup.open()
 
     def handle_backend_response(self, result, submit_button):
         """
@@ -135,13 +236,16 @@ class AddUserScreen(Screen):
         submit_button.disabled = False
 
         if result['success']:
-            self.display_submission_success(result['message'], result.get('qr_image_path'))
+            # Bulk results point at the saved QR codes instead of showing one
+            self.display_submission_success(result['message'], result.get('qr_buffer'),
+                                            show_qr='results' not in result, timings=result.get('timings'))
         else:
             self.display_submission_failure(result['message'])
 
-    def display_submission_success(self, message, qr_image_path):
+    def display_submission_success(self, message, qr_buffer, show_qr=True, timings=None):
         """
-        Displays a success message and shows the QR code image.
+        Displays a success message and shows the QR code, blitting the
+        (size, rgba_data) buffer from QRCodeGenerator.generate_qr_buffer into a texture.
         """
         # Create content for the popup
         popup_content = BoxLayout(orientation='vertical', padding=20, spacing=20)
@@ -157,9 +261,11 @@ class AddUserScreen(Screen):
         success_label.bind(size=success_label.setter('text_size'))
         popup_content.add_widget(success_label)
 
-        if qr_image_path and os.path.isfile(qr_image_path):
+        if not show_qr:
+            pass
+        elif qr_buffer:
             qr_image = Image(
-                source=qr_image_path,
+                texture=self.create_qr_texture(*qr_buffer),
                 size_hint=(1, 0.6),
                 allow_stretch=True
             )
@@ -195,6 +301,22 @@ class AddUserScreen(Screen):
         close_button.bind(on_press=popup.dismiss)
         popup.open()
 
+        if timings:
+            now = time.perf_counter()
+            logging.debug(f"QR popup shown {(now - timings['qr_started']) * 1000:.1f} ms after QR rendering started "
+                          f"({(now - timings['started']) * 1000:.1f} ms including provisioning).")
+
+    def create_qr_texture(self, size, rgba_data):
+        """
+        Creates a texture from an RGBA QR code buffer. Must run on the main thread.
+        """
+        texture = Texture.create(size=size, colorfmt='rgba')
+        # Keep the modules sharp when the image is stretched
+        texture.mag_filter = 'nearest'
+        texture.min_filter = 'nearest'
+        texture.blit_buffer(rgba_data, colorfmt='rgba', bufferfmt='ubyte')
+        return texture
+
     def display_submission_failure(self, message="Please enter a valid username."):
         """
         Displays an error message if the username input is invalid.
@@ -0,0 +1,109 @@
+# bench_device_http.py
+#
+# Measures the latency of device control requests sent through the pooled
+# DeviceControlClient session and with a new requests.post() per call, as
+# the app did before. Both talk to a local stdlib HTTP server that answers
+# like the control server, so only client overhead and connection setup differ.
+#
+#   python benchmarks/bench_device_http.py [requests] [delay_ms]
+
+import os
+import sys
+import json
+import time
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from device_control import DeviceControlClient
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST /control-method with {"state": ...} after the server's delay.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Keep-alive responses go out as two writes; without this Nagle's
+    # algorithm and delayed ACKs add ~40 ms to every pooled request
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        time.sleep(self.server.delay)
+        state = 'ON' if 'action=activate' in body else 'OFF'
+        payload = json.dumps({'state': state}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(delay):
+    """
+    Starts the control server stand-in on a free local port.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ControlHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def post_per_call(base_url):
+    """
+    The request the app sent before DeviceControlClient: a new connection per call.
+    """
+    def send(device_id, action):
+        response = requests.post(f"{base_url}/control-method", data={'action': action, 'device_id': device_id},
+                                 timeout=(3, 10))
+        return {'success': response.ok, 'state': response.json().get('state')}
+    return send
+
+
+def measure(send, count):
+    """
+    Returns the median and 95th percentile latency in ms of `count` calls.
+    """
+    latencies = []
+    for index in range(count):
+        start = time.perf_counter()
+        result = send(f"device{index % 10}", 'activate' if index % 2 else 'deactivate')
+        latencies.append((time.perf_counter() - start) * 1000)
+        if not result['success']:
+            raise RuntimeError(f"Request {index} failed: {result}")
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    delay_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server = start_server(delay_ms / 1000)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    client = DeviceControlClient(base_url=base_url, ca_bundle=None)
+
+    # One warm-up call each so imports and the first connection are not timed
+    senders = (('requests.post', post_per_call(base_url)), ('pooled session', client.set_device_state))
+    for _, send in senders:
+        send('device0', 'activate')
+
+    print(f"{count} requests, server delay {delay_ms:.1f} ms")
+    try:
+        for name, send in senders:
+            median, p95 = measure(send, count)
+            print(f"  {name:14} {median:7.2f} ms median  {p95:7.2f} ms p95")
+    finally:
+        client.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# bench_wg_dump.py
+#
+# Measures parsing a synthetic 'wg show all dump' with the dict-per-peer
+# parser the app used before and with VPNStatusChecker.parse_dump().
+# Only parsing is timed; no 'wg' subprocess is run.
+#
+#   python benchmarks/bench_wg_dump.py [peers] [repeats]
+
+import os
+import re
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vpn_status import VPNStatusChecker
+
+
+def make_dump(peers):
+    """
+    Returns the lines of a dump with one interface and `peers` peers.
+    """
+    lines = ["wg0\tc2VydmVyLXByaXZhdGUta2V5\tc2VydmVyLXB1YmxpYy1rZXk=\t51820\toff"]
+    now = int(time.time())
+    for index in range(peers):
+        address = f"10.{6 + index // 65536}.{index // 256 % 256}.{index % 256}"
+        lines.append('\t'.join((
+            'wg0',
+            f"peer{index:039d}=",
+            f"psk{index:040d}=",
+            f"203.0.113.{index % 250 + 1}:{40000 + index % 20000}",
+            f"{address}/32,fd11:5ee:bad:c0de::{index:x}/128",
+            str(now - index % 600 if index % 5 else 0),
+            str(index * 1024),
+            str(index * 512),
+            'off'
+        )))
+    return lines
+
+
+def parse_dump_dicts(lines):
+    """
+    The parser before WireGuardPeer: a dictionary per peer, the primary IP
+    found with a regex and the handshake formatted up front.
+    """
+    active_clients = []
+    for line in lines:
+        parts = line.strip().split('\t')
+        if len(parts) < 8:
+            continue
+        interface, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx = parts[:8]
+        ip_match = re.search(r'(\d{1,3}\.){3}\d{1,3}', allowed_ips)
+        ip_address = ip_match.group() if ip_match else "Unknown"
+        if latest_handshake.isdigit() and int(latest_handshake) > 0:
+            handshake_time = datetime.fromtimestamp(int(latest_handshake)).strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            handshake_time = "Never"
+        active_clients.append({
+            'interface': interface,
+            'public_key': public_key,
+            'endpoint': endpoint,
+            'allowed_ips': allowed_ips,
+            'latest_handshake': handshake_time,
+            'transfer_rx': transfer_rx,
+            'transfer_tx': transfer_tx,
+            'ip_address': ip_address
+        })
+    return active_clients
+
+
+def measure(parse, lines, repeats):
+    """
+    Returns the best time in ms over `repeats` runs and the peak traced
+    allocation in MB of one run.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parse(lines)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = parse(lines)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return best * 1000, peak / (1024 * 1024)
+
+
+def main():
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    lines = make_dump(peers)
+    # A checker polled repeatedly keeps its address cache warm
+    checker = VPNStatusChecker(snapshot_service=object())
+    checker.parse_dump(lines)
+
+    print(f"{peers} peers, best of {repeats}")
+    for name, parse in (('dicts', parse_dump_dicts), ('WireGuardPeer', checker.parse_dump)):
+        elapsed, peak = measure(parse, lines, repeats)
+        print(f"  {name:14} {elapsed:7.1f} ms  {peak:5.1f} MB peak")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# db_pool.py
+
+import time
+import threading
+import logging
+from contextlib import contextmanager
+
+
+class PoolError(Exception):
+    """
+    Raised when the pool cannot hand out a connection.
+    """
+
+
+class PoolTimeoutError(PoolError):
+    """
+    Raised when no connection became free within the checkout timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections.
+
+    Each call checks a connection out with connection() and returns it when the
+    block ends, so threads never share a connection. At most `max_size`
+    connections are open; callers wait up to `timeout` seconds for one to be
+    returned. Connections that sat idle for `health_check_interval` seconds are
+    pinged before use and replaced when the ping fails. When the database is
+    unreachable, new connection attempts back off exponentially from
+    `backoff_initial` up to `backoff_max` seconds.
+
+    Returned connections are rolled back, so each checkout starts a fresh
+    transaction.
+
+    `connect` is a callable returning a new DB-API connection with ping(),
+    rollback() and close(); `errors` is the tuple of exceptions the driver raises.
+    """
+
+    def __init__(self, connect, errors=(Exception,), max_size=4, timeout=5.0, health_check_interval=30.0,
+                 backoff_initial=0.5, backoff_max=30.0):
+        self.connect = connect
+        self.errors = errors
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self._condition = threading.Condition()
+        # Idle connections as (connection, returned_at), most recently returned last
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._backoff = 0.0
+        self._next_attempt = 0.0
+        self._closed = False
+        self._metrics = {
+            'checkouts': 0, 'wait_time': 0.0, 'max_wait': 0.0, 'timeouts': 0,
+            'connects': 0, 'reconnects': 0, 'connect_failures': 0, 'health_check_failures': 0
+        }
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of a with block.
+        Raises PoolTimeoutError if none is free in time, PoolError while the
+        database is unreachable, or the driver error from connecting.
+        """
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+        except self.errors:
+            # The error may have come from a dropped connection; check before reusing it
+            broken = not self._is_alive(conn)
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def metrics(self):
+        """
+        Returns pool counters: size, in-use and idle connections, checkout wait
+        times, timeouts, reconnects and failed connection attempts.
+        """
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics.update(size=self._size, in_use=self._in_use, idle=len(self._idle), max_size=self.max_size)
+        checkouts = metrics['checkouts']
+        metrics['avg_wait_ms'] = metrics['wait_time'] * 1000 / checkouts if checkouts else 0.0
+        return metrics
+
+    def close(self):
+        """
+        Closes the idle connections; connections in use are closed when returned.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _checkout(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolError("Connection pool is closed.")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot, then connect outside the lock
+                    self._size += 1
+                    self._in_use += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics['timeouts'] += 1
+                    raise PoolTimeoutError(f"No database connection free after {self.timeout} s.")
+                self._condition.wait(remaining)
+
+            wait = time.monotonic() - started
+            self._metrics['checkouts'] += 1
+            self._metrics['wait_time'] += wait
+            self._metrics['max_wait'] = max(self._metrics['max_wait'], wait)
+
+        try:
+            if conn is None:
+                return self._open()
+            if time.monotonic() - returned_at >= self.health_check_interval and not self._is_alive(conn):
+                logging.debug("Pooled database connection failed its health check; reconnecting.")
+                with self._condition:
+                    self._metrics['health_check_failures'] += 1
+                    self._metrics['reconnects'] += 1
+                self._close(conn)
+                return self._open()
+            return conn
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def _checkin(self, conn, broken):
+        if not broken and not self._closed:
+            # End the transaction, so the next user does not read an old
+            # REPEATABLE READ snapshot or inherit uncommitted changes
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        with self._condition:
+            self._in_use -= 1
+            if broken or self._closed:
+                self._size -= 1
+                if broken:
+                    self._metrics['reconnects'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._condition.notify()
+        if conn is not None:
+            self._close(conn)
+
+    def _open(self):
+        """
+        Opens a new connection, honouring the reconnect backoff.
+        """
+        with self._condition:
+            delay = self._next_attempt - time.monotonic()
+        if delay > 0:
+            raise PoolError(f"Database unavailable; next connection attempt in {delay:.1f} s.")
+
+        try:
+            conn = self.connect()
+        except self.errors:
+            with self._condition:
+                self._metrics['connect_failures'] += 1
+                self._backoff = min(self._backoff * 2 or self.backoff_initial, self.backoff_max)
+                self._next_attempt = time.monotonic() + self._backoff
+            raise
+
+        with self._condition:
+            self._metrics['connects'] += 1
+            self._backoff = 0.0
+            self._next_attempt = 0.0
+        return conn
+
+    def _is_alive(self, conn):
+        try:
+            conn.ping()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,398 @@
+# device_control.py
+
+import os
+import random
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# Control server; the CA bundle verifies its certificate when set
+CONTROL_BASE_URL = os.environ.get('DEVICE_CONTROL_URL', 'https://198.82.190.97:5000')
+CONTROL_CA_BUNDLE = os.environ.get('DEVICE_CONTROL_CA_BUNDLE')
+
+# Seconds to wait for the connection and for the response
+CONNECT_TIMEOUT = float(os.environ.get('DEVICE_CONTROL_CONNECT_TIMEOUT', 3))
+READ_TIMEOUT = float(os.environ.get('DEVICE_CONTROL_READ_TIMEOUT', 10))
+
+# Parallel single requests for bulk actions when the server has no batch endpoint
+BULK_CONCURRENCY = int(os.environ.get('DEVICE_CONTROL_CONCURRENCY', 8))
+
+# Retries of a failed command, and the first backoff delay in seconds
+COMMAND_RETRIES = int(os.environ.get('DEVICE_CONTROL_RETRIES', 4))
+COMMAND_BACKOFF = float(os.environ.get('DEVICE_CONTROL_BACKOFF', 0.5))
+
+
+def summarize_results(device_ids, results):
+    """
+    Builds the result dictionary of a bulk action from its per-device results.
+    """
+    succeeded = sum(1 for result in results.values() if result['success'])
+    message = f"{succeeded} of {len(device_ids)} devices updated."
+    failed = [device_id for device_id, result in results.items() if not result['success']]
+    if failed:
+        message += f" Failed: {', '.join(failed[:10])}{'...' if len(failed) > 10 else ''}."
+    logging.info(message)
+    return {'success': bool(device_ids) and not failed, 'message': message, 'results': results}
+
+
+class DeviceControlClient:
+    """
+    HTTP client for the device control server.
+
+    All requests share one requests.Session, so connections (and their TLS
+    sessions) are kept alive and reused instead of being set up for every
+    toggle. The session's pool holds up to `pool_size` connections for
+    concurrent callers, and every request has a connect and read timeout.
+    """
+
+    _shared_instance = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, base_url=CONTROL_BASE_URL, ca_bundle=CONTROL_CA_BUNDLE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # None until the first bulk action finds out whether the server has a batch endpoint
+        self.batch_supported = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if ca_bundle:
+            self.session.verify = ca_bundle
+        else:
+            # The control server uses a self-signed certificate; warn once instead of on every request
+            self.session.verify = False
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            logging.warning("DEVICE_CONTROL_CA_BUNDLE is not set; the control server certificate is not verified.")
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the process-wide client.
+        """
+        with cls._shared_lock:
+            if cls._shared_instance is None:
+                cls._shared_instance = cls()
+            return cls._shared_instance
+
+    def set_device_state(self, device_id, action):
+        """
+        Sends an 'activate' or 'deactivate' action for a device.
+        Returns a dictionary with success status, the device's new 'state'
+        ('ON' or 'OFF') and a message.
+        """
+        url = f"{self.base_url}/control-method"
+        data = {
+            'action': action,
+            'device_id': device_id
+        }
+
+        try:
+            logging.debug(f"Sending POST request to {url} with data: {data}")
+            response = self.session.post(url, data=data, timeout=self.timeout)
+            logging.debug(f"Response Status: {response.status_code}, Body: {response.text}")
+        except requests.RequestException as e:
+            logging.error(f"Error sending toggle request for device {device_id}: {e}")
+            return {'success': False, 'message': f"Could not reach the control server: {e}"}
+
+        if not response.ok:
+            logging.error(f"Control server answered {response.status_code} for device {device_id}: {response.text}")
+            return {'success': False, 'message': f"Control server error {response.status_code} for device {device_id}."}
+
+        # Check if the response is valid JSON
+        try:
+            new_state = str(response.json().get('state', 'OFF')).upper()
+        except (ValueError, AttributeError) as e:
+            logging.error(f"Error parsing response as JSON: {e}")
+            logging.error(f"Response body: {response.text}")
+            # Fallback based on action
+            new_state = 'ON' if action == 'activate' else 'OFF'
+
+        return {'success': True, 'state': new_state, 'message': f"Device {device_id} is {new_state}."}
+
+    def set_device_states(self, device_ids, action, max_workers=BULK_CONCURRENCY):
+        """
+        Sends the same action to many devices.
+
+        The whole set goes to the server's batch endpoint when it has one;
+        otherwise, and for devices the batch response leaves out, single
+        requests run with at most `max_workers` in flight. Returns a dictionary
+        with success status, a message and per-device 'results'.
+        """
+        device_ids = list(dict.fromkeys(device_ids))
+        results = {}
+        if not device_ids:
+            return {'success': False, 'message': "No devices selected.", 'results': results}
+
+        if self.batch_supported is not False:
+            results.update(self._send_batch(device_ids, action))
+
+        remaining = [device_id for device_id in device_ids if device_id not in results]
+        if remaining:
+            # Never ask for more connections than the session keeps alive
+            workers = max(1, min(max_workers, self.pool_size, len(remaining)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for device_id, result in zip(remaining, executor.map(
+                        lambda device_id: self.set_device_state(device_id, action), remaining)):
+                    results[device_id] = result
+
+        return summarize_results(device_ids, results)
+
+    def _send_batch(self, device_ids, action):
+        """
+        Sends an action for several devices to the batch endpoint.
+        Returns per-device results for the devices the server reported on.
+        The server is expected to answer {"states": {device_id: state}}.
+        """
+        url = f"{self.base_url}/control-method/batch"
+        try:
+            response = self.session.post(url, json={'action': action, 'device_ids': device_ids},
+                                         timeout=(self.timeout[0], self.timeout[1] * 3))
+        except requests.RequestException as e:
+            logging.debug(f"Batch control request failed, sending single requests: {e}")
+            return {}
+
+        if response.status_code in (404, 405, 501):
+            logging.debug("Control server has no batch endpoint; sending single requests.")
+            self.batch_supported = False
+            return {}
+        try:
+            response.raise_for_status()
+            states = response.json()['states']
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Unexpected batch control response, sending single requests: {e}")
+            return {}
+
+        self.batch_supported = True
+        results = {}
+        for device_id in device_ids:
+            state = states.get(device_id)
+            if state is not None:
+                state = str(state).upper()
+                results[device_id] = {'success': True, 'state': state, 'message': f"Device {device_id} is {state}."}
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+class DeviceCommandQueue:
+    """
+    Per-device queue of control commands.
+
+    At most one request per device is in flight. A command submitted while
+    another is in flight or waiting replaces the waiting one, so only the
+    latest desired state is sent. Failed requests are retried with
+    exponential backoff and full jitter, and a retry is dropped as soon as a
+    newer command for the device arrives. Callbacks of superseded commands
+    are carried over to the command that replaced them, so every caller
+    hears the final outcome.
+
+    Callbacks are called as callback(device_id, result) on a worker thread.
+    """
+
+    _shared_instance = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, client=None, max_workers=BULK_CONCURRENCY, retries=COMMAND_RETRIES, backoff=COMMAND_BACKOFF,
+                 max_backoff=30.0):
+        self.client = client or DeviceControlClient.shared()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='DeviceCommand')
+
+        self._condition = threading.Condition()
+        # Device id -> (action, [callbacks]) waiting to be sent
+        self._pending = {}
+        self._in_flight = set()
+        self._stats = {'submitted': 0, 'coalesced': 0, 'sent': 0, 'retries': 0, 'failed': 0}
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the process-wide queue.
+        """
+        with cls._shared_lock:
+            if cls._shared_instance is None:
+                cls._shared_instance = cls()
+            return cls._shared_instance
+
+    def submit(self, device_id, action, callback=None):
+        """
+        Queues an 'activate' or 'deactivate' command for a device.
+        """
+        with self._condition:
+            self._stats['submitted'] += 1
+            callbacks = [callback] if callback else []
+            waiting = self._pending.get(device_id)
+            if waiting is not None:
+                self._stats['coalesced'] += 1
+                callbacks = waiting[1] + callbacks
+            self._pending[device_id] = (action, callbacks)
+            # Wake a worker backing off on an older command for this device
+            self._condition.notify_all()
+            if device_id in self._in_flight:
+                return
+            self._in_flight.add(device_id)
+        self.executor.submit(self._drain, device_id)
+
+    def submit_many(self, device_ids, action, callback=None):
+        """
+        Sends the same command to many devices and waits for every result.
+
+        Idle devices go out together through the client's bulk path and stay
+        marked in flight meanwhile, so taps made during the batch queue behind
+        it. Devices the batch failed for are retried with backoff like single
+        commands. Devices with a command in flight get the bulk command queued
+        behind theirs, superseding any waiting one, so no device sees its
+        commands out of order. Returns a dictionary with success status, a
+        message and per-device 'results'.
+        """
+        device_ids = list(dict.fromkeys(device_ids))
+        if not device_ids:
+            return {'success': False, 'message': "No devices selected.", 'results': {}}
+
+        batch = []
+        queued = []
+        with self._condition:
+            for device_id in device_ids:
+                if device_id in self._in_flight:
+                    queued.append(device_id)
+                else:
+                    self._in_flight.add(device_id)
+                    batch.append(device_id)
+            # Queued devices are counted by submit()
+            self._stats['submitted'] += len(batch)
+
+        results = {}
+        awaited = set(queued)
+        done = threading.Event()
+
+        def on_queued_result(device_id, result):
+            with self._condition:
+                results[device_id] = result
+                if awaited.issubset(results):
+                    done.set()
+
+        for device_id in queued:
+            self.submit(device_id, action, on_queued_result)
+
+        retried = []
+        if batch:
+            batch_results = {}
+            try:
+                batch_results = self.client.set_device_states(batch, action)['results']
+            finally:
+                with self._condition:
+                    self._stats['sent'] += len(batch)
+                    resumed = []
+                    for device_id in batch:
+                        result = batch_results.get(device_id)
+                        if result is not None and not result['success'] and self.retries:
+                            # Stays in flight; its retries go through _drain
+                            retried.append(device_id)
+                        elif device_id in self._pending:
+                            # Taps made during the batch were left waiting; send them now
+                            resumed.append(device_id)
+                        else:
+                            self._in_flight.discard(device_id)
+                for device_id in resumed:
+                    self.executor.submit(self._drain, device_id)
+            with self._condition:
+                finished = {device_id: result for device_id, result in batch_results.items() if device_id not in retried}
+                self._stats['failed'] += sum(1 for result in finished.values() if not result['success'])
+                results.update(finished)
+                awaited.update(retried)
+                if awaited.issubset(results):
+                    done.set()
+            for device_id in retried:
+                self.executor.submit(self._drain, device_id, (action, [on_queued_result]))
+            if callback:
+                for device_id, result in finished.items():
+                    try:
+                        callback(device_id, result)
+                    except Exception:
+                        logging.exception(f"Device command callback failed for device {device_id}.")
+
+        if awaited:
+            done.wait()
+            if callback:
+                for device_id in queued + retried:
+                    try:
+                        callback(device_id, results[device_id])
+                    except Exception:
+                        logging.exception(f"Device command callback failed for device {device_id}.")
+        return summarize_results(device_ids, results)
+
+    def stats(self):
+        """
+        Returns submitted, coalesced, sent, retried and failed command counts.
+        """
+        with self._condition:
+            return dict(self._stats)
+
+    def _drain(self, device_id, failed=None):
+        """
+        Sends the device's waiting commands one at a time until none are left.
+        `failed` is an (action, callbacks) command whose first try already
+        failed in a batch; it is retried before anything else.
+        """
+        while True:
+            if failed is not None:
+                (action, callbacks), attempt, failed = failed, 1, None
+            else:
+                with self._condition:
+                    waiting = self._pending.pop(device_id, None)
+                    if waiting is None:
+                        self._in_flight.discard(device_id)
+                        return
+                action, callbacks = waiting
+                attempt = 0
+
+            result = self._send(device_id, action, attempt)
+            if result is None:
+                # Superseded while backing off; the newer command inherits the callbacks
+                with self._condition:
+                    newer_action, newer_callbacks = self._pending[device_id]
+                    self._pending[device_id] = (newer_action, callbacks + newer_callbacks)
+                continue
+
+            for callback in callbacks:
+                try:
+                    callback(device_id, result)
+                except Exception:
+                    logging.exception(f"Device command callback failed for device {device_id}.")
+
+    def _send(self, device_id, action, attempt=0):
+        """
+        Sends one command with retries; `attempt` counts the tries already
+        made. Returns the result, or None if a newer command for the device
+        arrived before a retry.
+        """
+        while attempt <= self.retries:
+            if attempt:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+                with self._condition:
+                    self._stats['retries'] += 1
+                    if self._condition.wait_for(lambda: device_id in self._pending, timeout=delay):
+                        return None
+                logging.debug(f"Retrying '{action}' for device {device_id} (attempt {attempt + 1}).")
+
+            with self._condition:
+                self._stats['sent'] += 1
+            result = self.client.set_device_state(device_id, action)
+            if result['success']:
+                return result
+            attempt += 1
+
+        with self._condition:
+            self._stats['failed'] += 1
+        return result
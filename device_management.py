@@ -2,72 +2,549 @@
 
 import mariadb
 import os
+import time
 import logging
+import threading
+
+from db_pool import ConnectionPool, PoolError
+from device_state_store import DeviceStateStore
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Devices per keyset page
+DEVICE_PAGE_SIZE = 200
+
+# Ids per IN (...) query in get_device_states
+STATE_QUERY_CHUNK_SIZE = 500
+
+# Seconds tombstones are kept, and how often old ones are deleted; a sync
+# more than TOMBSTONE_RETENTION after the previous one reloads every device
+TOMBSTONE_RETENTION = float(os.environ.get('DEVICE_TOMBSTONE_RETENTION', 7 * 24 * 3600))
+TOMBSTONE_PRUNE_INTERVAL = float(os.environ.get('DEVICE_TOMBSTONE_PRUNE_INTERVAL', 3600))
+
+# Change tracking for incremental sync: a row version timestamp maintained by
+# MariaDB, and tombstones written by a trigger so deletions can be synced too.
+# Every statement is idempotent.
+CHANGE_TRACKING_MIGRATION = [
+    """ALTER TABLE devices ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP(6) NOT NULL
+        DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)""",
+    "CREATE INDEX IF NOT EXISTS idx_devices_updated_at ON devices (updated_at, id)",
+    """CREATE TABLE IF NOT EXISTS device_tombstones (
+        id VARCHAR(64) NOT NULL PRIMARY KEY,
+        deleted_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+        INDEX idx_device_tombstones_deleted_at (deleted_at)
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS devices_track_delete AFTER DELETE ON devices FOR EACH ROW
+        INSERT INTO device_tombstones (id, deleted_at) VALUES (OLD.id, CURRENT_TIMESTAMP(6))
+        ON DUPLICATE KEY UPDATE deleted_at = CURRENT_TIMESTAMP(6)""",
+]
+
+class DeviceStateCache:
+    """
+    Thread-safe read-through cache of device states with a per-entry TTL.
+    Devices that do not exist are cached as None so repeated lookups of
+    unknown ids do not hit the database either.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get('DEVICE_STATE_TTL', 5))
+        self._lock = threading.Lock()
+        # Device id -> (state, expires_at)
+        self._entries = {}
+        self._stats = {'hits': 0, 'misses': 0, 'queries': 0, 'rows': 0}
+
+    def get_many(self, device_ids):
+        """
+        Returns ({device_id: state} for fresh entries, [ids that missed]).
+        """
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for device_id in device_ids:
+                entry = self._entries.get(device_id)
+                if entry is not None and entry[1] > now:
+                    found[device_id] = entry[0]
+                else:
+                    missing.append(device_id)
+            self._stats['hits'] += len(found)
+            self._stats['misses'] += len(missing)
+        return found, missing
+
+    def put_many(self, states):
+        """
+        Stores {device_id: state} entries.
+        """
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for device_id, state in states.items():
+                self._entries[device_id] = (state, expires_at)
+            self._prune_locked()
+
+    def invalidate(self, device_ids=None):
+        """
+        Drops the given devices, or every device when device_ids is None.
+        """
+        with self._lock:
+            if device_ids is None:
+                self._entries.clear()
+                return
+            for device_id in device_ids:
+                self._entries.pop(device_id, None)
+
+    def record_query(self, rows):
+        with self._lock:
+            self._stats['queries'] += 1
+            self._stats['rows'] += rows
+
+    def stats(self):
+        """
+        Returns hit, miss, query and row counts and the hit rate.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _prune_locked(self):
+        """
+        Drops expired entries once the cache has grown. Must hold the lock.
+        """
+        if len(self._entries) < 4096:
+            return
+        now = time.monotonic()
+        self._entries = {device_id: entry for device_id, entry in self._entries.items() if entry[1] > now}
+
+
 class DeviceManagement:
+    """
+    Reads devices and their states from the SMART MariaDB database.
+    Every query checks a connection out of a shared pool, so the screens'
+    worker threads can query concurrently.
+    """
+
+    # Shared by every DeviceManagement instance
+    _pool = None
+    _pool_lock = threading.Lock()
+    state_cache = DeviceStateCache()
+
     def __init__(self):
-        try:
-            self.conn = mariadb.connect(
-                user=os.environ.get('DB_USER', 'SMART'),
-                password=os.environ.get('DB_PASSWORD', 'SMARTHOME'),
-                host=os.environ.get('DB_HOST', 'localhost'),
-                port=int(os.environ.get('DB_PORT', 3306)),
-                database=os.environ.get('DB_NAME', 'SMART_DB')
-            )
-            logging.debug("Connection to MariaDB Platform successful!")
-        except mariadb.Error as e:
-            logging.debug(f"Error connecting to MariaDB Platform: {e}")
-            self.conn = None
+        self.pool = DeviceManagement.shared_pool()
+
+    @classmethod
+    def shared_pool(cls):
+        """
+        Returns the process-wide connection pool, creating it on first use.
+        """
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ConnectionPool(
+                    connect=lambda: mariadb.connect(
+                        user=os.environ.get('DB_USER', 'SMART'),
+                        password=os.environ.get('DB_PASSWORD', 'SMARTHOME'),
+                        host=os.environ.get('DB_HOST', 'localhost'),
+                        port=int(os.environ.get('DB_PORT', 3306)),
+                        database=os.environ.get('DB_NAME', 'SMART_DB'),
+                        connect_timeout=int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+                    ),
+                    errors=(mariadb.Error,),
+                    max_size=int(os.environ.get('DB_POOL_SIZE', 4)),
+                    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5))
+                )
+            return cls._pool
 
     def get_devices(self):
         """
         Retrieves the list of devices from the database.
         Returns a list of dictionaries with 'id' and 'state' keys.
         """
-        if self.conn is None:
+        try:
+            device_list = list(self.iter_devices())
+        except (mariadb.Error, PoolError) as e:
+            logging.debug(f"Error fetching devices: {e}")
             return []
+        logging.debug(f"Query executed, fetched {len(device_list)} devices.")
+        return device_list
 
+    def iter_devices(self, state=None, id_prefix=None, page_size=DEVICE_PAGE_SIZE):
+        """
+        Yields devices as {'id', 'state'} dictionaries in id order, optionally
+        filtered by state and id prefix. Devices are read one keyset page at a
+        time and no connection is held between pages, so memory use does not
+        grow with the table. Raises mariadb.Error or PoolError on failure.
+        """
+        after_id = None
+        while True:
+            devices, after_id = self.fetch_device_page(after_id, page_size, state, id_prefix)
+            yield from devices
+            if after_id is None:
+                return
+
+    def get_device_page(self, after_id=None, page_size=DEVICE_PAGE_SIZE, state=None, id_prefix=None):
+        """
+        Retrieves one page of devices in id order, starting after `after_id`.
+        Returns (devices, next_after_id); next_after_id is None on the last
+        page. Returns ([], None) on error.
+        """
         try:
-            cur = self.conn.cursor()
-            query = "SELECT id, state FROM devices"  # Adjust if needed for your DB schema
-            cur.execute(query)
-            device_list = []
-            for row in cur:
-                device_list.append({'id': str(row[0]), 'state': str(row[1])})
-            cur.close()
-            logging.debug(f"Query executed, fetched devices: {device_list}")
-            return device_list
-        except mariadb.Error as e:
+            return self.fetch_device_page(after_id, page_size, state, id_prefix)
+        except (mariadb.Error, PoolError) as e:
             logging.debug(f"Error fetching devices: {e}")
-            return []
+            return [], None
+
+    def fetch_device_page(self, after_id, page_size, state=None, id_prefix=None):
+        """
+        Runs a single keyset page query. Raises mariadb.Error or PoolError on failure.
+        """
+        conditions = []
+        params = []
+        if after_id is not None:
+            conditions.append("id > ?")
+            params.append(after_id)
+        if state is not None:
+            conditions.append("state = ?")
+            params.append(state)
+        if id_prefix:
+            conditions.append("id LIKE ?")
+            params.append(id_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        query = "SELECT id, state FROM devices"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id LIMIT ?"
+        params.append(page_size)
+
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, tuple(params))
+            rows = cur.fetchall()
+            cur.close()
+
+        devices = [{'id': str(row[0]), 'state': str(row[1])} for row in rows]
+        # Keep the raw id as the cursor so numeric ids compare as numbers
+        next_after_id = rows[-1][0] if len(rows) == page_size else None
+        return devices, next_after_id
 
     def get_device_state(self, device_id):
         """
         Retrieves the state of a single device by its ID.
         Returns 'ON', 'OFF', or None if not found.
         """
-        if self.conn is None:
+        return self.get_device_states([device_id]).get(str(device_id))
+
+    def get_device_states(self, device_ids):
+        """
+        Retrieves the states of several devices, from the state cache where
+        possible and otherwise with one IN (...) query per chunk of ids.
+        Returns a dictionary mapping device ids to states; devices that were
+        not found map to None, and devices that could not be read are left out.
+        """
+        device_ids = list(dict.fromkeys(str(device_id) for device_id in device_ids))
+        states, missing = self.state_cache.get_many(device_ids)
+
+        for start in range(0, len(missing), STATE_QUERY_CHUNK_SIZE):
+            chunk = missing[start:start + STATE_QUERY_CHUNK_SIZE]
+            try:
+                with self.pool.connection() as conn:
+                    cur = conn.cursor()
+                    query = f"SELECT id, state FROM devices WHERE id IN ({', '.join('?' * len(chunk))})"
+                    cur.execute(query, tuple(chunk))
+                    rows = cur.fetchall()
+                    cur.close()
+            except (mariadb.Error, PoolError) as e:
+                logging.debug(f"Error fetching device states: {e}")
+                break
+            self.state_cache.record_query(len(rows))
+
+            fetched = dict.fromkeys(chunk)
+            fetched.update((str(row[0]), str(row[1])) for row in rows)
+            self.state_cache.put_many(fetched)
+            states.update(fetched)
+        return states
+
+    def state_cache_stats(self):
+        """
+        Returns the device state cache and query statistics.
+        """
+        return self.state_cache.stats()
+
+    def ensure_change_tracking(self):
+        """
+        Applies the change tracking migration.
+        Returns True if the devices table supports incremental sync.
+        """
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                for statement in CHANGE_TRACKING_MIGRATION:
+                    cur.execute(statement)
+                cur.close()
+                conn.commit()
+            logging.debug("Device change tracking is in place.")
+            return True
+        except (mariadb.Error, PoolError) as e:
+            logging.warning(f"Device change tracking unavailable, falling back to full refreshes: {e}")
+            return False
+
+    def get_device_changes(self, since=None, overlap=2.0):
+        """
+        Retrieves devices changed and deleted after `since` (a database
+        timestamp), or every device when `since` is None. The window starts
+        `overlap` seconds early so rows from transactions that were still open
+        at the previous sync are not missed.
+        Returns (now, rows, deleted) where rows are (id, state, updated_at)
+        tuples and deleted are (id, deleted_at) tuples, or None on error.
+        """
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT NOW(6)")
+                now = cur.fetchone()[0]
+                if since is None:
+                    cur.execute("SELECT id, state, updated_at FROM devices")
+                    rows = [(str(row[0]), str(row[1]), row[2]) for row in cur]
+                    deleted = []
+                else:
+                    cur.execute(
+                        "SELECT id, state, updated_at FROM devices "
+                        "WHERE updated_at > ? - INTERVAL ? MICROSECOND ORDER BY updated_at",
+                        (since, int(overlap * 1000000))
+                    )
+                    rows = [(str(row[0]), str(row[1]), row[2]) for row in cur]
+                    cur.execute(
+                        "SELECT id, deleted_at FROM device_tombstones WHERE deleted_at > ? - INTERVAL ? MICROSECOND",
+                        (since, int(overlap * 1000000))
+                    )
+                    deleted = [(str(row[0]), row[1]) for row in cur]
+                cur.close()
+            logging.debug(f"Fetched {len(rows)} changed and {len(deleted)} deleted devices.")
+            return now, rows, deleted
+        except (mariadb.Error, PoolError) as e:
+            logging.debug(f"Error fetching device changes: {e}")
             return None
 
+    def get_database_time(self):
+        """
+        Returns the database's NOW(6), or None on error.
+        """
         try:
-            cur = self.conn.cursor()
-            query = "SELECT state FROM devices WHERE id = ?"
-            cur.execute(query, (device_id,))
-            result = cur.fetchone()
-            cur.close()
-            if result:
-                return str(result[0])
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT NOW(6)")
+                now = cur.fetchone()[0]
+                cur.close()
+            return now
+        except (mariadb.Error, PoolError) as e:
+            logging.debug(f"Error reading the database time: {e}")
             return None
-        except mariadb.Error as e:
-            logging.debug(f"Error fetching device state: {e}")
+
+    def prune_device_tombstones(self, retention=TOMBSTONE_RETENTION):
+        """
+        Deletes tombstones older than `retention` seconds.
+        Returns the number of deleted tombstones, or None on error.
+        """
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM device_tombstones WHERE deleted_at < NOW(6) - INTERVAL ? SECOND",
+                            (int(retention),))
+                deleted = cur.rowcount
+                cur.close()
+                conn.commit()
+        except (mariadb.Error, PoolError) as e:
+            logging.debug(f"Error pruning device tombstones: {e}")
             return None
+        logging.debug(f"Pruned {deleted} device tombstones.")
+        return deleted
+
+    def pool_metrics(self):
+        """
+        Returns the connection pool metrics (wait times, in-use connections, reconnects).
+        """
+        return self.pool.metrics()
 
     def close_connection(self):
         """
-        Closes the database connection.
+        Closes the pooled database connections.
         """
-        if self.conn:
-            self.conn.close()
-            logging.debug("Database connection closed.")
\ No newline at end of file
+        with DeviceManagement._pool_lock:
+            if DeviceManagement._pool is self.pool:
+                DeviceManagement._pool = None
+        self.pool.close()
+        logging.debug("Database connections closed.")
+
+
+class DeviceSync:
+    """
+    Keeps a local map of device states in step with the database.
+
+    The first sync loads every device, unless seed() started tracking
+    without a load and the caller adds devices page by page with merge();
+    later syncs only fetch rows whose
+    updated_at moved past the last watermark, plus tombstones of deleted
+    devices, so a refresh costs as much as the number of changes. When the
+    change tracking migration cannot be applied, every sync falls back to a
+    full read diffed against the local map. Changed states are reconciled
+    with the DeviceStateStore, and the delta reports the store's verdict.
+    Tombstones older than `retention` seconds are pruned, so a sync that
+    comes later than that after the previous one reloads every device.
+    """
+
+    def __init__(self, device_manager, overlap=2.0, store=None, retention=TOMBSTONE_RETENTION,
+                 prune_interval=TOMBSTONE_PRUNE_INTERVAL):
+        self.device_manager = device_manager
+        self.overlap = overlap
+        self.store = store or DeviceStateStore.shared()
+        self.retention = retention
+        self.prune_interval = prune_interval
+        # Device id -> (state, updated_at)
+        self.devices = {}
+        self.watermark = None
+        # Monotonic times of the last successful sync and tombstone prune
+        self._synced_at = None
+        self._pruned_at = None
+        self._tracking = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        Brings the local map up to date.
+        Returns a delta dictionary with 'added' and 'changed' lists of
+        {'id', 'state'} dictionaries, a 'removed' list of ids and 'full'
+        (True when the map was rebuilt), or None if the database could not be read.
+        """
+        with self._lock:
+            if self._tracking is None:
+                self._tracking = self.device_manager.ensure_change_tracking()
+            delta = self._sync_changes() if self._tracking else self._full_diff()
+            if delta is None:
+                return None
+
+            # The state store decides between these rows and newer control results
+            updated = delta['added'] + delta['changed']
+            self.store.discard(delta['removed'])
+            effective = self.store.observe({device['id']: (device['state'], self.devices[device['id']][1])
+                                            for device in updated})
+            for device in updated:
+                device['state'] = effective.get(device['id'], device['state'])
+
+        # Keep the state cache as fresh as the local map
+        cache = self.device_manager.state_cache
+        cache.put_many({device['id']: device['state'] for device in updated})
+        cache.invalidate(delta['removed'])
+        return delta
+
+    def seed(self):
+        """
+        Starts tracking changes from the database's current time without
+        reading the devices table; pages read afterwards are added with
+        merge(). Without change tracking this is a sync().
+        Returns a delta like sync(), or None if the database could not be read.
+        """
+        with self._lock:
+            if self._tracking is None:
+                self._tracking = self.device_manager.ensure_change_tracking()
+            if self._tracking:
+                local_now = time.monotonic()
+                now = self.device_manager.get_database_time()
+                if now is None:
+                    return None
+                self.store.sync_clock(now, local_now)
+                self.watermark = now
+                self._synced_at = local_now
+                return {'added': [], 'changed': [], 'removed': [], 'full': False}
+        return self.sync()
+
+    def merge(self, devices):
+        """
+        Adds devices read page by page to the local map, so later syncs report
+        their changes and removals. Devices already in the map are kept.
+        """
+        with self._lock:
+            for device in devices:
+                self.devices.setdefault(device['id'], (device['state'], None))
+
+    def _sync_changes(self):
+        """
+        Applies the rows and tombstones changed since the watermark. Must hold the lock.
+        """
+        # Taken before the query, so rows map to no later than they really are
+        local_now = time.monotonic()
+        if self._synced_at is not None and local_now - self._synced_at > self.retention - self.overlap:
+            # Tombstones since the watermark may have been pruned
+            self.watermark = None
+        if self._pruned_at is None or local_now - self._pruned_at > self.prune_interval:
+            self.device_manager.prune_device_tombstones(self.retention)
+            self._pruned_at = local_now
+
+        changes = self.device_manager.get_device_changes(self.watermark, self.overlap)
+        if changes is None:
+            return None
+        now, rows, deleted = changes
+        self.store.sync_clock(now, local_now)
+        full = self.watermark is None
+        delta = {'added': [], 'changed': [], 'removed': [], 'full': full}
+
+        if full:
+            current = {row[0] for row in rows}
+            delta['removed'] = [device_id for device_id in self.devices if device_id not in current]
+            for device_id in delta['removed']:
+                del self.devices[device_id]
+
+        for device_id, deleted_at in deleted:
+            known = self.devices.get(device_id)
+            # A device deleted and then re-created keeps its newer row; merged
+            # devices have no updated_at, and a re-created one comes back below
+            if known is not None and (known[1] is None or deleted_at >= known[1]):
+                del self.devices[device_id]
+                delta['removed'].append(device_id)
+
+        for device_id, state, updated_at in rows:
+            known = self.devices.get(device_id)
+            if known is not None and known[1] is not None and known[1] >= updated_at:
+                # Already seen through the overlap window
+                continue
+            self.devices[device_id] = (state, updated_at)
+            if known is None:
+                delta['added'].append({'id': device_id, 'state': state})
+            elif known[0] != state:
+                delta['changed'].append({'id': device_id, 'state': state})
+
+        self.watermark = now
+        self._synced_at = local_now
+        return delta
+
+    def reset(self):
+        """
+        Forgets the local map so the next sync reloads every device.
+        """
+        with self._lock:
+            self.devices = {}
+            self.watermark = None
+
+    def _full_diff(self):
+        """
+        Reads every device and diffs it against the local map. Must hold the
+        lock. Returns None if the devices could not be read, so a failed read
+        does not look like every device was removed.
+        """
+        try:
+            current = {device['id']: device['state'] for device in self.device_manager.iter_devices()}
+        except (mariadb.Error, PoolError) as e:
+            logging.debug(f"Error fetching devices: {e}")
+            return None
+        delta = {'added': [], 'changed': [], 'removed': [], 'full': True}
+        for device_id, state in current.items():
+            known = self.devices.get(device_id)
+            if known is None:
+                delta['added'].append({'id': device_id, 'state': state})
+            elif known[0] != state:
+                delta['changed'].append({'id': device_id, 'state': state})
+        delta['removed'] = [device_id for device_id in self.devices if device_id not in current]
+        self.devices = {device_id: (state, None) for device_id, state in current.items()}
+        return delta
+
+
+# States written through by control results also refresh the state cache
+DeviceStateStore.shared().add_listener(DeviceManagement.state_cache.put_many)
@@ -0,0 +1,142 @@
+# device_state_store.py
+
+import os
+import time
+import threading
+import logging
+
+# Seconds a control server result takes precedence over database reads that
+# carry no timestamp of their own, giving the server time to commit the change
+CONTROL_GRACE_PERIOD = float(os.environ.get('DEVICE_CONTROL_GRACE', 10))
+
+
+class DeviceStateStore:
+    """
+    Authoritative in-process record of device states.
+
+    States come from two sources: control server responses, written through
+    with record_control_result() as soon as a toggle completes, and database
+    reads, passed to observe(). Every state carries the time it was true; an
+    observation only replaces the stored state if it is at least as recent, so
+    a refresh that raced a toggle cannot roll the device back. Database rows
+    without an updated_at column count as observed CONTROL_GRACE_PERIOD
+    seconds ago.
+
+    All times are on this process's monotonic clock. updated_at values are in
+    the database's clock and time zone, so they are placed on it through the
+    database's NOW(6) passed to sync_clock(), never compared to the host clock.
+
+    Listeners are called with a {device_id: state} dictionary of the states
+    that changed, on the thread that made the change.
+    """
+
+    _shared_instance = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, grace_period=CONTROL_GRACE_PERIOD):
+        self.grace_period = grace_period
+        self._lock = threading.Lock()
+        # Device id -> (state, timestamp, source)
+        self._states = {}
+        self._listeners = []
+        # (database NOW(6), monotonic time) of the last sync
+        self._db_clock = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the process-wide store.
+        """
+        with cls._shared_lock:
+            if cls._shared_instance is None:
+                cls._shared_instance = cls()
+            return cls._shared_instance
+
+    def get(self, device_id, default=None):
+        """
+        Returns the current state of a device.
+        """
+        entry = self._states.get(device_id)
+        return entry[0] if entry is not None else default
+
+    def sync_clock(self, db_now, local_now):
+        """
+        Records the database time `db_now` (a NOW(6) datetime) read at the
+        monotonic time `local_now`.
+        """
+        with self._lock:
+            self._db_clock = (db_now, local_now)
+
+    def record_control_result(self, device_id, state, timestamp=None):
+        """
+        Records the state reported by the control server after a command.
+        """
+        self.record_control_results({device_id: state}, timestamp)
+
+    def record_control_results(self, states, timestamp=None):
+        """
+        Records the states reported for several devices at once, notifying
+        listeners a single time.
+        """
+        timestamp = timestamp if timestamp is not None else time.monotonic()
+        self._apply({device_id: (state, timestamp, 'control') for device_id, state in states.items()})
+
+    def observe(self, states):
+        """
+        Reconciles states read from the database. `states` maps device ids to
+        (state, updated_at) tuples; updated_at is a database datetime or None.
+        Returns a dictionary of the effective state of every given device.
+        """
+        untimed = time.monotonic() - self.grace_period
+        with self._lock:
+            db_clock = self._db_clock
+        observed = {}
+        for device_id, (state, updated_at) in states.items():
+            if updated_at is not None and db_clock is not None:
+                timestamp = db_clock[1] + (updated_at - db_clock[0]).total_seconds()
+            else:
+                timestamp = untimed
+            observed[device_id] = (state, timestamp, 'db')
+        self._apply(observed)
+        with self._lock:
+            return {device_id: self._states[device_id][0] for device_id in states if device_id in self._states}
+
+    def discard(self, device_ids):
+        """
+        Forgets devices that were removed.
+        """
+        with self._lock:
+            for device_id in device_ids:
+                self._states.pop(device_id, None)
+
+    def add_listener(self, callback):
+        with self._lock:
+            if callback not in self._listeners:
+                self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def _apply(self, updates):
+        changed = {}
+        with self._lock:
+            for device_id, (state, timestamp, source) in updates.items():
+                current = self._states.get(device_id)
+                if current is not None and current[1] > timestamp:
+                    if current[0] != state:
+                        logging.debug(f"Ignoring stale {source} state {state} for device {device_id}; "
+                                      f"keeping {current[2]} state {current[0]}.")
+                    continue
+                self._states[device_id] = (state, timestamp, source)
+                if current is None or current[0] != state:
+                    changed[device_id] = state
+            listeners = list(self._listeners)
+
+        if changed:
+            for callback in listeners:
+                try:
+                    callback(changed)
+                except Exception:
+                    logging.exception("Device state listener failed.")
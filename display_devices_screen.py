@@ -4,14 +4,19 @@ from kivy.uix.label import Label
 from kivy.uix.button import Button
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.gridlayout import GridLayout
+from kivy.uix.popup import Popup
 from kivy.clock import Clock
 import os
 import threading
 import logging
-import requests  # Ensure requests is imported
 
 # Import the backend module
-from device_management import DeviceManagement
+from device_management import DeviceManagement, DeviceSync, DEVICE_PAGE_SIZE
+from device_state_store import DeviceStateStore
+from device_control import DeviceCommandQueue, summarize_results
+
+# Device rows loaded per page as the list is scrolled
+UI_PAGE_SIZE = 50
 
 class DisplayDevicesScreen(Screen):
     """
@@ -25,6 +30,23 @@ class DisplayDevicesScreen(Screen):
 
         # Initialize the device management backend
         self.device_manager = DeviceManagement()
+        # Local copy of the devices table, refreshed incrementally
+        self.device_sync = DeviceSync(self.device_manager)
+        # Rows show the states held by the shared store, whichever source set them
+        self.state_store = DeviceStateStore.shared()
+        self.state_store.add_listener(self.on_device_states_changed)
+        # Toggles are queued per device; intended states show taps still in progress
+        self.command_queue = DeviceCommandQueue.shared()
+        self.intended_states = {}
+        self.pending_toggles = {}
+        # Device id -> (row layout, state label, toggle button)
+        self.device_rows = {}
+        self.no_device_label = None
+        # Keyset cursor of the next page to load; None once every page is shown
+        self.page_cursor = None
+        self.all_pages_loaded = False
+        self.page_loading = False
+        self.synced = False
 
         # Path to the custom font
         current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -44,6 +66,7 @@ class DisplayDevicesScreen(Screen):
 
         # Scrollable area for the device list
         self.scroll_view = ScrollView(size_hint=(1, 0.8))
+        self.scroll_view.bind(scroll_y=self.on_scroll)
 
         # Grid layout inside the scroll view
         self.devices_layout = GridLayout(cols=1, spacing=10, size_hint_y=None)
@@ -60,20 +83,37 @@ class DisplayDevicesScreen(Screen):
 
         back_button = Button(
             text='Back',
-            size_hint=(0.5, 1),
+            size_hint=(0.25, 1),
             font_name=font_path
         )
         back_button.bind(on_press=self.go_back)
 
         refresh_button = Button(
             text='Refresh',
-            size_hint=(0.5, 1),
+            size_hint=(0.25, 1),
             font_name=font_path
         )
         refresh_button.bind(on_press=self.load_devices)
 
+        # Bulk actions over every known device
+        self.all_on_button = Button(
+            text='All On',
+            size_hint=(0.25, 1),
+            font_name=font_path
+        )
+        self.all_on_button.bind(on_press=lambda instance: self.set_all_devices('activate'))
+
+        self.all_off_button = Button(
+            text='All Off',
+            size_hint=(0.25, 1),
+            font_name=font_path
+        )
+        self.all_off_button.bind(on_press=lambda instance: self.set_all_devices('deactivate'))
+
         button_layout.add_widget(back_button)
         button_layout.add_widget(refresh_button)
+        button_layout.add_widget(self.all_on_button)
+        button_layout.add_widget(self.all_off_button)
         self.main_layout.add_widget(button_layout)
 
         # Add the main layout to the screen
@@ -91,168 +131,284 @@ class DisplayDevicesScreen(Screen):
 
     def fetch_devices(self):
         """
-        Fetches devices from the backend and schedules the UI update.
+        Syncs the devices with the backend and schedules the UI update with the changes.
+        The first call only starts change tracking and loads the first page of
+        rows; later pages fill the local map as they are scrolled to.
         """
-        devices = self.device_manager.get_devices()
-        logging.debug(f"Fetched devices: {devices}")
-        Clock.schedule_once(lambda dt: self.update_devices_ui(devices))
+        page = None
+        if not self.synced:
+            # Seed before reading the page, so changes made meanwhile are synced
+            delta = self.device_sync.seed()
+            page = self.reconcile_page(self.device_manager.get_device_page(page_size=UI_PAGE_SIZE))
+        else:
+            delta = self.device_sync.sync()
+        if delta is not None:
+            logging.debug(f"Device changes: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+                          f"{len(delta['removed'])} removed.")
+        Clock.schedule_once(lambda dt: self.update_devices_ui(delta, page))
+
+    def on_scroll(self, scroll_view, scroll_y):
+        """
+        Loads the next page of devices when the list is scrolled to the bottom.
+        """
+        if scroll_y <= 0.05 and self.page_cursor is not None and not self.page_loading:
+            self.page_loading = True
+            threading.Thread(target=self.fetch_next_page, args=(self.page_cursor,), daemon=True).start()
 
-    def update_devices_ui(self, devices):
+    def fetch_next_page(self, cursor):
         """
-        Updates the UI with the list of devices.
+        Fetches the page of devices after `cursor` and schedules adding its rows.
         """
-        # Clear any existing widgets
-        logging.debug("Clearing existing widgets.")
-        self.devices_layout.clear_widgets()
+        page = self.reconcile_page(self.device_manager.get_device_page(cursor, UI_PAGE_SIZE))
+        Clock.schedule_once(lambda dt: self.update_devices_ui(None, page))
 
-        if devices:
-            logging.debug(f"Updating UI with devices: {devices}")
+    def reconcile_page(self, page):
+        """
+        Passes a page of devices read from the database through the state
+        store and returns it with the store's states.
+        """
+        devices, cursor = page
+        self.device_sync.merge(devices)
+        effective = self.state_store.observe({device['id']: (device['state'], None) for device in devices})
+        for device in devices:
+            device['state'] = effective.get(device['id'], device['state'])
+        return devices, cursor
+
+    def on_device_states_changed(self, changes):
+        """
+        State store listener; updates the rows of devices whose state changed.
+        """
+        Clock.schedule_once(lambda dt: [self.set_device_state(device_id, state)
+                                        for device_id, state in changes.items()])
+
+    def update_devices_ui(self, delta, page=None):
+        """
+        Adds a page of device rows and applies a device delta from DeviceSync
+        to the rows on screen.
+        """
+        if page is not None:
+            devices, self.page_cursor = page
+            self.all_pages_loaded = self.page_cursor is None
+            self.page_loading = False
             for device in devices:
-                # Horizontal layout for each device entry
-                device_layout = BoxLayout(orientation='horizontal', size_hint_y=None, height=50, spacing=10)
-
-                # Device id label
-                device_label = Label(
-                    text=str(device['id']),
-                    font_size='18sp',
-                    font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf'),
-                    size_hint=(0.3, 1),
-                    halign='left',
-                    valign='middle'
-                )
-                device_label.bind(size=device_label.setter('text_size'))
-
-                # Device state label
-                state_label = Label(
-                    text=str(device['state']),
-                    font_size='18sp',
-                    font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf'),
-                    size_hint=(0.2, 1),
-                    halign='center',
-                    valign='middle',
-                    color=(0, 1, 0, 1) if str(device['state']).lower() == 'on' else (1, 0, 0, 1)
-                )
-                state_label.bind(size=state_label.setter('text_size'))
-
-                # On/Off button
-                toggle_button = Button(
-                    text='Turn Off' if str(device['state']).lower() == 'on' else 'Turn On',
-                    size_hint=(0.3, 1),
-                    font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf')
-                )
-                toggle_button.device_id = device['id']  # Attach device ID to the button
-                toggle_button.bind(on_press=self.toggle_device_state)
-
-                # Add widgets to the device layout
-                device_layout.add_widget(device_label)
-                device_layout.add_widget(state_label)
-                device_layout.add_widget(toggle_button)
-
-                # Add device layout to the devices layout
-                self.devices_layout.add_widget(device_layout)
-        else:
+                if device['id'] not in self.device_rows:
+                    self.add_device_row(device)
+
+        if delta is not None:
+            for device_id in delta['removed']:
+                row = self.device_rows.pop(device_id, None)
+                if row is not None:
+                    self.devices_layout.remove_widget(row[0])
+            # The first sync reports every device as added; pages show those as they are scrolled to
+            if self.synced:
+                for device in delta['added']:
+                    if device['id'] in self.device_rows:
+                        self.set_device_state(device['id'], device['state'])
+                    elif self.is_paged_in(device['id']):
+                        # New within the loaded pages; devices beyond them come with their page
+                        self.add_device_row(device)
+            for device in delta['changed']:
+                self.set_device_state(device['id'], device['state'])
+            self.synced = True
+        elif page is None:
+            logging.debug("Devices could not be loaded; keeping the current list.")
+
+        if self.device_rows and self.no_device_label is not None:
+            self.devices_layout.remove_widget(self.no_device_label)
+            self.no_device_label = None
+        elif not self.device_rows and self.no_device_label is None:
             logging.debug("No devices found. Showing placeholder.")
             # If no devices are found or an error occurred
-            no_device_label = Label(
+            self.no_device_label = Label(
                 text='No active devices found.',
                 font_size='18sp',
                 font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf'),
                 size_hint=(1, None),
                 height=50
             )
-            self.devices_layout.add_widget(no_device_label)
+            self.devices_layout.add_widget(self.no_device_label)
+
+    def is_paged_in(self, device_id):
+        """
+        Returns True if `device_id` sorts within the pages loaded so far.
+        """
+        if self.all_pages_loaded:
+            return True
+        cursor = self.page_cursor
+        if cursor is None:
+            return False
+        # The cursor is the raw id of the last loaded row, ordered as the database orders it
+        if isinstance(cursor, int):
+            try:
+                return int(device_id) <= cursor
+            except ValueError:
+                return False
+        return str(device_id) <= str(cursor)
+
+    def add_device_row(self, device):
+        """
+        Adds a row with the device id, its state and an On/Off button.
+        """
+        # Horizontal layout for each device entry
+        device_layout = BoxLayout(orientation='horizontal', size_hint_y=None, height=50, spacing=10)
+
+        # Device id label
+        device_label = Label(
+            text=str(device['id']),
+            font_size='18sp',
+            font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf'),
+            size_hint=(0.3, 1),
+            halign='left',
+            valign='middle'
+        )
+        device_label.bind(size=device_label.setter('text_size'))
+
+        # Device state label
+        state_label = Label(
+            font_size='18sp',
+            font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf'),
+            size_hint=(0.2, 1),
+            halign='center',
+            valign='middle'
+        )
+        state_label.bind(size=state_label.setter('text_size'))
+
+        # On/Off button
+        toggle_button = Button(
+            size_hint=(0.3, 1),
+            font_name=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'SixtyFourConvergence.ttf')
+        )
+        toggle_button.device_id = device['id']  # Attach device ID to the button
+        toggle_button.bind(on_press=self.toggle_device_state)
+
+        # Add widgets to the device layout
+        device_layout.add_widget(device_label)
+        device_layout.add_widget(state_label)
+        device_layout.add_widget(toggle_button)
+
+        # Add device layout to the devices layout
+        self.devices_layout.add_widget(device_layout)
+        self.device_rows[device['id']] = (device_layout, state_label, toggle_button)
+        self.set_device_state(device['id'], self.state_store.get(device['id'], device['state']))
+
+    def set_device_state(self, device_id, state):
+        """
+        Shows a device's state in its row.
+        """
+        row = self.device_rows.get(device_id)
+        if row is None:
+            return
+        _, state_label, toggle_button = row
+        state_label.text = str(state)
+        state_label.color = (0, 1, 0, 1) if str(state).lower() == 'on' else (1, 0, 0, 1)
+        # A toggle in progress keeps its 'Turning On/Off...' label
+        if device_id not in self.intended_states:
+            toggle_button.text = 'Turn Off' if str(state).lower() == 'on' else 'Turn On'
 
     def toggle_device_state(self, instance):
         """
-        Toggles the state of the device and sends a POST request to update the backend.
+        Toggles the state of the device through the shared command queue.
+        Taps made before the previous toggle finished flip the intended state
+        again; the queue only sends the latest one.
         """
         device_id = instance.device_id
-        current_state = None
-
-        # Find the current state of the device
-        for child in self.devices_layout.children:
-            # child.children list is in reverse order in Kivy, so adjust accordingly
-            device_label = child.children[2]  # device_label is the third child added
-            if isinstance(device_label, Label) and device_label.text == device_id:
-                state_label = child.children[1]  # state_label is the second child
-                current_state = state_label.text.lower()
-                break
+        current_state = self.intended_states.get(device_id) or self.state_store.get(device_id)
 
         if current_state is None:
             logging.error(f"Could not find current state for device {device_id}")
             return
 
         # Determine the new action based on current state
-        if current_state == 'on':
+        if current_state.lower() == 'on':
             action = 'deactivate'
         else:
             action = 'activate'
+        self.intended_states[device_id] = 'ON' if action == 'activate' else 'OFF'
+        self.pending_toggles[device_id] = self.pending_toggles.get(device_id, 0) + 1
 
         # Update button text optimistically
         instance.text = 'Turning On...' if action == 'activate' else 'Turning Off...'
-        instance.disabled = True
 
-        # Start a new thread to send the POST request
-        threading.Thread(target=self.send_toggle_request, args=(device_id, action, instance), daemon=True).start()
+        self.command_queue.submit(device_id, action, self.on_toggle_result)
 
-    def send_toggle_request(self, device_id, action, button_instance):
+    def on_toggle_result(self, device_id, result):
         """
-        Sends a POST request to toggle the device state.
+        Command queue callback, called once per toggle on a worker thread.
         """
-        # Updated to match the working curl URL
-        url = 'https://198.82.190.97:5000/control-method'
-        data = {
-            'action': action,
-            'device_id': device_id
-        }
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
+        if result['success']:
+            # Write through to the state store; its listeners update every screen
+            self.state_store.record_control_result(device_id, result['state'])
+        else:
+            logging.error(f"Toggle failed for device {device_id}: {result['message']}")
+        Clock.schedule_once(lambda dt: self.finish_toggle(device_id))
 
-        try:
-            logging.debug(f"Sending POST request to {url} with data: {data}")
-            response = requests.post(url, data=data, headers=headers, verify=False)
-            logging.debug(f"Response Status: {response.status_code}, Body: {response.text}")
+    def finish_toggle(self, device_id):
+        """
+        Shows the device's final state once its last queued toggle completed.
+        """
+        remaining = self.pending_toggles.get(device_id, 1) - 1
+        if remaining > 0:
+            self.pending_toggles[device_id] = remaining
+            return
+        self.pending_toggles.pop(device_id, None)
+        self.intended_states.pop(device_id, None)
+        self.set_device_state(device_id, self.state_store.get(device_id))
 
-            # Check if the response is valid JSON
-            try:
-                response_data = response.json()
-                new_state = response_data.get('state', 'OFF').upper()
-            except ValueError as e:
-                logging.error(f"Error parsing response as JSON: {e}")
-                logging.error(f"Response body: {response.text}")
-                # Fallback based on action
-                new_state = 'ON' if action == 'activate' else 'OFF'
-
-            # Schedule UI update on the main thread
-            Clock.schedule_once(lambda dt: self.update_device_ui_after_toggle(device_id, new_state, button_instance))
-        except requests.RequestException as e:
-            logging.error(f"Error sending toggle request for device {device_id}: {e}")
-            Clock.schedule_once(lambda dt: self.reset_button_state(button_instance, action))
-
-    def update_device_ui_after_toggle(self, device_id, new_state, button_instance):
-        """
-        Updates the UI after successfully toggling the device state.
-        """
-        for child in self.devices_layout.children:
-            # child.children list is in reverse order in Kivy, so adjust accordingly
-            device_label = child.children[2]  # device_label is the third child added
-            if isinstance(device_label, Label) and device_label.text == device_id:
-                state_label = child.children[1]  # state_label is the second child
-                state_label.text = new_state
-                state_label.color = (0, 1, 0, 1) if new_state.lower() == 'on' else (1, 0, 0, 1)
-
-                # Update the button text
-                button_instance.text = 'Turn Off' if new_state.lower() == 'on' else 'Turn On'
-                button_instance.disabled = False
+    def set_all_devices(self, action):
+        """
+        Sends the same action to every device in the background.
+        """
+        self.all_on_button.disabled = True
+        self.all_off_button.disabled = True
+        threading.Thread(target=self.send_bulk_request, args=(action,), daemon=True).start()
+
+    def send_bulk_request(self, action):
+        """
+        Dispatches a bulk action through the command queue, so it supersedes
+        toggles still waiting. Device ids are read one keyset page at a time
+        (the local map only holds the pages shown so far), and each page's
+        results are applied in one update.
+        """
+        results = {}
+        cursor = None
+        while True:
+            devices, cursor = self.device_manager.get_device_page(cursor, DEVICE_PAGE_SIZE)
+            if devices:
+                self.send_bulk_page([device['id'] for device in devices], action, results)
+            if cursor is None:
                 break
+        if not results and self.device_rows:
+            # The database could not be read; act on the devices on screen
+            self.send_bulk_page(list(self.device_rows), action, results)
 
-    def reset_button_state(self, button_instance, action):
+        logging.debug(f"Sent '{action}' to {len(results)} devices")
+        result = summarize_results(list(results), results)
+        Clock.schedule_once(lambda dt: self.show_bulk_result(result))
+
+    def send_bulk_page(self, device_ids, action, results):
+        """
+        Sends a bulk action to one page of devices and records its results.
+        """
+        page_result = self.command_queue.submit_many(device_ids, action)
+        results.update(page_result['results'])
+        states = {device_id: device_result['state']
+                  for device_id, device_result in page_result['results'].items() if device_result['success']}
+        # One write to the store per page, so its listeners schedule a single UI update
+        self.state_store.record_control_results(states)
+
+    def show_bulk_result(self, result):
         """
-        Resets the button state if the POST request failed.
+        Re-enables the bulk buttons and shows the outcome of a bulk action.
         """
-        button_instance.text = 'Turn On' if action == 'activate' else 'Turn Off'
-        button_instance.disabled = False
+        self.all_on_button.disabled = False
+        self.all_off_button.disabled = False
+        message_label = Label(text=result['message'], halign='center', valign='middle')
+        message_label.bind(size=message_label.setter('text_size'))
+        Popup(
+            title='Success' if result['success'] else 'Error',
+            content=message_label,
+            size_hint=(0.6, 0.4)
+        ).open()
 
     def go_back(self, instance):
         """
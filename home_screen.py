@@ -6,9 +6,11 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.button import Button, ButtonBehavior
 from kivy.uix.popup import Popup
+from kivy.uix.progressbar import ProgressBar
 from kivy.graphics import Color, Rectangle
 from kivy.uix.image import Image
 import logging
+import threading
 import os
 
 from kivy.clock import Clock
@@ -16,6 +18,7 @@ from datetime import datetime
 
 # Import the backend classes
 from user_management import UserManager  # User management backend
+from qr_code_generator import QRCodeGenerator
 
 class SettingsButton(ButtonBehavior, Image):
     """
@@ -32,6 +35,7 @@ class HomeScreen(Screen):
 
         # Initialize the backend
         self.backend = UserManager()
+        self.qr_generator = QRCodeGenerator()
 
         # Path to the custom font and images
         current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -67,6 +71,7 @@ class HomeScreen(Screen):
             {'text': 'Display Devices', 'on_press': self.navigate_to_display_devices},
             {'text': 'Add a User', 'on_press': self.navigate_to_add_user},
             {'text': 'Remove All Users', 'on_press': self.confirm_remove_all},
+            {'text': 'Export VPN Profiles', 'on_press': self.export_profiles},
             {'text': 'Show Active VPN Connections', 'on_press': self.navigate_to_active_vpn}
         ]
 
@@ -192,24 +197,103 @@ class HomeScreen(Screen):
     def remove_all_users(self, instance):
         """
         Removes all users using the backend.
+        Runs in a background thread and shows the progress in a popup.
         """
         logging.debug("Removing all users")
-        success = self.backend.remove_all_users()
-        if success:
-            logging.info("All users have been removed successfully.")
+        self.show_progress_popup('Removing Users', 'Looking up VPN users...')
+        threading.Thread(target=self.process_remove_all_users, daemon=True).start()
+
+    def process_remove_all_users(self):
+        """
+        Removes all users in the backend and reports progress to the UI thread.
+        """
+        def progress(done, total):
+            Clock.schedule_once(lambda dt: self.update_progress(f"Removed {done} of {total} users...", done, total), 0)
+
+        result = self.backend.remove_all_users(progress)
+        Clock.schedule_once(lambda dt: self.show_result(result), 0)
+
+    def export_profiles(self, instance):
+        """
+        Exports every user's config and QR code to a ZIP file.
+        Runs in a background thread and shows the progress in a popup.
+        """
+        logging.debug("Exporting VPN profiles")
+        self.show_progress_popup('Exporting Profiles', 'Looking up VPN users...')
+        threading.Thread(target=self.process_export_profiles, daemon=True).start()
+
+    def process_export_profiles(self):
+        """
+        Runs the export and reports progress to the UI thread. The progress
+        popup is always replaced by a result, even if the export crashed.
+        """
+        def progress(done, total):
+            Clock.schedule_once(lambda dt: self.update_progress(f"Exported {done} of {total} profiles...", done, total), 0)
+
+        try:
+            result = self.qr_generator.export_profiles(self.backend.config_dir, progress_callback=progress)
+        except Exception as e:
+            logging.exception("Exporting VPN profiles failed.")
+            result = {
+                'success': False,
+                'message': f"Failed to export profiles: {e}"
+            }
+        Clock.schedule_once(lambda dt: self.show_result(result), 0)
+
+    def show_progress_popup(self, title, text):
+        """
+        Opens a popup with a label and a progress bar for a long-running job.
+        """
+        popup_content = BoxLayout(orientation='vertical', padding=20, spacing=20)
+        self.progress_label = Label(
+            text=text,
+            font_size='18sp',
+            halign='center',
+            valign='middle'
+        )
+        self.progress_label.bind(size=self.progress_label.setter('text_size'))
+        popup_content.add_widget(self.progress_label)
+        self.progress_bar = ProgressBar(max=1, value=0, size_hint=(1, 0.3))
+        popup_content.add_widget(self.progress_bar)
+
+        self.progress_popup = Popup(
+            title=title,
+            content=popup_content,
+            size_hint=(0.6, 0.4),
+            auto_dismiss=False
+        )
+        self.progress_popup.open()
+
+    def update_progress(self, text, done, total):
+        """
+        Updates the progress popup.
+        """
+        self.progress_label.text = text
+        self.progress_bar.max = total
+        self.progress_bar.value = done
+
+    def show_result(self, result):
+        """
+        Replaces the progress popup with the outcome of the removal or export.
+        """
+        self.progress_popup.dismiss()
+        if result['success']:
+            logging.info(result['message'])
             # Optionally, show a success popup
             popup = Popup(
                 title='Success',
-                content=Label(text='All VPN users have been removed.'),
+                content=Label(text=result['message']),
                 size_hint=(0.6, 0.4)
             )
             popup.open()
         else:
-            logging.error("Failed to remove all users.")
+            logging.error(f"Operation failed: {result['message']}")
             # Optionally, show an error popup
+            message_label = Label(text=result['message'], halign='center', valign='middle')
+            message_label.bind(size=message_label.setter('text_size'))
             popup = Popup(
                 title='Error',
-                content=Label(text='Failed to remove all VPN users.'),
+                content=message_label,
                 size_hint=(0.6, 0.4)
             )
             popup.open()
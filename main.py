@@ -3,6 +3,7 @@ from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, SlideTransition
 from kivy.core.window import Window
 import logging
+import threading
 
 # Import the screens
 from home_screen import HomeScreen
@@ -11,6 +12,11 @@ from active_vpn_screen import ActiveVPNScreen
 from display_devices_screen import DisplayDevicesScreen
 from settings_screen import SettingsScreen
 
+# Import the background services
+from vpn_status import VPNSnapshotService
+from vpn_history import VPNHistoryStore, VPN_HISTORY_INTERVAL
+import privileged_helper
+
 # Ensure compatibility with the latest Kivy version
 kivy.require('2.0.0')
 
@@ -48,8 +54,28 @@ class SmartHubApp(App):
 
         logging.debug("SmartHubApp built successfully with Home, AddUser, and ActiveVPN screens.")
 
+        # Start the privileged helper once so sudo is not forked for every command
+        threading.Thread(target=privileged_helper.start_helper, daemon=True).start()
+
+        # Record VPN peer activity in the background, even when no screen is polling
+        self.vpn_history = None
+        try:
+            self.vpn_history = VPNHistoryStore()
+            VPNSnapshotService.shared().add_listener(self.vpn_history.record, keep_alive=True,
+                                                     interval=VPN_HISTORY_INTERVAL)
+        except Exception:
+            logging.exception("VPN history is disabled; the history database could not be opened.")
+
         return sm
 
+    def on_stop(self):
+        """
+        Flushes the VPN history when the app closes.
+        """
+        if self.vpn_history:
+            VPNSnapshotService.shared().remove_listener(self.vpn_history.record)
+            self.vpn_history.close()
+
 if __name__ == '__main__':
     SmartHubApp().run()
 
@@ -0,0 +1,497 @@
+# privileged_helper.py
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import ipaddress
+import threading
+import itertools
+import subprocess
+import logging
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# Unix socket the helper listens on
+SOCKET_PATH = os.environ.get('SMARTHUB_HELPER_SOCKET', '/run/smarthub-helper.sock')
+
+# Root-owned install of this module that sudo is allowed to run; see the readme.
+# The helper never runs from the app's checkout, which the app's user can write.
+HELPER_PATH = os.environ.get('SMARTHUB_HELPER_PATH', '/usr/local/lib/smarthub/privileged_helper.py')
+HELPER_PYTHON = '/usr/bin/python3'
+
+# Where the helper copies client configs for the app, owned by the app's user
+CLIENT_CONFIG_DIR = '/home/SMART/configs'
+
+# PiVPN client names: alphanumeric, as enforced by UserManager.validate_username
+CLIENT_NAME = re.compile(r'^[A-Za-z0-9]{1,32}$')
+WIREGUARD_KEY = re.compile(r'^[A-Za-z0-9+/]{43}=$')
+
+# WireGuardProvisioner methods the app may call through the helper
+PROVISIONER_CALLS = ('provision', 'allocate_address', 'reserve_address', 'release_address')
+
+
+class HelperRefusedError(Exception):
+    """
+    Raised when the helper rejects a request, e.g. a command that is not whitelisted.
+    """
+
+
+def is_allowed(argv):
+    """
+    Returns True if argv is one of the whitelisted privileged commands.
+    """
+    if not argv or not all(isinstance(arg, str) for arg in argv):
+        return False
+    command, args = argv[0], argv[1:]
+
+    if command == 'wg':
+        if args[:1] == ['show']:
+            return all(re.match(r'^[A-Za-z0-9_.-]+$', arg) for arg in args)
+        # Live peer added by WireGuardProvisioner:
+        # wg set <iface> peer <key> preshared-key /etc/wireguard/keys/<name>_psk allowed-ips <ips>
+        return (len(args) == 8 and args[0] == 'set' and re.match(r'^[A-Za-z0-9_.-]+$', args[1])
+                and args[2] == 'peer' and WIREGUARD_KEY.match(args[3])
+                and args[4] == 'preshared-key' and re.match(r'^/etc/wireguard/keys/[A-Za-z0-9]+_psk$', args[5])
+                and args[6] == 'allowed-ips' and re.match(r'^[0-9a-fA-F:.,/]+$', args[7]) is not None)
+    if command == 'pivpn':
+        if args == ['list']:
+            return True
+        if len(args) == 3 and args[:2] == ['add', '-n']:
+            return bool(CLIENT_NAME.match(args[2]))
+        if len(args) >= 3 and args[:2] == ['remove', '-y']:
+            return all(CLIENT_NAME.match(name) for name in args[2:])
+        return False
+    if command == 'rfkill':
+        return len(args) == 2 and args[0] in ('block', 'unblock') and args[1] == 'bluetooth'
+    return False
+
+
+class PrivilegedHelperServer:
+    """
+    Runs whitelisted commands as root on behalf of the app.
+
+    Clients send one JSON request per line: {"id", "argv", "timeout"} to run a
+    command, or {"id", "call", "args", "timeout"} to call one of the
+    PROVISIONER_CALLS on the helper's WireGuardProvisioner, which owns the
+    files under /etc/wireguard. Every request runs as its own task, so a
+    client can pipeline several requests on one connection; responses carry
+    the request id and may arrive out of order.
+    """
+
+    def __init__(self, socket_path, group_id=None, parent_pid=None, owner_uid=None,
+                 client_config_dir=CLIENT_CONFIG_DIR):
+        self.socket_path = socket_path
+        self.group_id = group_id
+        self.parent_pid = parent_pid
+        self.owner_uid = owner_uid
+        self.client_config_dir = client_config_dir
+        self._provisioner = None
+        self._provisioner_lock = threading.Lock()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        # Only root and the app's group may talk to the helper
+        if self.group_id is not None:
+            os.chown(self.socket_path, 0, self.group_id)
+        os.chmod(self.socket_path, 0o660)
+        logging.info(f"Privileged helper listening on {self.socket_path}")
+
+        async with server:
+            await self.watch_parent()
+        os.unlink(self.socket_path)
+
+    async def watch_parent(self):
+        """
+        Returns once the app that started the helper has exited.
+        """
+        while True:
+            await asyncio.sleep(2)
+            if self.parent_pid and not os.path.exists(f'/proc/{self.parent_pid}'):
+                logging.info("Parent process exited; stopping privileged helper.")
+                return
+
+    async def handle_client(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self.handle_request(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def handle_request(self, line, writer, write_lock):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            argv = request.get('argv')
+            timeout = float(request.get('timeout', 30))
+            if 'call' in request:
+                response = await self.run_call(request_id, request['call'], request.get('args', []), timeout)
+            elif not is_allowed(argv):
+                logging.warning(f"Rejected privileged command: {argv}")
+                response = {'id': request_id, 'error': 'command not allowed'}
+            else:
+                response = await self.run_command(request_id, argv, timeout)
+        except (ValueError, AttributeError, TypeError) as e:
+            response = {'id': request_id, 'error': f'malformed request: {e}'}
+        except OSError as e:
+            # e.g. the command is not installed
+            logging.error(f"Could not run privileged command: {e}")
+            response = {'id': request_id, 'error': f'could not run command: {e}'}
+        except Exception as e:
+            logging.exception("Privileged helper request failed.")
+            response = {'id': request_id, 'error': f'internal error: {e}'}
+
+        async with write_lock:
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+
+    async def run_command(self, request_id, argv, timeout):
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return {'id': request_id, 'error': 'timeout'}
+        return {
+            'id': request_id,
+            'returncode': process.returncode,
+            'stdout': stdout.decode(errors='replace'),
+            'stderr': stderr.decode(errors='replace')
+        }
+
+
+    async def run_call(self, request_id, call, args, timeout):
+        if call not in PROVISIONER_CALLS or not isinstance(args, list):
+            logging.warning(f"Rejected privileged call: {call}")
+            return {'id': request_id, 'error': 'call not allowed'}
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wait_for(loop.run_in_executor(None, self.call_provisioner, call, args), timeout)
+        except asyncio.TimeoutError:
+            return {'id': request_id, 'error': 'timeout'}
+        return {'id': request_id, 'result': result}
+
+    def call_provisioner(self, call, args):
+        """
+        Runs a provisioner call with arguments decoded from JSON and returns a
+        JSON-serializable result. Runs in a worker thread.
+        """
+        from wireguard_provisioner import WireGuardProvisioner
+
+        with self._provisioner_lock:
+            if self._provisioner is None:
+                owner = (self.owner_uid, self.group_id) if self.owner_uid is not None else None
+                self._provisioner = WireGuardProvisioner(client_config_dir=self.client_config_dir,
+                                                         client_owner=owner, runner=run_direct)
+        provisioner = self._provisioner
+
+        if call == 'provision':
+            name, keys, address = args
+            if not CLIENT_NAME.match(name):
+                raise ValueError(f"invalid client name {name!r}")
+            if keys is not None:
+                if len(keys) != 3 or not all(isinstance(key, str) and WIREGUARD_KEY.match(key) for key in keys):
+                    raise ValueError("invalid keys")
+                keys = tuple(keys)
+            return provisioner.provision(name, keys, ipaddress.ip_address(address) if address else None)
+        if call == 'allocate_address':
+            return str(provisioner.allocate_address())
+        if call == 'reserve_address':
+            return provisioner.reserve_address(ipaddress.ip_address(args[0]))
+        provisioner.release_address(ipaddress.ip_address(args[0]))
+        return None
+
+
+class PrivilegedHelperClient:
+    """
+    Client side of the privileged helper. A single connection is shared by all
+    threads; requests are pipelined and matched to responses by id.
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.socket_path = socket_path
+        self._sock = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ids = itertools.count(1)
+
+    def connect(self):
+        """
+        Connects to the helper. Raises OSError if it is not running.
+        """
+        with self._lock:
+            if self._sock is not None:
+                return
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._sock = sock
+            threading.Thread(target=self._read_loop, args=(sock,), name='PrivilegedHelperReader', daemon=True).start()
+
+    def submit(self, argv, timeout=30):
+        """
+        Sends a request without waiting for it. Returns a Future resolving to a
+        subprocess.CompletedProcess.
+        """
+        return self._send({'argv': list(argv), 'timeout': timeout}, argv, timeout)
+
+    def submit_call(self, call, args, timeout=30):
+        """
+        Sends a provisioner call without waiting for it. Returns a Future
+        resolving to the call's result.
+        """
+        return self._send({'call': call, 'args': list(args), 'timeout': timeout}, ['call', call], timeout)
+
+    def _send(self, request, argv, timeout):
+        self.connect()
+        request_id = next(self._ids)
+        future = Future()
+        future.request_id = request_id
+        payload = (json.dumps(dict(request, id=request_id)) + '\n').encode()
+        with self._lock:
+            if self._sock is None:
+                raise OSError("Privileged helper connection lost.")
+            self._pending[request_id] = (future, list(argv), timeout)
+            try:
+                self._sock.sendall(payload)
+            except OSError as e:
+                del self._pending[request_id]
+                self._disconnect_locked(e)
+                raise
+        return future
+
+    def run(self, argv, timeout=30):
+        """
+        Runs a command through the helper and waits for its result.
+        """
+        return self._wait(self.submit(argv, timeout), argv, timeout)
+
+    def call(self, call, args, timeout=30):
+        """
+        Calls a provisioner method through the helper and waits for its result.
+        """
+        return self._wait(self.submit_call(call, args, timeout), ['call', call], timeout)
+
+    def _wait(self, future, argv, timeout):
+        try:
+            # Leave the helper time to report its own timeout first
+            return future.result(timeout + 5)
+        except FutureTimeoutError:
+            with self._lock:
+                self._pending.pop(future.request_id, None)
+            raise subprocess.TimeoutExpired(argv, timeout)
+
+    def close(self):
+        with self._lock:
+            self._disconnect_locked(OSError("Privileged helper connection closed."))
+
+    def _read_loop(self, sock):
+        buffer = sock.makefile('rb')
+        try:
+            for line in buffer:
+                response = json.loads(line)
+                with self._lock:
+                    pending = self._pending.pop(response.get('id'), None)
+                if pending is None:
+                    continue
+                future, argv, timeout = pending
+                if response.get('error') == 'timeout':
+                    future.set_exception(subprocess.TimeoutExpired(argv, timeout))
+                elif 'error' in response:
+                    future.set_exception(HelperRefusedError(f"Privileged helper refused {argv}: {response['error']}"))
+                elif 'result' in response:
+                    future.set_result(response['result'])
+                else:
+                    future.set_result(subprocess.CompletedProcess(
+                        argv, response['returncode'], response['stdout'], response['stderr']))
+        except (OSError, ValueError) as e:
+            logging.debug(f"Privileged helper connection lost: {e}")
+        with self._lock:
+            if self._sock is sock:
+                self._disconnect_locked(OSError("Privileged helper connection lost."))
+
+    def _disconnect_locked(self, error):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+        pending, self._pending = self._pending, {}
+        for future, argv, timeout in pending.values():
+            future.set_exception(error)
+
+
+_client = PrivilegedHelperClient()
+
+
+def is_available():
+    """
+    Returns True if the privileged helper socket exists.
+    """
+    return os.path.exists(_client.socket_path)
+
+
+def run_privileged(argv, timeout=30, sudo=True, check=False):
+    """
+    Runs a whitelisted privileged command and returns a subprocess.CompletedProcess.
+
+    The command goes through the long-lived helper when it is running, and falls
+    back to forking it directly (through sudo unless `sudo` is False) otherwise.
+    With check=True a non-zero exit raises subprocess.CalledProcessError, and a
+    timeout raises subprocess.TimeoutExpired either way.
+    """
+    result = None
+    if is_available():
+        try:
+            result = _client.run(argv, timeout)
+        except OSError as e:
+            logging.debug(f"Privileged helper unavailable, running {argv} directly: {e}")
+
+    if result is None:
+        command = ['sudo'] + list(argv) if sudo else list(argv)
+        result = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+
+    if check:
+        result.check_returncode()
+    return result
+
+
+def call_privileged(call, *args, timeout=30):
+    """
+    Calls one of the PROVISIONER_CALLS in the privileged helper and returns
+    its result. Raises OSError if the helper is not running, HelperRefusedError
+    if the call failed and subprocess.TimeoutExpired on timeout.
+    """
+    if not is_available():
+        raise OSError("Privileged helper is not running.")
+    return _client.call(call, args, timeout)
+
+
+def run_direct(argv, timeout=30):
+    """
+    Runs a command without sudo; used inside the helper, which is already root.
+    """
+    return subprocess.run(list(argv), capture_output=True, text=True, timeout=timeout)
+
+
+def is_root_owned(path):
+    """
+    Returns True if `path` and every directory above it are owned by root and
+    not writable by group or others, so only root can change what sudo runs.
+    """
+    path = os.path.abspath(path)
+    while True:
+        try:
+            info = os.lstat(path)
+        except OSError:
+            return False
+        if info.st_uid != 0 or info.st_mode & 0o022 or os.path.islink(path):
+            return False
+        parent = os.path.dirname(path)
+        if parent == path:
+            return True
+        path = parent
+
+
+def start_helper(socket_path=SOCKET_PATH, wait=3.0):
+    """
+    Starts the root-owned install of the helper at HELPER_PATH through
+    'sudo -n' unless it is already running. Returns True once the socket
+    accepts connections.
+    """
+    try:
+        _client.connect()
+        return True
+    except OSError:
+        pass
+
+    if not is_root_owned(HELPER_PATH):
+        logging.warning(f"{HELPER_PATH} is not installed root-owned; falling back to sudo per command.")
+        return False
+
+    command = ['sudo', '-n', HELPER_PYTHON, HELPER_PATH,
+               '--socket', socket_path, '--gid', str(os.getgid()), '--uid', str(os.getuid()),
+               '--parent-pid', str(os.getpid())]
+    try:
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        logging.error(f"Could not start privileged helper: {e}")
+        return False
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        try:
+            _client.connect()
+            logging.debug("Privileged helper started.")
+            return True
+        except OSError:
+            time.sleep(0.1)
+    logging.warning("Privileged helper did not start; falling back to sudo per command.")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMARTHub privileged command helper')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--gid', type=int, default=None)
+    parser.add_argument('--uid', type=int, default=None)
+    parser.add_argument('--client-config-dir', default=CLIENT_CONFIG_DIR)
+    parser.add_argument('--parent-pid', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if os.geteuid() != 0:
+        logging.error("The privileged helper must run as root.")
+        sys.exit(1)
+
+    # sudo passes the arguments through unchecked, so trust the caller's ids
+    # from sudo itself and only serve the standard socket and their own directory
+    if 'SUDO_UID' in os.environ:
+        args.uid = int(os.environ['SUDO_UID'])
+        args.gid = int(os.environ['SUDO_GID'])
+        if os.path.abspath(args.socket) != SOCKET_PATH:
+            logging.error(f"Refusing to listen on {args.socket} when started through sudo.")
+            sys.exit(1)
+        try:
+            config_dir = os.lstat(args.client_config_dir)
+        except OSError as e:
+            logging.error(f"Client config directory unavailable: {e}")
+            sys.exit(1)
+        if not os.path.isdir(args.client_config_dir) or os.path.islink(args.client_config_dir) \
+                or config_dir.st_uid != args.uid:
+            logging.error(f"{args.client_config_dir} is not a directory owned by uid {args.uid}.")
+            sys.exit(1)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = PrivilegedHelperServer(args.socket, args.gid, args.parent_pid, args.uid, args.client_config_dir)
+    try:
+        asyncio.run(server.serve())
+    finally:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
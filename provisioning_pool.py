@@ -0,0 +1,137 @@
+# provisioning_pool.py
+
+import os
+import json
+import time
+import threading
+import ipaddress
+import logging
+
+from wireguard_provisioner import generate_keypair, generate_preshared_key, write_file_atomic
+
+# Holds private keys, so it lives with the app user rather than in a shared directory
+POOL_STATE_PATH = os.environ.get('VPN_POOL_STATE', os.path.expanduser('~/.smarthub_pool.json'))
+
+
+class ProvisioningPool:
+    """
+    Warm pool of ready-to-assign client slots for WireGuardProvisioner.
+
+    Each slot is a keypair, a preshared key and a reserved client address, so
+    adding a user only has to bind a name to a slot and write its files. A
+    background thread tops the pool up to `size`, creating at most one slot
+    every `refill_interval` seconds and pausing while slots are being taken.
+    Slots are persisted (mode 0600) to `state_path` so reserved keys and
+    addresses survive restarts.
+    """
+
+    def __init__(self, provisioner, size=None, refill_interval=None, state_path=None, idle_delay=2.0):
+        self.provisioner = provisioner
+        self.size = size if size is not None else int(os.environ.get('VPN_POOL_SIZE', 8))
+        self.refill_interval = (refill_interval if refill_interval is not None
+                                else float(os.environ.get('VPN_POOL_REFILL_INTERVAL', 1.0)))
+        self.state_path = state_path or POOL_STATE_PATH
+        self.idle_delay = idle_delay
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._slots = []
+        self._last_take = 0.0
+        self._refiller = None
+
+    def start(self):
+        """
+        Loads the persisted slots and starts the background refill.
+        """
+        with self._lock:
+            if self._refiller is not None:
+                return
+            self._load()
+            self._refiller = threading.Thread(target=self._refill_loop, name='ProvisioningPoolRefill', daemon=True)
+            self._refiller.start()
+
+    def take(self):
+        """
+        Removes and returns a slot as a (keys, address) tuple, or None if the
+        pool is empty.
+        """
+        with self._lock:
+            self._last_take = time.monotonic()
+            if not self._slots:
+                return None
+            slot = self._slots.pop()
+            self._save()
+        self._wakeup.set()
+        return slot
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _refill_loop(self):
+        while True:
+            with self._lock:
+                missing = self.size - len(self._slots)
+                busy = time.monotonic() - self._last_take < self.idle_delay
+            if missing <= 0:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            if busy:
+                # Leave the CPU and the server config lock to the add in progress
+                time.sleep(self.idle_delay)
+                continue
+
+            try:
+                slot = self._create_slot()
+            except Exception:
+                logging.exception("Could not create a provisioning pool slot.")
+                time.sleep(max(self.refill_interval, 30))
+                continue
+
+            with self._lock:
+                self._slots.append(slot)
+                self._save()
+            logging.debug(f"Provisioning pool has {len(self._slots)} of {self.size} slots.")
+            time.sleep(self.refill_interval)
+
+    def _create_slot(self):
+        private_key, public_key = generate_keypair()
+        keys = (private_key, public_key, generate_preshared_key())
+        return keys, self.provisioner.allocate_address()
+
+    def _load(self):
+        """
+        Loads persisted slots, keeping only those whose address is still free.
+        Must hold the lock.
+        """
+        try:
+            with open(self.state_path, 'r') as state_file:
+                saved = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read provisioning pool state {self.state_path}: {e}")
+            return
+
+        for entry in saved.get('slots', []):
+            try:
+                keys = (entry['private_key'], entry['public_key'], entry['preshared_key'])
+                address = ipaddress.ip_address(entry['address'])
+            except (KeyError, ValueError):
+                continue
+            if self.provisioner.reserve_address(address):
+                self._slots.append((keys, address))
+        logging.debug(f"Loaded {len(self._slots)} provisioning pool slots.")
+
+    def _save(self):
+        """
+        Persists the slots. Must hold the lock.
+        """
+        state = {'slots': [
+            {'private_key': keys[0], 'public_key': keys[1], 'preshared_key': keys[2], 'address': str(address)}
+            for keys, address in self._slots
+        ]}
+        try:
+            write_file_atomic(self.state_path, json.dumps(state), 0o600)
+        except OSError as e:
+            logging.error(f"Could not save provisioning pool state {self.state_path}: {e}")
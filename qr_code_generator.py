@@ -1,45 +1,570 @@
 # qr_code_generator.py
 
 import os
+import io
+import time
+import stat
+import hashlib
+import tempfile
+import zipfile
+import threading
 import logging
+from collections import OrderedDict
 import qrcode
+try:
+    import numpy
+except ImportError:  # Optional; the RGBA expansion falls back to bytes operations
+    numpy = None
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+# Render parameters; they are part of the cache key
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+QR_ERROR_CORRECTION = 'L'
+# Pixels per module for in-memory textures; the GPU scales them up without smoothing
+QR_TEXTURE_BOX_SIZE = 4
+
+QR_BLACK = b'\x00\x00\x00\xff'
+QR_WHITE = b'\xff\xff\xff\xff'
+
+# Where bulk-added users' QR codes are saved as <username>_qrcode.png
+QR_IMAGE_DIR = os.environ.get('QR_IMAGE_DIR', os.path.expanduser('~/smarthub_qr_codes'))
+
+# Where bulk profile exports are written
+EXPORT_DIR = os.environ.get('VPN_EXPORT_DIR', '/home/SMART/exports')
+
+# The images encode whole client configs, private keys included, so they are
+# kept in a directory only the app user can read and expire after QR_CACHE_MAX_AGE
+QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR', os.path.expanduser('~/.cache/smarthub_qr'))
+QR_MEMORY_BUDGET = int(os.environ.get('QR_MEMORY_BUDGET', 8 * 1024 * 1024))
+QR_DISK_BUDGET = int(os.environ.get('QR_DISK_BUDGET', 64 * 1024 * 1024))
+QR_CACHE_MAX_AGE = float(os.environ.get('QR_CACHE_MAX_AGE', 24 * 3600))
+
+
+def ensure_private_dir(path):
+    """
+    Creates `path` as a directory only the current user can access, or checks
+    that an existing one is, tightening its mode if needed.
+    Returns False if the directory cannot be trusted with private files.
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+    except OSError as e:
+        logging.error(f"Could not create directory {path}: {e}")
+        return False
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        logging.error(f"{path} is not a directory owned by this user; not storing QR codes in it.")
+        return False
+    if info.st_mode & 0o077:
+        try:
+            os.chmod(path, 0o700)
+        except OSError as e:
+            logging.error(f"Could not restrict the permissions of {path}: {e}")
+            return False
+    return True
+
+
+def write_private_file(path, data):
+    """
+    Writes bytes to `path` with mode 0600 through a temporary file, so
+    readers never see a partial file.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as output_file:
+            output_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class QRCodeCache:
+    """
+    Two-level cache of rendered QR code PNGs, keyed by a hash of the config
+    data and the render parameters.
+
+    Recently used images are kept in memory up to `memory_budget` bytes. Every
+    image is also written to `cache_dir` as <key>.png with mode 0600; once the
+    directory grows past `disk_budget` bytes the least recently used files are
+    removed, and files unused for `max_age` seconds are removed regardless.
+    If `cache_dir` is not a private directory of the app user, a fresh
+    temporary one is used instead.
+    """
+
+    def __init__(self, cache_dir=QR_CACHE_DIR, memory_budget=QR_MEMORY_BUDGET, disk_budget=QR_DISK_BUDGET,
+                 max_age=QR_CACHE_MAX_AGE):
+        if not ensure_private_dir(cache_dir):
+            cache_dir = tempfile.mkdtemp(prefix='smarthub_qr_')
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._last_sweep = None
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'encodes': 0, 'encode_time': 0.0}
+        with self._lock:
+            self._evict_disk_locked()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def get_memory(self, key):
+        """
+        Returns data stored with put_memory(), or None on a miss.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is None:
+                self._stats['misses'] += 1
+                return None
+            self._memory.move_to_end(key)
+            self._stats['memory_hits'] += 1
+            return data
+
+    def put_memory(self, key, data, encode_time=None):
+        """
+        Stores data in the memory LRU only.
+        """
+        with self._lock:
+            if encode_time is not None:
+                self._stats['encodes'] += 1
+                self._stats['encode_time'] += encode_time
+            self._remember(key, data)
+
+    def get_path(self, key):
+        """
+        Returns the path of the cached image for a key, or None on a miss.
+        """
+        path = self.path_for(key)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                # The file may have been evicted while the image stayed in memory
+                if os.path.isfile(path):
+                    self._touch(path)
+                    return path
+                png_data = self._memory[key]
+            else:
+                png_data = None
+
+        if png_data is not None:
+            self._write(key, png_data)
+            return path
+
+        try:
+            with open(path, 'rb') as png_file:
+                png_data = png_file.read()
+        except OSError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._remember(key, png_data)
+        self._touch(path)
+        return path
+
+    def put(self, key, png_data, encode_time=None):
+        """
+        Stores a rendered image and returns its path.
+        """
+        with self._lock:
+            if encode_time is not None:
+                self._stats['encodes'] += 1
+                self._stats['encode_time'] += encode_time
+            self._remember(key, png_data)
+        return self._write(key, png_data)
+
+    def stats(self):
+        """
+        Returns hit counts, the hit rate and the average encode time in milliseconds.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_bytes'] = self._memory_bytes
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        stats['avg_encode_ms'] = stats['encode_time'] * 1000 / stats['encodes'] if stats['encodes'] else 0.0
+        return stats
+
+    def _remember(self, key, png_data):
+        """
+        Adds an image to the memory LRU. Must hold the lock.
+        """
+        if len(png_data) > self.memory_budget:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = png_data
+        self._memory_bytes += len(png_data)
+        while self._memory_bytes > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _write(self, key, png_data):
+        path = self.path_for(key)
+        if os.path.isfile(path):
+            self._touch(path)
+            return path
+
+        try:
+            write_private_file(path, png_data)
+        except OSError as e:
+            logging.error(f"Could not write QR code cache file {path}: {e}")
+            return None
+
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(png_data)
+            self._evict_disk_locked()
+        return path
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict_disk_locked(self):
+        """
+        Removes expired files, and the least recently used ones once the
+        directory is over budget. Must hold the lock.
+        """
+        now = time.time()
+        # Expiry is checked at most every tenth of max_age
+        sweep = self._last_sweep is None or time.monotonic() - self._last_sweep > self.max_age / 10
+        if not sweep and self._disk_bytes is not None and self._disk_bytes <= self.disk_budget:
+            return
+        if sweep:
+            self._last_sweep = time.monotonic()
+
+        files = []
+        try:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.png') and entry.is_file():
+                        info = entry.stat()
+                        files.append((info.st_mtime_ns, info.st_size, entry.path))
+        except OSError as e:
+            logging.debug(f"Could not scan QR code cache {self.cache_dir}: {e}")
+            return
+
+        expired_before = (now - self.max_age) * 1e9
+        kept = []
+        for mtime_ns, size, path in files:
+            if mtime_ns >= expired_before:
+                kept.append((mtime_ns, size, path))
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                kept.append((mtime_ns, size, path))
+        files = kept
+
+        self._disk_bytes = sum(size for _, size, _ in files)
+        if self._disk_bytes <= self.disk_budget:
+            return
+        files.sort()
+        for _, size, path in files:
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+            if self._disk_bytes <= self.disk_budget:
+                break
+        logging.debug(f"QR code cache trimmed to {self._disk_bytes} bytes.")
+
 
 class QRCodeGenerator:
     """
     Generates QR codes for VPN configuration files.
     """
 
-    def __init__(self):
-        # Directory to store QR code images
-        self.qr_image_dir = '/tmp'
-        os.makedirs(self.qr_image_dir, exist_ok=True)
+    def __init__(self, cache=None, qr_image_dir=QR_IMAGE_DIR):
+        # Rendered QR codes are cached by content, so re-showing a code is a lookup
+        self.cache = cache or QRCodeCache()
+        self.qr_image_dir = qr_image_dir
 
     def generate_qr_code(self, username, config_data):
         """
-        Generates a QR code for the user's VPN config data and saves it to disk.
-        Returns the path to the generated QR code image.
+        Generates a QR code for the user's VPN config data, or reuses a cached one.
+        Returns the path to the QR code image, or None on error.
+        """
+        key = qr_cache_key(config_data)
+        qr_image_path = self.cache.get_path(key)
+        if qr_image_path:
+            logging.debug(f"QR code for user '{username}' served from cache.")
+            return qr_image_path
+
+        rendered = render_qr_code(username, config_data)
+        if rendered is None:
+            return None
+        png_data, encode_time = rendered
+        return self.cache.put(key, png_data, encode_time)
+
+    def generate_qr_buffer(self, username, config_data, box_size=QR_TEXTURE_BOX_SIZE):
+        """
+        Renders a QR code straight to an RGBA pixel buffer for a Kivy Texture,
+        without encoding a PNG or touching the disk.
+        Returns a (size, rgba_data) tuple with rows bottom-up, or None on error.
+        """
+        key = qr_cache_key(config_data, box_size=box_size, image_format='rgba')
+        rgba_data = self.cache.get_memory(key)
+        if rgba_data is None:
+            try:
+                start = time.perf_counter()
+                rgba_data = matrix_to_rgba(qr_matrix(config_data), box_size)
+                encode_time = time.perf_counter() - start
+            except Exception:
+                logging.exception(f"Error generating QR code for user '{username}'.")
+                return None
+            self.cache.put_memory(key, rgba_data, encode_time)
+            logging.debug(f"QR buffer generated for user '{username}' in {encode_time * 1000:.1f} ms.")
+
+        # The buffer is square
+        side = int(round((len(rgba_data) // 4) ** 0.5))
+        return (side, side), rgba_data
+
+    def generate_qr_codes(self, configs, progress_callback=None, max_workers=None):
+        """
+        Generates QR codes for several users, rendering cache misses in a process pool.
+        `configs` is an iterable of (username, config_data) pairs and
+        `progress_callback(done, total, username, qr_image_path)` is called as
+        each code is ready. Returns a dictionary mapping usernames to image paths.
+        """
+        configs = list(configs)
+        qr_image_paths = {}
+        total = len(configs)
+
+        misses = []
+        for username, config_data in configs:
+            key = qr_cache_key(config_data)
+            qr_image_path = self.cache.get_path(key)
+            if qr_image_path is None:
+                misses.append((username, config_data, key))
+                continue
+            qr_image_paths[username] = qr_image_path
+            if progress_callback:
+                progress_callback(len(qr_image_paths), total, username, qr_image_path)
+        if not misses:
+            return qr_image_paths
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(render_qr_code, username, config_data): (username, key)
+                for username, config_data, key in misses
+            }
+            for future in as_completed(futures):
+                username, key = futures[future]
+                rendered = future.result()
+                qr_image_paths[username] = self.cache.put(key, *rendered) if rendered else None
+                if progress_callback:
+                    progress_callback(len(qr_image_paths), total, username, qr_image_paths[username])
+        return qr_image_paths
+
+    def save_named_copies(self, qr_image_paths):
+        """
+        Copies cached QR codes to qr_image_dir as <username>_qrcode.png, with
+        mode 0600 in a private directory, since
+        cache file names are content hashes. `qr_image_paths` maps usernames to
+        cached image paths. Returns a dictionary mapping usernames to the copies.
+        """
+        saved = {}
+        if not ensure_private_dir(self.qr_image_dir):
+            return saved
+        for username, qr_image_path in qr_image_paths.items():
+            if qr_image_path is None:
+                continue
+            named_path = os.path.join(self.qr_image_dir, f"{username}_qrcode.png")
+            try:
+                with open(qr_image_path, 'rb') as png_file:
+                    write_private_file(named_path, png_file.read())
+            except OSError as e:
+                logging.error(f"Could not save QR code for user '{username}': {e}")
+                continue
+            saved[username] = named_path
+        return saved
+
+    def export_profiles(self, config_dir, export_path=None, progress_callback=None, max_workers=None):
+        """
+        Exports the config and QR code of every client config in config_dir to a ZIP file.
+
+        QR codes are rendered in a process pool. Only a small window of renders
+        is in flight at a time and each result is written to the archive as
+        soon as it arrives, so memory use does not grow with the number of
+        users. `progress_callback(done, total)` is called after each profile.
+        Returns a result dictionary with the archive path.
         """
         try:
-            # Generate the QR code
-            qr = qrcode.QRCode(
-                version=None,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(config_data)
-            qr.make(fit=True)
+            with os.scandir(config_dir) as entries:
+                config_paths = sorted(entry.path for entry in entries
+                                      if entry.name.endswith('.conf') and entry.is_file())
+        except OSError as e:
+            logging.error(f"Could not read VPN config directory {config_dir}: {e}")
+            return {'success': False, 'message': f"Could not read VPN configs: {e}"}
+        if not config_paths:
+            return {'success': False, 'message': "There are no VPN users to export."}
 
-            # Create an image from the QR code
-            img = qr.make_image(fill_color="black", back_color="white")
+        if export_path is None:
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            export_path = os.path.join(EXPORT_DIR, time.strftime('vpn_profiles_%Y%m%d_%H%M%S.zip'))
 
-            # Save the QR code image to the specified directory
-            qr_image_path = os.path.join(self.qr_image_dir, f"{username}_qrcode.png")
-            img.save(qr_image_path)
+        total = len(config_paths)
+        failed = []
+        done = 0
+        max_workers = max_workers or os.cpu_count() or 1
+        pending_paths = iter(config_paths)
+        in_flight = set()
+        try:
+            # The archive holds private keys, so only the owner may read it
+            export_fd = os.open(export_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(export_fd, 'wb') as export_file, \
+                    zipfile.ZipFile(export_file, 'w') as archive, \
+                    ProcessPoolExecutor(max_workers=max_workers) as executor:
+                while True:
+                    # Keep each worker busy with one render queued behind it
+                    while len(in_flight) < max_workers * 2:
+                        config_path = next(pending_paths, None)
+                        if config_path is None:
+                            break
+                        in_flight.add(executor.submit(render_profile, config_path))
+                    if not in_flight:
+                        break
 
-            logging.debug(f"QR code generated for user '{username}' at {qr_image_path}.")
-            return qr_image_path
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        username, config_data, png_data = future.result()
+                        done += 1
+                        if config_data is None or png_data is None:
+                            failed.append(username)
+                        else:
+                            archive.writestr(f"{username}/{username}.conf", config_data, zipfile.ZIP_DEFLATED)
+                            # PNGs are already compressed
+                            archive.writestr(f"{username}/{username}.png", png_data, zipfile.ZIP_STORED)
+                        if progress_callback:
+                            progress_callback(done, total)
+        except OSError as e:
+            logging.error(f"Could not write profile export {export_path}: {e}")
+            return {'success': False, 'message': f"Could not write the export: {e}"}
 
-        except Exception as e:
-            logging.exception(f"Error generating QR code for user '{username}'.")
-            return None
+        exported = total - len(failed)
+        message = f"Exported {exported} of {total} VPN profiles to {export_path}."
+        if failed:
+            message += f" Failed: {', '.join(sorted(failed))}."
+        logging.info(message)
+        return {'success': exported > 0, 'message': message, 'path': export_path, 'failed': failed}
+
+    def stats(self):
+        """
+        Returns the QR code cache statistics.
+        """
+        return self.cache.stats()
+
+
+def qr_cache_key(config_data, box_size=QR_BOX_SIZE, border=QR_BORDER, error_correction=QR_ERROR_CORRECTION,
+                 image_format='png'):
+    """
+    Returns the cache key for a config rendered with the given parameters.
+    """
+    digest = hashlib.sha256(f"{image_format}:{box_size}:{border}:{error_correction}\n".encode())
+    digest.update(config_data.encode())
+    return digest.hexdigest()
+
+
+def qr_matrix(config_data):
+    """
+    Returns the QR code modules for the config data as rows of booleans,
+    including the quiet zone border.
+    """
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=getattr(qrcode.constants, f'ERROR_CORRECT_{QR_ERROR_CORRECTION}'),
+        border=QR_BORDER,
+    )
+    qr.add_data(config_data)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def matrix_to_rgba(matrix, box_size):
+    """
+    Expands a QR matrix to RGBA bytes with `box_size` pixels per module.
+    Rows are emitted bottom-up, the order Kivy textures expect.
+    """
+    if numpy is not None:
+        modules = numpy.array(matrix, dtype=bool)[::-1]
+        colors = numpy.frombuffer(QR_WHITE + QR_BLACK, dtype=numpy.uint8).reshape(2, 4)
+        pixels = colors[modules.astype(numpy.uint8)]
+        pixels = pixels.repeat(box_size, axis=0).repeat(box_size, axis=1)
+        return pixels.tobytes()
+
+    black, white = QR_BLACK * box_size, QR_WHITE * box_size
+    return b''.join(
+        b''.join(black if module else white for module in row) * box_size
+        for row in reversed(matrix)
+    )
+
+
+def render_qr_code(username, config_data):
+    """
+    Renders a QR code PNG for the config data.
+    Kept at module level so it can run in a worker process.
+    Returns a (png_data, encode_time) tuple, or None on error.
+    """
+    try:
+        start = time.perf_counter()
+        # Generate the QR code
+        qr = qrcode.QRCode(
+            version=None,
+            error_correction=getattr(qrcode.constants, f'ERROR_CORRECT_{QR_ERROR_CORRECTION}'),
+            box_size=QR_BOX_SIZE,
+            border=QR_BORDER,
+        )
+        qr.add_data(config_data)
+        qr.make(fit=True)
+
+        # Create an image from the QR code
+        img = qr.make_image(fill_color="black", back_color="white")
+
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG')
+        encode_time = time.perf_counter() - start
+
+        logging.debug(f"QR code generated for user '{username}' in {encode_time * 1000:.1f} ms.")
+        return buffer.getvalue(), encode_time
+
+    except Exception as e:
+        logging.exception(f"Error generating QR code for user '{username}'.")
+        return None
+
+
+def render_profile(config_path):
+    """
+    Reads a client config and renders its QR code, in a worker process.
+    Returns a (username, config_data, png_data) tuple; the last two are None on error.
+    """
+    username = os.path.basename(config_path)[:-len('.conf')]
+    try:
+        with open(config_path, 'r') as config_file:
+            config_data = config_file.read()
+    except OSError as e:
+        logging.error(f"Could not read VPN config {config_path}: {e}")
+        return username, None, None
+
+    rendered = render_qr_code(username, config_data)
+    return username, config_data, rendered[0] if rendered else None
@@ -1,6 +1,8 @@
 import logging
 import subprocess
 
+from privileged_helper import run_privileged, HelperRefusedError
+
 class Settings:
     def __init__(self):
         pass
@@ -34,18 +36,15 @@ class Settings:
         """
         try:
             # Start the Bluetooth service
-            subprocess.run(
-                ['rfkill', 'unblock', 'bluetooth'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True
-            )
+            run_privileged(['rfkill', 'unblock', 'bluetooth'], sudo=False, check=True)
            
             logging.info("Bluetooth has been enabled successfully.")
             return True
         except subprocess.CalledProcessError as e:
-            logging.error(f"Error enabling Bluetooth: {e.stderr.strip()}")
+            logging.error(f"Error enabling Bluetooth: {(e.stderr or '').strip()}")
+            return False
+        except (subprocess.TimeoutExpired, HelperRefusedError, OSError) as e:
+            logging.error(f"Error enabling Bluetooth: {e}")
             return False
 
     def disable_bluetooth(self):
@@ -55,18 +54,15 @@ class Settings:
         """
         try:
             # Stop the Bluetooth service
-            subprocess.run(
-                ['rfkill', 'block', 'bluetooth'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True
-            )
+            run_privileged(['rfkill', 'block', 'bluetooth'], sudo=False, check=True)
         
             logging.info("Bluetooth has been disabled successfully.")
             return True
         except subprocess.CalledProcessError as e:
-            logging.error(f"Error disabling Bluetooth: {e.stderr.strip()}")
+            logging.error(f"Error disabling Bluetooth: {(e.stderr or '').strip()}")
+            return False
+        except (subprocess.TimeoutExpired, HelperRefusedError, OSError) as e:
+            logging.error(f"Error disabling Bluetooth: {e}")
             return False
   
     
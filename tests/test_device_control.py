@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from device_control import DeviceCommandQueue, summarize_results
+except ImportError:
+    DeviceCommandQueue = None
+
+
+class FakeClient:
+    """
+    Stands in for DeviceControlClient. Each device answers from its list of
+    scripted outcomes (True or False, the last one repeating), and requests
+    for a device in `blocked` wait until it is released.
+    """
+
+    def __init__(self, outcomes=None, batch_outcomes=None):
+        self.outcomes = outcomes or {}
+        self.batch_outcomes = batch_outcomes or {}
+        self.calls = []
+        self.batches = []
+        self.blocked = {}
+        self.lock = threading.Lock()
+
+    def block(self, device_id):
+        self.blocked[device_id] = threading.Event()
+
+    def release(self, device_id):
+        self.blocked.pop(device_id).set()
+
+    def set_device_state(self, device_id, action):
+        with self.lock:
+            self.calls.append((device_id, action))
+            outcomes = self.outcomes.get(device_id, [True])
+            success = outcomes.pop(0) if len(outcomes) > 1 else outcomes[0]
+        gate = self.blocked.get(device_id)
+        if gate is not None:
+            gate.wait(5)
+        return self.result(device_id, action, success)
+
+    def set_device_states(self, device_ids, action):
+        with self.lock:
+            self.batches.append((list(device_ids), action))
+        results = {device_id: self.result(device_id, action, self.batch_outcomes.get(device_id, True))
+                   for device_id in device_ids}
+        return summarize_results(device_ids, results)
+
+    def result(self, device_id, action, success):
+        if not success:
+            return {'success': False, 'message': f"Control server error 503 for device {device_id}."}
+        state = 'ON' if action == 'activate' else 'OFF'
+        return {'success': True, 'state': state, 'message': f"Device {device_id} is {state}."}
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.01)
+
+
+@unittest.skipIf(DeviceCommandQueue is None, "requests is not installed")
+class DeviceCommandQueueTest(unittest.TestCase):
+
+    def make_queue(self, client, retries=3, backoff=0.001):
+        queue = DeviceCommandQueue(client=client, max_workers=4, retries=retries, backoff=backoff, max_backoff=0.01)
+        self.addCleanup(queue.executor.shutdown)
+        return queue
+
+    def collect(self):
+        results = []
+        done = threading.Event()
+
+        def callback(device_id, result):
+            results.append((device_id, result))
+            done.set()
+        return results, done, callback
+
+    def test_commands_queued_behind_one_in_flight_are_coalesced(self):
+        client = FakeClient()
+        client.block('lamp')
+        queue = self.make_queue(client)
+        results, done, callback = self.collect()
+
+        queue.submit('lamp', 'activate')
+        wait_for(lambda: client.calls)
+        queue.submit('lamp', 'deactivate', callback)
+        queue.submit('lamp', 'activate', callback)
+        client.release('lamp')
+        wait_for(lambda: len(results) == 2)
+
+        self.assertEqual(client.calls, [('lamp', 'activate'), ('lamp', 'activate')])
+        self.assertEqual([result['state'] for _, result in results], ['ON', 'ON'])
+        self.assertEqual(queue.stats()['coalesced'], 1)
+        self.assertEqual(queue.stats()['sent'], 2)
+
+    def test_failed_command_is_retried_with_backoff(self):
+        client = FakeClient(outcomes={'lamp': [False, False, True]})
+        queue = self.make_queue(client)
+        results, done, callback = self.collect()
+
+        queue.submit('lamp', 'activate', callback)
+        self.assertTrue(done.wait(5))
+
+        self.assertTrue(results[0][1]['success'])
+        self.assertEqual(len(client.calls), 3)
+        stats = queue.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['failed']), (3, 2, 0))
+
+    def test_command_fails_once_retries_are_exhausted(self):
+        client = FakeClient(outcomes={'lamp': [False]})
+        queue = self.make_queue(client, retries=2)
+        results, done, callback = self.collect()
+
+        queue.submit('lamp', 'activate', callback)
+        self.assertTrue(done.wait(5))
+
+        self.assertFalse(results[0][1]['success'])
+        self.assertEqual(len(client.calls), 3)
+        self.assertEqual(queue.stats()['failed'], 1)
+
+    def test_newer_command_supersedes_a_retry(self):
+        client = FakeClient(outcomes={'lamp': [False, True]})
+        queue = self.make_queue(client, backoff=10)
+        queue.max_backoff = 10
+        results, done, callback = self.collect()
+
+        queue.submit('lamp', 'activate', callback)
+        wait_for(lambda: queue.stats()['retries'] == 1)
+        queue.submit('lamp', 'deactivate')
+        self.assertTrue(done.wait(5))
+
+        self.assertEqual(client.calls, [('lamp', 'activate'), ('lamp', 'deactivate')])
+        # The superseded command's caller hears the outcome of the newer one
+        self.assertEqual(results, [('lamp', {'success': True, 'state': 'OFF', 'message': "Device lamp is OFF."})])
+
+    def test_submit_many_retries_devices_the_batch_failed_for(self):
+        client = FakeClient(outcomes={'fan': [False, True]}, batch_outcomes={'fan': False})
+        queue = self.make_queue(client)
+
+        result = queue.submit_many(['lamp', 'fan', 'heater'], 'activate')
+
+        self.assertTrue(result['success'])
+        self.assertEqual(client.batches, [(['lamp', 'fan', 'heater'], 'activate')])
+        self.assertEqual(client.calls, [('fan', 'activate'), ('fan', 'activate')])
+        self.assertTrue(all(device_result['success'] for device_result in result['results'].values()))
+        wait_for(lambda: not queue._in_flight)
+
+    def test_submit_many_reports_failure_if_any_device_failed(self):
+        client = FakeClient(outcomes={'fan': [False]}, batch_outcomes={'fan': False})
+        queue = self.make_queue(client, retries=1)
+        seen = []
+
+        result = queue.submit_many(['lamp', 'fan'], 'activate', lambda device_id, result: seen.append(device_id))
+
+        self.assertFalse(result['success'])
+        self.assertTrue(result['results']['lamp']['success'])
+        self.assertFalse(result['results']['fan']['success'])
+        self.assertEqual(sorted(seen), ['fan', 'lamp'])
+        self.assertEqual(queue.stats()['failed'], 1)
+
+    def test_submit_many_queues_behind_a_command_in_flight(self):
+        client = FakeClient()
+        client.block('lamp')
+        queue = self.make_queue(client)
+
+        queue.submit('lamp', 'deactivate')
+        wait_for(lambda: client.calls)
+        threading.Timer(0.05, client.release, args=('lamp',)).start()
+        result = queue.submit_many(['lamp', 'fan'], 'activate')
+
+        self.assertTrue(result['success'])
+        self.assertEqual(client.batches, [(['fan'], 'activate')])
+        self.assertEqual(client.calls, [('lamp', 'deactivate'), ('lamp', 'activate')])
+        self.assertEqual(result['results']['lamp']['state'], 'ON')
+
+
+@unittest.skipIf(DeviceCommandQueue is None, "requests is not installed")
+class SummarizeResultsTest(unittest.TestCase):
+
+    def test_success_means_no_failures(self):
+        ok = {'success': True, 'state': 'ON', 'message': ''}
+        failed = {'success': False, 'message': ''}
+
+        self.assertTrue(summarize_results(['a', 'b'], {'a': ok, 'b': ok})['success'])
+        self.assertFalse(summarize_results(['a', 'b'], {'a': ok, 'b': failed})['success'])
+        self.assertFalse(summarize_results([], {})['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
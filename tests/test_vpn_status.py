@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vpn_status import VPNStatusChecker
+
+# A stand-in for 'wg show all dump': prints an interface line and two peers,
+# then behaves according to its first argument. It records its own pid and
+# that of a background child in the file named by its second argument.
+FAKE_WG = """#!/bin/sh
+mode="$1"
+sleep 30 &
+echo "$$ $!" > "$2"
+printf 'wg0\\tcHJpdmF0ZQ==\\tcHVibGlj\\t51820\\toff\\n'
+printf 'wg0\\talice=\\t(none)\\t203.0.113.1:40000\\t10.6.0.2/32,fd11:5ee:bad:c0de::2/128\\t1700000000\\t1024\\t512\\toff\\n'
+case "$mode" in
+  fail)
+    echo "Unable to access interface: Operation not permitted" >&2
+    kill $!
+    exit 1
+    ;;
+  hang)
+    wait
+    ;;
+esac
+printf 'wg0\\tbob=\\t(none)\\t(none)\\t10.6.0.3/32\\t0\\t0\\t0\\toff\\n'
+if [ "$mode" = "slow" ]; then
+  wait
+fi
+kill $!
+"""
+
+
+def is_running(pid):
+    """
+    Returns True while `pid` exists and is not a zombie waiting to be reaped.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            return stat_file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+
+class IterActiveVPNClientsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.script = os.path.join(self.root, 'wg')
+        with open(self.script, 'w') as script_file:
+            script_file.write(FAKE_WG)
+        os.chmod(self.script, 0o755)
+        self.pid_file = os.path.join(self.root, 'pids')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def checker(self, mode):
+        return VPNStatusChecker(snapshot_service=object(), wg_command=[self.script, mode, self.pid_file], timeout=5)
+
+    def read_pids(self):
+        with open(self.pid_file) as pid_file:
+            return [int(pid) for pid in pid_file.read().split()]
+
+    def assert_exited(self, pids):
+        deadline = time.monotonic() + 2
+        while any(is_running(pid) for pid in pids) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for pid in pids:
+            self.assertFalse(is_running(pid), f"process {pid} is still running")
+
+    def test_yields_every_peer(self):
+        peers = list(self.checker('normal').iter_active_vpn_clients())
+
+        self.assertEqual([peer.public_key for peer in peers], ['alice=', 'bob='])
+        self.assertEqual(peers[0].ip_address, '10.6.0.2')
+        self.assertEqual(peers[0].endpoint, '203.0.113.1:40000')
+        self.assertEqual((peers[0].transfer_rx, peers[0].transfer_tx), (1024, 512))
+        self.assertEqual(peers[1].ip_address, '10.6.0.3')
+
+    def test_non_zero_exit_raises_after_the_output(self):
+        peers = []
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            for peer in self.checker('fail').iter_active_vpn_clients():
+                peers.append(peer)
+
+        self.assertEqual([peer.public_key for peer in peers], ['alice='])
+        self.assertEqual(raised.exception.returncode, 1)
+        self.assertIn('Operation not permitted', raised.exception.stderr)
+
+    def test_timeout_kills_the_process_group(self):
+        started = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            list(self.checker('hang').iter_active_vpn_clients(timeout=0.5))
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assert_exited(self.read_pids())
+
+    def test_stopping_early_kills_the_process_group(self):
+        clients = self.checker('slow').iter_active_vpn_clients()
+        first = next(clients)
+        clients.close()
+
+        self.assertEqual(first.public_key, 'alice=')
+        self.assert_exited(self.read_pids())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vpn_status import WireGuardPeer
+from vpn_throughput import PeerRateTracker
+
+
+def make_peer(transfer_rx, transfer_tx):
+    return WireGuardPeer('wg0', 'alice=', '203.0.113.1:40000', '10.6.0.2/32',
+                         0, transfer_rx, transfer_tx, '10.6.0.2')
+
+
+class PeerRateTrackerTest(unittest.TestCase):
+
+    def poll(self, tracker, start, seconds, rx_rate, rx=0, poll_interval=1):
+        """
+        Feeds one sample per poll_interval for `seconds`, with rx growing at
+        rx_rate bytes per second and tx at half that. Returns the last rx.
+        """
+        for step in range(1, int(seconds / poll_interval) + 1):
+            rx += int(rx_rate * poll_interval)
+            tracker.ingest([make_peer(rx, rx // 2)], timestamp=start + step * poll_interval)
+        return rx
+
+    def test_fifteen_minute_rate_with_one_second_polls(self):
+        tracker = PeerRateTracker(min_interval=5.0)
+        key = ('wg0', 'alice=')
+        tracker.ingest([make_peer(0, 0)], timestamp=0)
+        # 20 minutes at 1000 B/s, then 5 minutes at 2000 B/s
+        rx = self.poll(tracker, 0, 1200, 1000)
+        self.poll(tracker, 1200, 300, 2000, rx)
+
+        rates = tracker.get_rates(key)
+        self.assertAlmostEqual(rates[60][0], 2000, delta=1)
+        self.assertAlmostEqual(rates[300][0], 2000, delta=5)
+        # The 15-minute window spans 300 s at 2000 B/s and 600 s at 1000 B/s
+        self.assertAlmostEqual(rates[900][0], (300 * 2000 + 600 * 1000) / 900, delta=10)
+        self.assertAlmostEqual(rates[900][1], rates[900][0] / 2, delta=10)
+
+    def test_samples_are_stored_at_least_min_interval_apart(self):
+        tracker = PeerRateTracker(min_interval=5.0)
+        tracker.ingest([make_peer(0, 0)], timestamp=0)
+        self.poll(tracker, 0, 2000, 1000, poll_interval=0.5)
+
+        buffer = tracker.buffers[('wg0', 'alice=')]
+        self.assertEqual(buffer.count, tracker.capacity)
+        times = sorted(buffer.times)
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        self.assertGreaterEqual(min(gaps[:-1]), 5.0)
+        self.assertLessEqual(times[0], times[-1] - 900)
+
+    def test_counter_reset_does_not_give_a_negative_rate(self):
+        tracker = PeerRateTracker(min_interval=5.0)
+        key = ('wg0', 'alice=')
+        self.poll(tracker, 0, 120, 1000, poll_interval=5)
+        # The interface restarts and its counters begin again from zero
+        self.poll(tracker, 120, 60, 1000, poll_interval=5)
+
+        rx_rate, tx_rate = tracker.get_rate(key, 60)
+        self.assertGreater(rx_rate, 0)
+        self.assertGreater(tx_rate, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import ipaddress
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from privileged_helper import PrivilegedHelperServer
+from wireguard_provisioner import WireGuardProvisioner
+
+SERVER_CONFIG = """[Interface]
+PrivateKey = c2VydmVyLXByaXZhdGUta2V5LXNlcnZlci1wcml2YXRlLWs=
+Address = 10.6.0.1/24
+ListenPort = 51820
+"""
+
+SETUP_VARS = """pivpnDEV=wg0
+pivpnNET=10.6.0.0
+subnetClass=24
+pivpnHOST=vpn.example.com
+pivpnPORT=51820
+pivpnDNS1=10.6.0.1
+"""
+
+
+def make_keys(name):
+    """
+    Returns a fake (private_key, public_key, preshared_key) tuple for a client.
+    """
+    return tuple(f"{name}{kind}".ljust(43, 'A')[:43] + '=' for kind in ('priv', 'pub', 'psk'))
+
+
+class WireGuardProvisionerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.wireguard_dir = os.path.join(self.root, 'wireguard')
+        os.makedirs(os.path.join(self.wireguard_dir, 'keys'))
+        os.makedirs(os.path.join(self.wireguard_dir, 'configs'))
+        with open(os.path.join(self.wireguard_dir, 'wg0.conf'), 'w') as server_file:
+            server_file.write(SERVER_CONFIG)
+        with open(os.path.join(self.wireguard_dir, 'keys', 'server_pub'), 'w') as key_file:
+            key_file.write(make_keys('server')[1] + '\n')
+        self.setup_vars_path = os.path.join(self.root, 'setupVars.conf')
+        with open(self.setup_vars_path, 'w') as setup_file:
+            setup_file.write(SETUP_VARS)
+        self.client_config_dir = os.path.join(self.root, 'configs')
+        self.provisioner = WireGuardProvisioner(self.wireguard_dir, self.setup_vars_path,
+                                                self.client_config_dir, apply_live=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read_server_config(self):
+        with open(os.path.join(self.wireguard_dir, 'wg0.conf')) as server_file:
+            return server_file.read()
+
+    def remove_peer(self, name):
+        """
+        Removes a peer block from the server config the way 'pivpn remove' does.
+        """
+        lines = self.read_server_config().splitlines(keepends=True)
+        start = lines.index(f"### begin {name} ###\n")
+        end = lines.index(f"### end {name} ###\n")
+        with open(os.path.join(self.wireguard_dir, 'wg0.conf'), 'w') as server_file:
+            server_file.writelines(lines[:start] + lines[end + 1:])
+        clients_path = os.path.join(self.wireguard_dir, 'configs', 'clients.txt')
+        with open(clients_path) as clients_file:
+            clients = [line for line in clients_file if line.split()[0] != name]
+        with open(clients_path, 'w') as clients_file:
+            clients_file.writelines(clients)
+        # Make sure the mtime moves even on coarse-grained filesystems
+        stat = os.stat(os.path.join(self.wireguard_dir, 'wg0.conf'))
+        os.utime(os.path.join(self.wireguard_dir, 'wg0.conf'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_provision_writes_profile(self):
+        result = self.provisioner.provision('alice', make_keys('alice'))
+        self.assertTrue(result['success'], result['message'])
+        self.assertIn('Address = 10.6.0.2/24', result['config_data'])
+        self.assertIn('### begin alice ###', self.read_server_config())
+        self.assertTrue(os.path.isfile(os.path.join(self.client_config_dir, 'alice.conf')))
+
+    def test_removed_address_is_reused(self):
+        for name in ('alice', 'bob'):
+            self.assertTrue(self.provisioner.provision(name, make_keys(name))['success'])
+        self.remove_peer('bob')
+
+        result = self.provisioner.provision('carol', make_keys('carol'))
+        self.assertTrue(result['success'], result['message'])
+        self.assertIn('Address = 10.6.0.3/24', result['config_data'])
+
+    def test_outstanding_reservation_survives_rebuild(self):
+        self.assertTrue(self.provisioner.provision('alice', make_keys('alice'))['success'])
+        reserved = self.provisioner.allocate_address()
+        self.remove_peer('alice')
+
+        # The rebuilt allocator frees alice's address but keeps the reservation
+        self.assertEqual(str(self.provisioner.allocate_address()), '10.6.0.2')
+        self.assertNotEqual(self.provisioner.allocate_address(), reserved)
+
+    def test_taken_pooled_address_is_replaced(self):
+        pooled = self.provisioner.allocate_address()
+        # Another tool adds a peer with the pooled address behind our back
+        with open(os.path.join(self.wireguard_dir, 'wg0.conf'), 'a') as server_file:
+            server_file.write(f"[Peer]\nPublicKey = {make_keys('bob')[1]}\nAllowedIPs = {pooled}/32\n")
+        stat = os.stat(os.path.join(self.wireguard_dir, 'wg0.conf'))
+        os.utime(os.path.join(self.wireguard_dir, 'wg0.conf'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        result = self.provisioner.provision('alice', make_keys('alice'), pooled)
+        self.assertTrue(result['success'], result['message'])
+        self.assertNotIn(f"Address = {pooled}/24", result['config_data'])
+
+    def test_failed_provision_is_rolled_back(self):
+        server_config = self.read_server_config()
+        # Appending to clients.txt, the last step, fails
+        os.makedirs(os.path.join(self.wireguard_dir, 'configs', 'clients.txt'))
+
+        with mock.patch.object(self.provisioner, '_existing_clients', return_value=set()), \
+                mock.patch.object(self.provisioner, '_client_counts', return_value=[]):
+            result = self.provisioner.provision('alice', make_keys('alice'))
+        self.assertFalse(result['success'])
+        self.assertEqual(self.read_server_config(), server_config)
+        self.assertEqual(os.listdir(os.path.join(self.wireguard_dir, 'keys')), ['server_pub'])
+        self.assertEqual(os.listdir(os.path.join(self.wireguard_dir, 'configs')), ['clients.txt'])
+        self.assertEqual(os.listdir(self.client_config_dir), [])
+
+        # The retry succeeds and gets the same address
+        os.rmdir(os.path.join(self.wireguard_dir, 'configs', 'clients.txt'))
+        result = self.provisioner.provision('alice', make_keys('alice'))
+        self.assertTrue(result['success'], result['message'])
+        self.assertIn('Address = 10.6.0.2/24', result['config_data'])
+
+    def test_helper_provision_call(self):
+        server = PrivilegedHelperServer(os.path.join(self.root, 'helper.sock'))
+        server._provisioner = self.provisioner
+
+        address = server.call_provisioner('allocate_address', [])
+        result = server.call_provisioner('provision', ['alice', list(make_keys('alice')), address])
+        self.assertTrue(result['success'], result['message'])
+        self.assertIn(f"Address = {address}/24", result['config_data'])
+        with self.assertRaises(ValueError):
+            server.call_provisioner('provision', ['../etc', list(make_keys('eve')), None])
+
+    def test_clients_txt_matches_pivpn(self):
+        self.assertTrue(self.provisioner.provision('alice', make_keys('alice'))['success'])
+        with open(os.path.join(self.wireguard_dir, 'configs', 'clients.txt')) as clients_file:
+            fields = clients_file.read().split()
+        self.assertEqual(fields[0], 'alice')
+        self.assertEqual(fields[3], '2')
+
+    def test_pivpn_count_is_taken(self):
+        # A client added by 'pivpn add' whose peer block is not written yet
+        with open(os.path.join(self.wireguard_dir, 'configs', 'clients.txt'), 'w') as clients_file:
+            clients_file.write(f"bob {make_keys('bob')[1]} 1700000000 2\n")
+        result = self.provisioner.provision('alice', make_keys('alice'))
+        self.assertIn('Address = 10.6.0.3/24', result['config_data'])
+
+    def test_ipv6_address_appends_decimal_count(self):
+        with open(self.setup_vars_path, 'a') as setup_file:
+            setup_file.write("pivpnenableipv6=1\npivpnNETv6=fd11:5ee:bad:c0de::\nsubnetClassv6=64\n")
+        provisioner = WireGuardProvisioner(self.wireguard_dir, self.setup_vars_path,
+                                           self.client_config_dir, apply_live=False)
+        result = provisioner.provision('alice', make_keys('alice'), ipaddress.ip_address('10.6.0.10'))
+        self.assertIn('Address = 10.6.0.10/24, fd11:5ee:bad:c0de::10/64', result['config_data'])
+        self.assertIn('AllowedIPs = 10.6.0.10/32, fd11:5ee:bad:c0de::10/128', self.read_server_config())
+
+    def test_invalid_address_is_rejected(self):
+        for address in ('10.6.0.1', '10.7.0.5'):
+            result = self.provisioner.provision('alice', make_keys('alice'), ipaddress.ip_address(address))
+            self.assertFalse(result['success'])
+        self.assertNotIn('### begin alice ###', self.read_server_config())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,17 +2,69 @@
 
 import subprocess
 import os
+import csv
 import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from privileged_helper import run_privileged, HelperRefusedError
+from user_registry import UserRegistry
+from wireguard_provisioner import shared_provisioner
+from provisioning_pool import ProvisioningPool
+
+# 'pivpn add' edits the server config and reloads WireGuard, so concurrent
+# adds would race on address allocation. Raise only for a backend that allows it.
+PIVPN_ADD_CONCURRENCY = 1
+
+# The native backend serializes file updates itself and only overlaps key generation
+NATIVE_ADD_CONCURRENCY = 4
+
+# Number of clients passed to a single 'pivpn remove' invocation
+PIVPN_REMOVE_BATCH_SIZE = 25
 
 class UserManager:
     """
     Handles VPN user management tasks such as adding, listing, and removing users.
     """
 
+    # Shared by every UserManager so the pool is filled only once
+    _pool = None
+    _pool_lock = threading.Lock()
+
     def __init__(self):
         # Directory where VPN config files are stored
         self.config_dir = '/home/SMART/configs'  # Adjust this path as necessary
 
+        # 'pivpn' shells out to 'pivpn add'; 'native' provisions in-process
+        self.backend = os.environ.get('VPN_USER_BACKEND', 'pivpn')
+
+    @property
+    def provisioner(self):
+        """
+        The WireGuard provisioner used by the 'native' backend; it writes
+        through the privileged helper unless the app runs as root.
+        """
+        return shared_provisioner(self.config_dir)
+
+    @property
+    def pool(self):
+        """
+        The warm pool of pre-generated keys and addresses for the 'native' backend.
+        """
+        with UserManager._pool_lock:
+            if UserManager._pool is None:
+                UserManager._pool = ProvisioningPool(self.provisioner)
+                UserManager._pool.start()
+            return UserManager._pool
+
+    @property
+    def registry(self):
+        """
+        The shared, self-updating registry of users in config_dir.
+        """
+        return UserRegistry.shared(self.config_dir, self.list_users_from_pivpn)
+
     def add_user(self, username):
         """
         Adds a VPN user.
@@ -25,10 +77,21 @@ class UserManager:
                 'message': "Invalid username. It must be alphanumeric and between 3-16 characters."
             }
 
+        if self.backend == 'native':
+            # Bind the name to a pre-generated slot when one is ready
+            slot = self.pool.take()
+            keys, address = slot if slot else (None, None)
+            result = self.provisioner.provision(username, keys, address)
+            if result['success']:
+                self.registry.add(username)
+            elif address is not None:
+                self.provisioner.release_address(address)
+            return result
+
         try:
             # Add the VPN user using the PiVPN command
-            add_command = ['sudo', 'pivpn', 'add', '-n', username]
-            result = subprocess.run(add_command, capture_output=True, text=True)
+            add_command = ['pivpn', 'add', '-n', username]
+            result = run_privileged(add_command)
 
             if result.returncode != 0:
                 logging.error(f"Error adding user '{username}': {result.stderr}")
@@ -38,19 +101,110 @@ class UserManager:
                 }
 
             # User added successfully
+            self.registry.add(username)
             logging.info(f"User '{username}' added successfully.")
             return {
                 'success': True,
                 'message': f"User '{username}' added successfully."
             }
 
-        except subprocess.CalledProcessError as e:
+        except (subprocess.SubprocessError, HelperRefusedError) as e:
             logging.exception(f"Error while adding user '{username}'.")
             return {
                 'success': False,
                 'message': f"An error occurred while adding the user '{username}'."
             }
 
+    def add_users(self, usernames, progress_callback=None):
+        """
+        Adds several VPN users.
+
+        Every name is validated before anything is provisioned; if any name is
+        invalid, duplicated or already a known user nothing is added. PiVPN allocates addresses and
+        rewrites the server config on every 'pivpn add', so users are
+        provisioned up to PIVPN_ADD_CONCURRENCY at a time (one by default);
+        the native backend allows NATIVE_ADD_CONCURRENCY.
+        `progress_callback(done, total, username, result)` is called after each user.
+        Returns a dictionary with success status, message and per-user results.
+        """
+        usernames = [username.strip() for username in usernames if username and username.strip()]
+        invalid = [username for username in usernames if not self.validate_username(username)]
+        duplicates = sorted(username for username, count in Counter(usernames).items() if count > 1)
+        existing = sorted(set(usernames) & set(self.registry.users())) if usernames else []
+        if not usernames or invalid or duplicates or existing:
+            problems = []
+            if not usernames:
+                problems.append("No usernames given.")
+            if invalid:
+                problems.append(f"Invalid usernames: {', '.join(invalid)}.")
+            if duplicates:
+                problems.append(f"Duplicate usernames: {', '.join(duplicates)}.")
+            if existing:
+                problems.append(f"Users already exist: {', '.join(existing)}.")
+            return {
+                'success': False,
+                'message': ' '.join(problems),
+                'results': {}
+            }
+
+        results = {}
+        total = len(usernames)
+        max_workers = NATIVE_ADD_CONCURRENCY if self.backend == 'native' else PIVPN_ADD_CONCURRENCY
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.add_user, username): username for username in usernames}
+            for future in as_completed(futures):
+                username = futures[future]
+                results[username] = future.result()
+                if progress_callback:
+                    progress_callback(len(results), total, username, results[username])
+
+        failed = [username for username in usernames if not results[username]['success']]
+        added = total - len(failed)
+        message = f"Added {added} of {total} VPN users."
+        if failed:
+            message += f" Failed: {', '.join(failed)}."
+        logging.info(message)
+        return {
+            'success': not failed,
+            'message': message,
+            'results': results
+        }
+
+    def add_users_from_csv(self, csv_path, progress_callback=None):
+        """
+        Adds the VPN users listed in the first column of a CSV file.
+        A 'username' header row, blank rows and rows starting with '#' are skipped.
+        """
+        try:
+            with open(csv_path, 'r', newline='') as csv_file:
+                usernames = [
+                    row[0].strip() for row in csv.reader(csv_file)
+                    if row and row[0].strip() and not row[0].strip().startswith('#')
+                ]
+        except OSError as e:
+            logging.error(f"Error reading user CSV '{csv_path}': {e}")
+            return {
+                'success': False,
+                'message': f"Could not read '{csv_path}'.",
+                'results': {}
+            }
+
+        if usernames and usernames[0].lower() == 'username':
+            usernames = usernames[1:]
+        return self.add_users(usernames, progress_callback)
+
+    def read_user_config(self, username):
+        """
+        Returns the contents of a user's VPN config file, or None if it does not exist.
+        """
+        config_file_path = os.path.join(self.config_dir, f"{username}.conf")
+        try:
+            with open(config_file_path, 'r') as config_file:
+                return config_file.read()
+        except OSError:
+            logging.error(f"Config file for user '{username}' not found.")
+            return None
+
     def validate_username(self, username):
         """
         Validates the VPN username. Must be alphanumeric and between 3-16 characters.
@@ -59,13 +213,20 @@ class UserManager:
 
     def list_users(self):
         """
-        Lists all existing VPN users.
+        Lists all existing VPN users from the in-memory registry.
+        Returns a list of usernames.
+        """
+        return self.registry.users()
+
+    def list_users_from_pivpn(self):
+        """
+        Lists all existing VPN users by running 'pivpn list'.
         Returns a list of usernames.
         """
         try:
             # List users using PiVPN
-            list_command = ['sudo', 'pivpn', 'list']
-            result = subprocess.run(list_command, capture_output=True, text=True)
+            list_command = ['pivpn', 'list']
+            result = run_privileged(list_command)
 
             if result.returncode != 0:
                 logging.error(f"Error listing users: {result.stderr}")
@@ -76,6 +237,9 @@ class UserManager:
                 # Adjust parsing based on the output format of 'pivpn list'
                 if line.strip() and not line.startswith(':::'):
                     parts = line.strip().split()
+                    # Skip the 'Client  Public key  Creation date' column header
+                    if parts[:2] == ['Client', 'Public']:
+                        continue
                     if parts:
                         username = parts[0]
                         users.append(username)
@@ -85,38 +249,99 @@ class UserManager:
             logging.exception("An error occurred while listing users.")
             return []
 
-    def remove_all_users(self):
+    def remove_all_users(self, progress_callback=None):
         """
         Removes all VPN users.
-        Returns a dictionary with success status and message.
+        `progress_callback(done, total)` is called as users are removed.
+        Returns a dictionary with success status, message and per-user results.
         """
         try:
             users = self.list_users()
             if not users:
                 return {
                     'success': True,
-                    'message': "No VPN users found to remove."
+                    'message': "No VPN users found to remove.",
+                    'results': {}
                 }
 
-            # Remove each user
-            for username in users:
-                remove_command = ['sudo', 'pivpn', 'remove', '-y', username]
-                result = subprocess.run(remove_command, capture_output=True, text=True)
-                if result.returncode != 0:
-                    logging.error(f"Error removing user '{username}': {result.stderr}")
-                    # Continue removing other users even if one fails
-                    continue
-                else:
-                    logging.debug(f"User '{username}' removed successfully.")
-
-            return {
-                'success': True,
-                'message': "All VPN users have been removed successfully."
-            }
+            return self.remove_users(users, progress_callback)
 
         except Exception as e:
             logging.exception("An unexpected error occurred while removing all users.")
             return {
                 'success': False,
-                'message': f"An unexpected error occurred: {str(e)}"
+                'message': f"An unexpected error occurred: {str(e)}",
+                'results': {}
             }
+
+    def remove_users(self, usernames, progress_callback=None):
+        """
+        Removes the given VPN users.
+
+        'pivpn remove' accepts several clients at once, so users are removed in
+        batches of PIVPN_REMOVE_BATCH_SIZE with one invocation per batch. Batches
+        run one after another because every removal rewrites the server config.
+        `progress_callback(done, total)` is called after each batch.
+        Returns a dictionary with success status, message and per-user results.
+        """
+        results = {}
+        total = len(usernames)
+        for start in range(0, total, PIVPN_REMOVE_BATCH_SIZE):
+            results.update(self._remove_batch(usernames[start:start + PIVPN_REMOVE_BATCH_SIZE]))
+            if progress_callback:
+                progress_callback(len(results), total)
+
+        failed = [username for username in usernames if not results[username]]
+        if failed:
+            message = f"Removed {total - len(failed)} of {total} VPN users. Failed: {', '.join(failed)}."
+        else:
+            message = "All VPN users have been removed successfully."
+        logging.info(message)
+        return {
+            'success': not failed,
+            'message': message,
+            'results': results
+        }
+
+    def _remove_batch(self, usernames):
+        """
+        Removes a batch of users with a single 'pivpn remove' call.
+        Returns a dictionary mapping each username to True if it was removed.
+        """
+        remove_command = ['pivpn', 'remove', '-y'] + list(usernames)
+        try:
+            result = run_privileged(remove_command, timeout=30 + 5 * len(usernames))
+        except (subprocess.SubprocessError, HelperRefusedError) as e:
+            logging.error(f"Error removing users {usernames}: {e}")
+            result = None
+
+        if result is not None and result.returncode == 0:
+            logging.debug(f"Users {usernames} removed successfully.")
+            for username in usernames:
+                self.registry.discard(username)
+            return {username: True for username in usernames}
+
+        if len(usernames) == 1:
+            if result is not None:
+                logging.error(f"Error removing user '{usernames[0]}': {result.stderr}")
+            return {usernames[0]: False}
+
+        # The batch failed part way; retry every user on its own to find out
+        # which ones could not be removed. A missing config file proves
+        # nothing, as some users are only known to 'pivpn list'.
+        outcome = {}
+        for username in usernames:
+            outcome.update(self._remove_batch([username]))
+
+        failed = [username for username, removed in outcome.items() if not removed]
+        if failed:
+            # A retry fails for users the batch did remove; 'pivpn list' tells them apart.
+            # An empty list may be an error, so it proves nothing either.
+            remaining = set(self.list_users_from_pivpn())
+            if remaining:
+                for username in failed:
+                    if (username not in remaining
+                            and not os.path.exists(os.path.join(self.config_dir, f"{username}.conf"))):
+                        self.registry.discard(username)
+                        outcome[username] = True
+        return outcome
@@ -0,0 +1,139 @@
+# user_registry.py
+
+import os
+import time
+import threading
+import logging
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Optional; fall back to polling the directory mtime
+    INotify = None
+
+
+class UserRegistry:
+    """
+    In-memory list of VPN users, kept up to date without forking 'pivpn list'.
+
+    The registry is seeded once from the client configs in `config_dir` and the
+    output of `loader` (normally 'pivpn list'). A watcher thread then follows
+    the config directory, with inotify when inotify_simple is installed and an
+    mtime scan otherwise, so users added or removed outside the app show up
+    within `poll_interval` seconds. UserManager writes its own changes through
+    with add() and discard().
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, config_dir, loader=None, poll_interval=0.5):
+        self.config_dir = config_dir
+        self.loader = loader
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._file_users = set()
+        self._listed_users = set()
+        self._dir_mtime = None
+        self._loaded = False
+        self._watcher = None
+
+    @classmethod
+    def shared(cls, config_dir, loader=None):
+        """
+        Returns the process-wide registry for a config directory.
+        """
+        with cls._shared_lock:
+            registry = cls._shared.get(config_dir)
+            if registry is None:
+                registry = cls._shared[config_dir] = cls(config_dir, loader)
+            return registry
+
+    def users(self):
+        """
+        Returns the sorted list of known usernames.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return sorted(self._file_users | self._listed_users)
+
+    def add(self, username):
+        """
+        Records a user added by the app.
+        """
+        with self._lock:
+            # Tracked like a listed user until its config file shows up, so a
+            # rescan that happens before PiVPN copies the file does not drop it
+            self._listed_users.add(username)
+
+    def discard(self, username):
+        """
+        Forgets a user removed by the app.
+        """
+        with self._lock:
+            self._file_users.discard(username)
+            self._listed_users.discard(username)
+
+    def _ensure_loaded(self):
+        """
+        Builds the registry on first use and starts the watcher.
+        """
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            listed = set(self.loader()) if self.loader else set()
+            self._listed_users = listed
+            self._rescan_locked()
+            self._loaded = True
+            logging.debug(f"User registry loaded with {len(self._file_users | listed)} users.")
+
+        self._watcher = threading.Thread(target=self._watch, name='UserRegistryWatcher', daemon=True)
+        self._watcher.start()
+
+    def _rescan_locked(self):
+        """
+        Re-reads the client config file names. Must hold the lock.
+        """
+        try:
+            self._dir_mtime = os.stat(self.config_dir).st_mtime_ns
+            with os.scandir(self.config_dir) as entries:
+                file_users = {entry.name[:-len('.conf')] for entry in entries if entry.name.endswith('.conf')}
+        except OSError as e:
+            logging.debug(f"Could not scan VPN config directory {self.config_dir}: {e}")
+            return
+
+        # A config file that disappeared means the user was removed
+        removed = self._file_users - file_users
+        self._listed_users -= removed
+        self._file_users = file_users
+
+    def _watch(self):
+        if INotify is not None:
+            try:
+                self._watch_inotify()
+                return
+            except OSError as e:
+                logging.debug(f"inotify unavailable for {self.config_dir}, polling instead: {e}")
+        self._watch_mtime()
+
+    def _watch_inotify(self):
+        inotify = INotify()
+        inotify.add_watch(self.config_dir, flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM)
+        while True:
+            if inotify.read(timeout=int(self.poll_interval * 1000), read_delay=50):
+                with self._lock:
+                    self._rescan_locked()
+
+    def _watch_mtime(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                mtime = os.stat(self.config_dir).st_mtime_ns
+            except OSError:
+                continue
+            # Adding or removing a file changes the directory mtime
+            if mtime != self._dir_mtime:
+                with self._lock:
+                    self._rescan_locked()
@@ -0,0 +1,268 @@
+# vpn_history.py
+
+import os
+import queue
+import sqlite3
+import threading
+import logging
+import time
+
+# Rollup resolutions in seconds and how long each level is kept
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+
+# Seconds between history samples while no screen is polling the VPN status
+VPN_HISTORY_INTERVAL = float(os.environ.get('VPN_HISTORY_INTERVAL', 60))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS peers (
+    id INTEGER PRIMARY KEY,
+    interface TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    UNIQUE (interface, public_key)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    peer_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    latest_handshake INTEGER NOT NULL,
+    transfer_rx INTEGER NOT NULL,
+    transfer_tx INTEGER NOT NULL,
+    PRIMARY KEY (peer_id, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_minute (
+    peer_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    latest_handshake INTEGER NOT NULL,
+    rx_bytes INTEGER NOT NULL,
+    tx_bytes INTEGER NOT NULL,
+    PRIMARY KEY (peer_id, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_hour (
+    peer_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    latest_handshake INTEGER NOT NULL,
+    rx_bytes INTEGER NOT NULL,
+    tx_bytes INTEGER NOT NULL,
+    PRIMARY KEY (peer_id, bucket)
+) WITHOUT ROWID;
+"""
+
+ROLLUP_UPSERT = """
+INSERT INTO {table} (peer_id, bucket, samples, latest_handshake, rx_bytes, tx_bytes)
+VALUES (?, ?, 1, ?, ?, ?)
+ON CONFLICT (peer_id, bucket) DO UPDATE SET
+    samples = samples + 1,
+    latest_handshake = MAX(latest_handshake, excluded.latest_handshake),
+    rx_bytes = rx_bytes + excluded.rx_bytes,
+    tx_bytes = tx_bytes + excluded.tx_bytes
+"""
+
+RESOLUTIONS = {
+    'raw': 'samples',
+    'minute': 'rollup_minute',
+    'hour': 'rollup_hour',
+}
+
+
+class VPNHistoryStore:
+    """
+    Append-only SQLite history of VPN peer handshakes and transfer counters.
+
+    record() only queues the snapshot, so it is safe to call from the poll
+    loop. A writer thread inserts queued snapshots in batches and keeps
+    per-minute and per-hour rollups of transferred bytes up to date as it goes.
+    Each level is pruned to its own retention limit. Peers that have not been
+    seen for `peer_timeout` seconds are forgotten by the writer, so their next
+    sample starts a new counter baseline.
+    """
+
+    def __init__(self, db_path=None, flush_interval=10.0, max_pending=1000,
+                 raw_retention=2 * DAY, minute_retention=14 * DAY, hour_retention=365 * DAY, peer_timeout=HOUR):
+        self.db_path = db_path or os.environ.get('VPN_HISTORY_DB', '/home/SMART/vpn_history.db')
+        self.flush_interval = flush_interval
+        self.peer_timeout = peer_timeout
+        self.retention = {
+            'samples': raw_retention,
+            'rollup_minute': minute_retention,
+            'rollup_hour': hour_retention,
+        }
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._read_lock = threading.Lock()
+        self._read_conn = None
+        self._peer_ids = {}
+        # Peer id -> (latest_handshake, transfer_rx, transfer_tx, last seen)
+        self._last_counters = {}
+        self._last_prune = 0.0
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name='VPNHistoryWriter', daemon=True)
+        self._writer.start()
+
+    def record(self, snapshot, timestamp=None):
+        """
+        Queues a snapshot of WireGuardPeer records for writing. Never blocks;
+        the snapshot is dropped with a warning if the writer has fallen behind.
+        """
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        rows = [(peer.interface, peer.public_key, peer.latest_handshake, peer.transfer_rx, peer.transfer_tx)
+                for peer in snapshot]
+        try:
+            self._queue.put_nowait((timestamp, rows))
+        except queue.Full:
+            logging.warning("VPN history writer is behind; dropping a snapshot.")
+
+    def query(self, public_key, start, end, resolution='hour', interface=None):
+        """
+        Returns the history of one peer between the `start` and `end` Unix times.
+
+        For 'raw' each row is (ts, latest_handshake, transfer_rx, transfer_tx)
+        with cumulative counters. For 'minute' and 'hour' each row is
+        (bucket, samples, latest_handshake, rx_bytes, tx_bytes) with the bytes
+        transferred during that bucket.
+        """
+        table = RESOLUTIONS[resolution]
+        time_column = 'ts' if table == 'samples' else 'bucket'
+        columns = ('ts, latest_handshake, transfer_rx, transfer_tx' if table == 'samples'
+                   else 'bucket, samples, latest_handshake, rx_bytes, tx_bytes')
+        peer_filter = 'public_key = ?' + (' AND interface = ?' if interface else '')
+        params = [public_key] + ([interface] if interface else [])
+
+        sql = (f"SELECT {columns} FROM {table} "
+               f"WHERE peer_id IN (SELECT id FROM peers WHERE {peer_filter}) "
+               f"AND {time_column} >= ? AND {time_column} < ? ORDER BY {time_column}")
+        with self._read_lock:
+            if self._read_conn is None:
+                self._read_conn = self._connect()
+            return self._read_conn.execute(sql, params + [start, end]).fetchall()
+
+    def summarize(self, start, end, resolution='hour'):
+        """
+        Returns per-peer activity between `start` and `end` as a list of
+        (interface, public_key, latest_handshake, rx_bytes, tx_bytes) tuples,
+        ordered by total bytes transferred.
+        """
+        table = RESOLUTIONS[resolution]
+        if table == 'samples':
+            raise ValueError("summarize() works on 'minute' or 'hour' rollups.")
+        sql = (f"SELECT p.interface, p.public_key, MAX(r.latest_handshake), SUM(r.rx_bytes), SUM(r.tx_bytes) "
+               f"FROM {table} r JOIN peers p ON p.id = r.peer_id "
+               f"WHERE r.bucket >= ? AND r.bucket < ? "
+               f"GROUP BY r.peer_id ORDER BY SUM(r.rx_bytes) + SUM(r.tx_bytes) DESC")
+        with self._read_lock:
+            if self._read_conn is None:
+                self._read_conn = self._connect()
+            return self._read_conn.execute(sql, (start, end)).fetchall()
+
+    def close(self):
+        """
+        Flushes pending snapshots and stops the writer thread.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        with self._read_lock:
+            if self._read_conn is not None:
+                self._read_conn.close()
+                self._read_conn = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            for row in conn.execute('SELECT interface, public_key, id FROM peers'):
+                self._peer_ids[(row[0], row[1])] = row[2]
+
+            while True:
+                batch = [self._queue.get()]
+                # Gather everything that piled up, waiting up to flush_interval for more
+                deadline = time.monotonic() + self.flush_interval
+                while batch[-1] is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+
+                stopping = batch[-1] is None
+                snapshots = [item for item in batch if item is not None]
+                if snapshots:
+                    try:
+                        self._write_batch(conn, snapshots)
+                    except sqlite3.Error:
+                        logging.exception("Error writing VPN history.")
+                if stopping:
+                    return
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, snapshots):
+        """
+        Inserts a batch of snapshots and updates the rollups in one transaction.
+        Peer ids and counters are only cached once the transaction committed,
+        so a failed batch does not leave ids of rolled-back peers behind.
+        """
+        samples = []
+        minute_rows = []
+        hour_rows = []
+        peer_ids = {}
+        counters = {}
+        with conn:
+            for timestamp, rows in snapshots:
+                for interface, public_key, handshake, rx, tx in rows:
+                    key = (interface, public_key)
+                    peer_id = peer_ids.get(key, self._peer_ids.get(key))
+                    if peer_id is None:
+                        conn.execute('INSERT OR IGNORE INTO peers (interface, public_key) VALUES (?, ?)', key)
+                        peer_id = conn.execute('SELECT id FROM peers WHERE interface = ? AND public_key = ?',
+                                               key).fetchone()[0]
+                        peer_ids[key] = peer_id
+
+                    last = counters.get(peer_id, self._last_counters.get(peer_id))
+                    counters[peer_id] = (handshake, rx, tx, timestamp)
+                    if last is not None and last[:3] == (handshake, rx, tx):
+                        # Nothing happened since the previous sample; keep the table compact
+                        continue
+
+                    if last is None:
+                        rx_bytes = tx_bytes = 0
+                    else:
+                        # Counters going backwards means the interface restarted
+                        rx_bytes = rx - last[1] if rx >= last[1] else rx
+                        tx_bytes = tx - last[2] if tx >= last[2] else tx
+
+                    samples.append((peer_id, timestamp, handshake, rx, tx))
+                    minute_rows.append((peer_id, timestamp - timestamp % MINUTE, handshake, rx_bytes, tx_bytes))
+                    hour_rows.append((peer_id, timestamp - timestamp % HOUR, handshake, rx_bytes, tx_bytes))
+
+            conn.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)', samples)
+            conn.executemany(ROLLUP_UPSERT.format(table='rollup_minute'), minute_rows)
+            conn.executemany(ROLLUP_UPSERT.format(table='rollup_hour'), hour_rows)
+
+            now = snapshots[-1][0]
+            prune = now - self._last_prune >= HOUR
+            if prune:
+                for table, retention in self.retention.items():
+                    column = 'ts' if table == 'samples' else 'bucket'
+                    conn.execute(f'DELETE FROM {table} WHERE {column} < ?', (now - retention,))
+
+        self._peer_ids.update(peer_ids)
+        self._last_counters.update(counters)
+        if prune:
+            self._last_prune = now
+            # Forget peers that disappeared, e.g. removed users
+            self._last_counters = {peer_id: last for peer_id, last in self._last_counters.items()
+                                   if now - last[3] <= self.peer_timeout}
+        logging.debug(f"Wrote {len(samples)} VPN history samples from {len(snapshots)} snapshots.")
@@ -0,0 +1,104 @@
+# vpn_peer_delta.py
+
+import logging
+
+# Bit flags for the per-field change mask of a changed peer
+ENDPOINT = 1 << 0
+ALLOWED_IPS = 1 << 1
+LATEST_HANDSHAKE = 1 << 2
+TRANSFER_RX = 1 << 3
+TRANSFER_TX = 1 << 4
+IP_ADDRESS = 1 << 5
+
+# Peer fields that are compared between snapshots, with their mask bit
+TRACKED_FIELDS = (
+    ('endpoint', ENDPOINT),
+    ('allowed_ips', ALLOWED_IPS),
+    ('latest_handshake', LATEST_HANDSHAKE),
+    ('transfer_rx', TRANSFER_RX),
+    ('transfer_tx', TRANSFER_TX),
+    ('ip_address', IP_ADDRESS),
+)
+
+
+def peer_key(peer):
+    """
+    Returns the identity of a peer across snapshots.
+    """
+    return (peer.interface, peer.public_key)
+
+
+class PeerDelta:
+    """
+    The difference between two consecutive WireGuard peer snapshots.
+
+    `added` and `changed` map peer keys to the new peer, `removed` maps peer keys
+    to the last known peer, and `masks` maps every changed key to the bitwise OR
+    of the fields that differ.
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.changed = {}
+        self.masks = {}
+
+    def is_empty(self):
+        """
+        Returns True if nothing changed between the two snapshots.
+        """
+        return not (self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return (f"PeerDelta(added={len(self.added)}, removed={len(self.removed)}, "
+                f"changed={len(self.changed)})")
+
+
+class PeerDiffer:
+    """
+    Compares consecutive snapshots from VPNStatusChecker and reports only the
+    peers that were added, removed or changed since the previous call.
+    """
+
+    def __init__(self, fields=TRACKED_FIELDS):
+        self.fields = fields
+        self.peers = {}
+
+    def update(self, snapshot):
+        """
+        Records a new snapshot and returns the PeerDelta against the previous one.
+        """
+        delta = PeerDelta()
+        previous = self.peers
+        current = {}
+
+        for peer in snapshot:
+            key = peer_key(peer)
+            current[key] = peer
+            old = previous.get(key)
+            if old is None:
+                delta.added[key] = peer
+            elif old is not peer:
+                mask = 0
+                for field, bit in self.fields:
+                    if getattr(old, field) != getattr(peer, field):
+                        mask |= bit
+                if mask:
+                    delta.changed[key] = peer
+                    delta.masks[key] = mask
+
+        if len(current) != len(previous) or delta.added:
+            for key, peer in previous.items():
+                if key not in current:
+                    delta.removed[key] = peer
+
+        self.peers = current
+        if not delta.is_empty():
+            logging.debug(f"VPN peer delta: {delta}")
+        return delta
+
+    def reset(self):
+        """
+        Forgets the previous snapshot so the next update reports every peer as added.
+        """
+        self.peers = {}
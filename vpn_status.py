@@ -2,65 +2,382 @@
 
 import subprocess
 import logging
-import re
+import ipaddress
+import os
+import signal
+import threading
+import time
 from datetime import datetime
 
+import privileged_helper
+from privileged_helper import run_privileged
+
+# Machine-readable listing of every WireGuard interface and peer
+WG_DUMP_COMMAND = ['sudo', 'wg', 'show', 'all', 'dump']
+
 class VPNStatusChecker:
     """
     Checks the status of VPN connections and clients using WireGuard commands.
+    Results are served from the shared VPNSnapshotService so that every caller
+    reuses the same 'wg show' output instead of forking its own copy.
     """
 
+    def __init__(self, snapshot_service=None, wg_command=None, timeout=10):
+        self.snapshot_service = snapshot_service or VPNSnapshotService.shared()
+        # Command producing the dump; overridable so a fake 'wg' can be used
+        self.wg_command = wg_command or WG_DUMP_COMMAND
+        self.timeout = timeout
+        # Maps allowed_ips strings to their already-parsed primary address
+        self._ip_cache = {}
+
     def get_active_vpn_clients(self):
+        """
+        Retrieves the list of active VPN clients from the latest shared snapshot.
+        Returns a list of WireGuardPeer records.
+        """
+        return self.snapshot_service.get_snapshot()
+
+    def fetch_active_vpn_clients(self):
         """
         Retrieves the list of active VPN clients by parsing the output of 'wg show'.
-        Returns a list of dictionaries containing peer information.
+        Always runs the command; use get_active_vpn_clients() for cached results.
+        Returns a list of WireGuardPeer records, or None if 'wg' failed, so
+        the snapshot service keeps the last good snapshot.
         """
         try:
-            # Execute the 'wg show' command to get the current status
-            result = subprocess.run(['sudo', 'wg', 'show', 'all', 'dump'], capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                logging.error(f"Error executing 'wg show': {result.stderr}")
-                return []
-
-            active_clients = []
-            # The 'wg show all dump' provides a machine-readable output
-            # Format: interface, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx
-            for line_number, line in enumerate(result.stdout.splitlines(), start=1):
-                parts = line.strip().split('\t')
-                
-                if len(parts) < 8:
-                    logging.warning(f"Line {line_number}: Expected at least 8 fields, got {len(parts)}. Line content: {line}")
-                    continue
-                
-                # Safely unpack the first 8 fields, ignoring any extra fields
-                interface, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx = parts[:8]
-
-                # Extract the IP address from allowed_ips (assuming the first IP is primary)
-                ip_match = re.search(r'(\d{1,3}\.){3}\d{1,3}', allowed_ips)
-                ip_address = ip_match.group() if ip_match else "Unknown"
-
-                # Convert latest_handshake from Unix timestamp to readable format
-                if latest_handshake.isdigit() and int(latest_handshake) > 0:
-                    handshake_time = datetime.fromtimestamp(int(latest_handshake)).strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    handshake_time = "Never"
-
-                client_info = {
-                    'interface': interface,
-                    'public_key': public_key,
-                    'endpoint': endpoint,
-                    'allowed_ips': allowed_ips,
-                    'latest_handshake': handshake_time,
-                    'transfer_rx': transfer_rx,
-                    'transfer_tx': transfer_tx,
-                    'ip_address': ip_address
-                }
-                active_clients.append(client_info)
-
-            logging.debug(f"Active VPN clients: {active_clients}")
+            if self.wg_command is WG_DUMP_COMMAND and privileged_helper.is_available():
+                # The helper already runs 'wg' as root; no sudo fork needed
+                result = run_privileged(WG_DUMP_COMMAND[1:], timeout=self.timeout, check=True)
+                active_clients = list(self.iter_dump(result.stdout.splitlines()))
+            else:
+                active_clients = list(self.iter_active_vpn_clients())
+            self._trim_ip_cache(active_clients)
+            logging.debug(f"Active VPN clients: {len(active_clients)} peers")
             return active_clients
 
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error executing 'wg show': {e.stderr}")
+            return None
+        except subprocess.TimeoutExpired:
+            logging.error(f"'wg show' did not finish within {self.timeout} seconds.")
+            return None
         except Exception as e:
             logging.exception("An error occurred while fetching active VPN clients.")
-            return []
+            return None
+
+    def iter_active_vpn_clients(self, timeout=None):
+        """
+        Runs 'wg show all dump' and yields WireGuardPeer records line by line as
+        the output arrives, without buffering the whole peer table.
+
+        The process is killed if it runs longer than `timeout` seconds or if the
+        caller stops iterating early. Raises subprocess.TimeoutExpired or
+        subprocess.CalledProcessError once the output is exhausted if the
+        command timed out or failed.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        process = subprocess.Popen(
+            self.wg_command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True
+        )
+        timed_out = threading.Event()
+
+        def kill_on_timeout():
+            timed_out.set()
+            kill_process_group(process)
+
+        watchdog = threading.Timer(timeout, kill_on_timeout)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            yield from self.iter_dump(process.stdout)
+            process.wait()
+        finally:
+            watchdog.cancel()
+            killed = process.poll() is None or timed_out.is_set()
+            if killed:
+                kill_process_group(process)
+            process.stdout.close()
+            # Reading stderr of a killed process could block on its children
+            stderr = '' if killed else process.stderr.read()
+            process.stderr.close()
+            process.wait()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(self.wg_command, timeout, stderr=stderr)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, self.wg_command, stderr=stderr)
+
+    def parse_dump(self, lines):
+        """
+        Parses the lines of 'wg show all dump' into a list of WireGuardPeer records.
+        """
+        active_clients = list(self.iter_dump(lines))
+        self._trim_ip_cache(active_clients)
+        return active_clients
+
+    def iter_dump(self, lines):
+        """
+        Parses the lines of 'wg show all dump', yielding a WireGuardPeer per peer line.
+        """
+        ip_cache = self._ip_cache
+        # The 'wg show all dump' provides a machine-readable output
+        # Format: interface, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx
+        for line_number, line in enumerate(lines, start=1):
+            parts = line.strip().split('\t')
+
+            if len(parts) < 8:
+                # Interface lines carry 5 fields (interface, keys, port, fwmark)
+                if len(parts) != 5:
+                    logging.warning(f"Line {line_number}: Expected at least 8 fields, got {len(parts)}. Line content: {line}")
+                continue
+
+            # Safely unpack the first 8 fields, ignoring any extra fields
+            interface, public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx = parts[:8]
+
+            # The primary IP only changes when allowed_ips does, so parse it once
+            ip_address = ip_cache.get(allowed_ips)
+            if ip_address is None:
+                ip_address = ip_cache[allowed_ips] = primary_ip_address(allowed_ips)
+
+            yield WireGuardPeer(
+                interface,
+                public_key,
+                endpoint,
+                allowed_ips,
+                int(latest_handshake) if latest_handshake.isdigit() else 0,
+                int(transfer_rx) if transfer_rx.isdigit() else 0,
+                int(transfer_tx) if transfer_tx.isdigit() else 0,
+                ip_address
+            )
+
+    def _trim_ip_cache(self, active_clients):
+        """
+        Forgets addresses of peers that went away so the cache stays bounded.
+        """
+        if len(self._ip_cache) > 2 * len(active_clients) + 64:
+            live = {peer.allowed_ips for peer in active_clients}
+            self._ip_cache = {key: value for key, value in self._ip_cache.items() if key in live}
+
+
+def kill_process_group(process):
+    """
+    Kills a process started with start_new_session=True together with its children.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def primary_ip_address(allowed_ips):
+    """
+    Returns the first address in a WireGuard allowed_ips list, or "Unknown".
+    """
+    for entry in allowed_ips.split(','):
+        try:
+            return str(ipaddress.ip_interface(entry.strip()).ip)
+        except ValueError:
+            continue
+    return "Unknown"
+
+
+class WireGuardPeer:
+    """
+    A single peer from 'wg show all dump'.
+
+    Handshake time and byte counters are kept as raw integers; the handshake is
+    only formatted for display when handshake_time is read.
+    """
+
+    __slots__ = ('interface', 'public_key', 'endpoint', 'allowed_ips',
+                 'latest_handshake', 'transfer_rx', 'transfer_tx', 'ip_address')
+
+    def __init__(self, interface, public_key, endpoint, allowed_ips,
+                 latest_handshake, transfer_rx, transfer_tx, ip_address):
+        self.interface = interface
+        self.public_key = public_key
+        self.endpoint = endpoint
+        self.allowed_ips = allowed_ips
+        self.latest_handshake = latest_handshake
+        self.transfer_rx = transfer_rx
+        self.transfer_tx = transfer_tx
+        self.ip_address = ip_address
+
+    @property
+    def handshake_time(self):
+        """
+        The latest handshake as a readable local time, or "Never".
+        """
+        if self.latest_handshake > 0:
+            return datetime.fromtimestamp(self.latest_handshake).strftime('%Y-%m-%d %H:%M:%S')
+        return "Never"
+
+    def __repr__(self):
+        return f"WireGuardPeer({self.interface}, {self.public_key}, {self.ip_address})"
+
+
+class VPNSnapshotService:
+    """
+    Long-lived owner of the 'wg show all dump' subprocess.
+
+    A background poller refreshes the parsed snapshot every `ttl` seconds while
+    there are callers, and every caller is served from memory. Callers that
+    arrive while a fetch is already running wait for that fetch instead of
+    starting another one. The poller stops after `idle_timeout` seconds without
+    callers, unless a keep-alive listener is registered, and is restarted
+    transparently on the next request. Keep-alive listeners set their own,
+    usually coarser, polling interval for the time without callers.
+    """
+
+    _shared_instance = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, ttl=5.0, idle_timeout=30.0, fetcher=None):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.fetcher = fetcher or VPNStatusChecker(snapshot_service=self).fetch_active_vpn_clients
+
+        self._condition = threading.Condition()
+        self._snapshot = []
+        # Wall-clock time for callers and listeners; monotonic time for ages
+        self._snapshot_time = None
+        self._snapshot_monotonic = None
+        self._fetching = False
+        self._last_request = 0.0
+        self._poller = None
+        self._stopped = False
+        self._listeners = []
+        # Keep-alive listener -> polling interval in seconds while idle
+        self._keep_alive = {}
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the process-wide snapshot service, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared_instance is None:
+                cls._shared_instance = cls()
+            return cls._shared_instance
+
+    def get_snapshot(self, max_age=None):
+        """
+        Returns the latest list of peers, fetching a new one only if the cached
+        snapshot is older than `max_age` (defaults to the service TTL).
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._condition:
+            self._last_request = time.monotonic()
+            self._ensure_poller()
+            while True:
+                if self._is_fresh(max_age):
+                    return self._snapshot
+                if not self._fetching:
+                    break
+                # Another caller is already fetching; share its result
+                self._condition.wait()
+            self._fetching = True
+
+        return self._fetch()
+
+    def get_snapshot_time(self):
+        """
+        Returns the wall-clock time of the latest snapshot, or None if none was taken yet.
+        """
+        with self._condition:
+            return self._snapshot_time
+
+    def add_listener(self, callback, keep_alive=False, interval=None):
+        """
+        Registers a callback invoked as callback(snapshot, timestamp) after every
+        successful fetch. Callbacks run on the fetching thread. A keep-alive
+        listener keeps the poller running even when nobody calls get_snapshot(),
+        fetching every `interval` seconds (the TTL by default) in that time.
+        """
+        with self._condition:
+            self._listeners.append(callback)
+            if keep_alive:
+                self._keep_alive[callback] = interval if interval is not None else self.ttl
+                self._ensure_poller()
+
+    def remove_listener(self, callback):
+        """
+        Unregisters a callback added with add_listener().
+        """
+        with self._condition:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+            self._keep_alive.pop(callback, None)
+
+    def stop(self):
+        """
+        Stops the background poller.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _is_fresh(self, max_age):
+        return self._snapshot_monotonic is not None and time.monotonic() - self._snapshot_monotonic < max_age
+
+    def _fetch(self):
+        """
+        Runs the fetcher and publishes the result. Must be called with _fetching set.
+        """
+        snapshot = None
+        try:
+            snapshot = self.fetcher()
+        except Exception:
+            logging.exception("An error occurred while refreshing the VPN snapshot.")
+        finally:
+            with self._condition:
+                if snapshot is not None:
+                    self._snapshot = snapshot
+                # A failed fetch keeps the previous peers but still counts as an
+                # attempt, so a broken 'wg' is not retried in a tight loop.
+                self._snapshot_time = time.time()
+                self._snapshot_monotonic = time.monotonic()
+                self._fetching = False
+                self._condition.notify_all()
+                timestamp = self._snapshot_time
+                listeners = list(self._listeners)
+
+        if snapshot is None:
+            return self._snapshot
+        for callback in listeners:
+            try:
+                callback(snapshot, timestamp)
+            except Exception:
+                logging.exception("A VPN snapshot listener failed.")
+        return snapshot
+
+    def _ensure_poller(self):
+        """
+        Starts the background poller if it is not running. Must hold the condition.
+        """
+        if self._stopped or (self._poller is not None and self._poller.is_alive()):
+            return
+        self._poller = threading.Thread(target=self._poll_loop, name='VPNSnapshotPoller', daemon=True)
+        self._poller.start()
+
+    def _poll_loop(self):
+        logging.debug("VPN snapshot poller started.")
+        while True:
+            with self._condition:
+                idle = time.monotonic() - self._last_request > self.idle_timeout
+                if self._stopped or (idle and not self._keep_alive):
+                    self._poller = None
+                    logging.debug("VPN snapshot poller stopped.")
+                    return
+                # Without callers only keep-alive listeners want snapshots, at their own pace
+                interval = min(self._keep_alive.values()) if idle else self.ttl
+                if self._fetching or self._is_fresh(interval):
+                    age = time.monotonic() - self._snapshot_monotonic if self._snapshot_monotonic else 0
+                    self._condition.wait(max(interval - age, 0.05))
+                    continue
+                self._fetching = True
+            self._fetch()
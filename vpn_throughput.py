@@ -0,0 +1,172 @@
+# vpn_throughput.py
+
+import logging
+import math
+import threading
+import time
+from array import array
+
+from vpn_peer_delta import peer_key
+
+# Averaging windows in seconds: 1, 5 and 15 minutes
+RATE_WINDOWS = (60, 300, 900)
+
+
+class PeerRateBuffer:
+    """
+    Fixed-size ring buffer of (timestamp, rx, tx) samples for a single peer.
+
+    Byte counters are stored as monotonically increasing totals in array('Q'),
+    so a counter reset (the interface restarted and the kernel counters went
+    back to zero) does not show up as a negative rate.
+    """
+
+    __slots__ = ('times', 'rx', 'tx', 'head', 'count', 'last_raw_rx', 'last_raw_tx',
+                 'rx_offset', 'tx_offset', 'last_seen')
+
+    def __init__(self, capacity):
+        self.times = array('d', bytes(8 * capacity))
+        self.rx = array('Q', bytes(8 * capacity))
+        self.tx = array('Q', bytes(8 * capacity))
+        self.head = -1
+        self.count = 0
+        self.last_raw_rx = 0
+        self.last_raw_tx = 0
+        self.rx_offset = 0
+        self.tx_offset = 0
+        self.last_seen = 0.0
+
+    def add(self, timestamp, raw_rx, raw_tx, min_interval):
+        """
+        Records the raw kernel counters seen at `timestamp`.
+        """
+        # The counters only ever grow; going backwards means they were reset
+        if raw_rx < self.last_raw_rx:
+            self.rx_offset += self.last_raw_rx
+        if raw_tx < self.last_raw_tx:
+            self.tx_offset += self.last_raw_tx
+        self.last_raw_rx = raw_rx
+        self.last_raw_tx = raw_tx
+        self.last_seen = timestamp
+
+        capacity = len(self.times)
+        if self.count > 1 and self.times[self.head] - self.times[(self.head - 1) % capacity] < min_interval:
+            # The newest slot is overwritten until it lies min_interval past
+            # the one before it, so stored samples are never closer than
+            # min_interval at any poll rate and the buffer always covers
+            # capacity - 2 intervals
+            index = self.head
+        else:
+            self.head = (self.head + 1) % capacity
+            self.count = min(self.count + 1, capacity)
+            index = self.head
+
+        self.times[index] = timestamp
+        self.rx[index] = raw_rx + self.rx_offset
+        self.tx[index] = raw_tx + self.tx_offset
+
+    def rate(self, window):
+        """
+        Returns the average (rx, tx) bytes per second over the last `window`
+        seconds, or None if fewer than two samples are available.
+        """
+        if self.count < 2:
+            return None
+
+        capacity = len(self.times)
+        head = self.head
+        latest_time = self.times[head]
+        cutoff = latest_time - window
+
+        # Walk back to the oldest sample still inside the window
+        base = (head - 1) % capacity
+        for step in range(2, self.count):
+            index = (head - step) % capacity
+            if self.times[index] < cutoff:
+                break
+            base = index
+
+        elapsed = latest_time - self.times[base]
+        if elapsed <= 0:
+            return None
+        return ((self.rx[head] - self.rx[base]) / elapsed,
+                (self.tx[head] - self.tx[base]) / elapsed)
+
+
+class PeerRateTracker:
+    """
+    Computes per-peer rx/tx throughput from the cumulative transfer counters in
+    VPNStatusChecker snapshots.
+
+    Memory is bounded: every peer owns one ring buffer sized for the longest
+    window, and peers that have not been seen for that long are dropped.
+    """
+
+    def __init__(self, windows=RATE_WINDOWS, min_interval=5.0):
+        self.windows = tuple(windows)
+        self.min_interval = min_interval
+        self.max_window = max(self.windows)
+        # Stored samples are at least min_interval apart; one more slot holds
+        # the newest sample and one the sample at or before the window start
+        self.capacity = int(math.ceil(self.max_window / min_interval)) + 2
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def ingest(self, snapshot, timestamp=None):
+        """
+        Records the transfer counters of every peer in a snapshot.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            buffers = self.buffers
+            for peer in snapshot:
+                key = peer_key(peer)
+                buffer = buffers.get(key)
+                if buffer is None:
+                    buffer = buffers[key] = PeerRateBuffer(self.capacity)
+                buffer.add(timestamp, peer.transfer_rx, peer.transfer_tx, self.min_interval)
+
+            self._prune(timestamp)
+
+    def get_rate(self, key, window):
+        """
+        Returns the (rx, tx) bytes-per-second tuple of a peer over one window,
+        or None where there is not enough data yet.
+        """
+        with self._lock:
+            buffer = self.buffers.get(key)
+            return buffer.rate(window) if buffer is not None else None
+
+    def get_rates(self, key):
+        """
+        Returns a dictionary mapping each window (in seconds) to an (rx, tx)
+        bytes-per-second tuple, or None where there is not enough data yet.
+        """
+        with self._lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                return {window: None for window in self.windows}
+            return {window: buffer.rate(window) for window in self.windows}
+
+    def _prune(self, now):
+        """
+        Drops peers that have not been seen for longer than the largest window.
+        """
+        stale = [key for key, buffer in self.buffers.items() if now - buffer.last_seen > self.max_window]
+        for key in stale:
+            del self.buffers[key]
+        if stale:
+            logging.debug(f"Dropped throughput history for {len(stale)} stale VPN peers.")
+
+
+def format_rate(bytes_per_second):
+    """
+    Formats a bytes-per-second value for display, e.g. '1.5 KB/s'.
+    """
+    if bytes_per_second is None:
+        return '-'
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if bytes_per_second < 1024:
+            return f"{bytes_per_second:.1f} {unit}"
+        bytes_per_second /= 1024
+    return f"{bytes_per_second:.1f} GB/s"
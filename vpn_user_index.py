@@ -0,0 +1,182 @@
+# vpn_user_index.py
+
+import os
+import re
+import time
+import threading
+import logging
+
+from wireguard_provisioner import derive_public_key
+
+# PiVPN wraps every client in the server config with these markers
+BEGIN_MARKER = re.compile(r'^###\s*begin\s+(\S+)\s*###')
+END_MARKER = re.compile(r'^###\s*end\s+(\S+)\s*###')
+
+
+def parse_client_config(path):
+    """
+    Parses a PiVPN client config (<username>.conf) and returns a list of
+    ('ip', address) entries for the addresses assigned to that client, and a
+    ('key', public_key) entry derived from its private key.
+    """
+    entries = []
+    in_interface = False
+    with open(path, 'r') as config_file:
+        for line in config_file:
+            line = line.strip()
+            if line.startswith('['):
+                in_interface = line.lower() == '[interface]'
+                continue
+            key, _, value = line.partition('=')
+            key = key.strip().lower()
+            if key == 'address':
+                entries.extend(('ip', address.strip().split('/')[0]) for address in value.split(',') if address.strip())
+            elif key == 'privatekey' and in_interface:
+                # Keys are base64 and may end in '=', so rejoin after the first '='
+                public_key = derive_public_key(line.split('=', 1)[1].strip())
+                if public_key:
+                    entries.append(('key', public_key))
+    return entries
+
+
+def parse_server_config(path):
+    """
+    Parses the WireGuard server config written by PiVPN and returns a list of
+    (kind, value, username) entries for every '### begin <name> ###' peer block.
+    """
+    entries = []
+    username = None
+    with open(path, 'r') as config_file:
+        for line in config_file:
+            line = line.strip()
+            begin = BEGIN_MARKER.match(line)
+            if begin:
+                username = begin.group(1)
+                continue
+            if END_MARKER.match(line):
+                username = None
+                continue
+            if username is None:
+                continue
+            key, _, value = line.partition('=')
+            key = key.strip().lower()
+            if key == 'publickey':
+                # Keys are base64 and may end in '=', so rejoin after the first '='
+                entries.append(('key', line.split('=', 1)[1].strip(), username))
+            elif key == 'allowedips':
+                entries.extend(('ip', address.strip().split('/')[0], username)
+                               for address in value.split(',') if address.strip())
+    return entries
+
+
+class VPNUserIndex:
+    """
+    Maps WireGuard public keys and allowed IPs to VPN usernames.
+
+    The index is built from the client configs in the PiVPN config directory
+    (the file name is the username), whose private keys give the public keys,
+    and from the peer blocks of the server config where it is readable; it is
+    root-only, so the app normally relies on the client configs alone.
+    refresh() only re-parses files whose mtime or size changed, and lookups
+    are plain dictionary reads.
+    """
+
+    def __init__(self, config_dir, server_config='/etc/wireguard/wg0.conf', refresh_interval=30.0):
+        self.config_dir = config_dir
+        self.server_config = server_config
+        self.refresh_interval = refresh_interval
+
+        self.by_key = {}
+        self.by_ip = {}
+        self._files = {}
+        # Number of files providing each (kind, value, username) entry
+        self._refs = {}
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def lookup(self, public_key=None, ip_address=None):
+        """
+        Returns the username for a peer, or None if it is not known.
+        """
+        username = self.by_key.get(public_key)
+        if username is None:
+            username = self.by_ip.get(ip_address)
+        return username
+
+    def refresh_if_stale(self):
+        """
+        Refreshes the index if the last refresh is older than refresh_interval.
+        """
+        if time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Re-parses the config files that changed since the last refresh and
+        drops entries for files that were removed.
+        """
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            seen = set()
+
+            try:
+                with os.scandir(self.config_dir) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.conf') and entry.is_file():
+                            seen.add(entry.path)
+                            self._update_file(entry.path, entry.stat(), 'client')
+            except OSError as e:
+                logging.debug(f"Could not scan VPN config directory {self.config_dir}: {e}")
+
+            if self.server_config:
+                try:
+                    self._update_file(self.server_config, os.stat(self.server_config), 'server')
+                    seen.add(self.server_config)
+                except OSError as e:
+                    logging.debug(f"Could not read WireGuard server config {self.server_config}: {e}")
+
+            for path in [path for path in self._files if path not in seen]:
+                self._remove_entries(self._files.pop(path)[1])
+
+    def _update_file(self, path, stat, kind):
+        """
+        Re-parses a single file if its mtime or size changed.
+        """
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._files.get(path)
+        if cached is not None and cached[0] == signature:
+            return
+
+        try:
+            if kind == 'client':
+                username = os.path.basename(path)[:-len('.conf')]
+                entries = [(entry_kind, value, username) for entry_kind, value in parse_client_config(path)]
+            else:
+                entries = parse_server_config(path)
+        except (OSError, UnicodeDecodeError) as e:
+            logging.debug(f"Could not parse VPN config {path}: {e}")
+            return
+
+        if cached is not None:
+            self._remove_entries(cached[1])
+        self._files[path] = (signature, entries)
+        for entry in entries:
+            self._refs[entry] = self._refs.get(entry, 0) + 1
+            entry_kind, value, username = entry
+            (self.by_key if entry_kind == 'key' else self.by_ip)[value] = username
+
+    def _remove_entries(self, entries):
+        """
+        Removes entries that no other file provides and that still point at
+        the username they were added for.
+        """
+        for entry in entries:
+            count = self._refs.get(entry, 0) - 1
+            if count > 0:
+                self._refs[entry] = count
+                continue
+            self._refs.pop(entry, None)
+            entry_kind, value, username = entry
+            index = self.by_key if entry_kind == 'key' else self.by_ip
+            if index.get(value) == username:
+                del index[value]
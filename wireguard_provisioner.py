@@ -0,0 +1,591 @@
+# wireguard_provisioner.py
+
+import os
+import time
+import base64
+import fcntl
+import shutil
+import threading
+import ipaddress
+import subprocess
+import logging
+from collections import deque
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives import serialization
+except ImportError:  # Optional; fall back to 'wg genkey' / 'wg pubkey'
+    X25519PrivateKey = None
+
+from privileged_helper import run_privileged, call_privileged, HelperRefusedError
+
+CLIENT_TEMPLATE = """[Interface]
+PrivateKey = {private_key}
+Address = {address}
+DNS = {dns}
+{interface_extra}
+[Peer]
+PublicKey = {server_public_key}
+PresharedKey = {preshared_key}
+Endpoint = {endpoint}
+AllowedIPs = {allowed_ips}
+{peer_extra}"""
+
+SERVER_PEER_TEMPLATE = """### begin {name} ###
+[Peer]
+PublicKey = {public_key}
+PresharedKey = {preshared_key}
+AllowedIPs = {allowed_ips}
+### end {name} ###
+"""
+
+
+class ProvisioningError(Exception):
+    """
+    Raised when a client profile cannot be provisioned.
+    """
+
+
+def generate_keypair():
+    """
+    Generates a WireGuard (X25519) keypair.
+    Returns (private_key, public_key) as base64 strings.
+    """
+    if X25519PrivateKey is not None:
+        private_key = X25519PrivateKey.generate()
+        private_bytes = private_key.private_bytes(
+            serialization.Encoding.Raw, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+        public_bytes = private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        return base64.b64encode(private_bytes).decode(), base64.b64encode(public_bytes).decode()
+
+    private_key = subprocess.run(['wg', 'genkey'], capture_output=True, text=True, check=True).stdout.strip()
+    public_key = subprocess.run(['wg', 'pubkey'], input=private_key, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    return private_key, public_key
+
+
+def derive_public_key(private_key):
+    """
+    Returns the base64 public key of a base64 WireGuard private key, like
+    'wg pubkey', or None if it cannot be derived.
+    """
+    try:
+        if X25519PrivateKey is not None:
+            key = X25519PrivateKey.from_private_bytes(base64.b64decode(private_key))
+            return base64.b64encode(key.public_key().public_bytes(
+                serialization.Encoding.Raw, serialization.PublicFormat.Raw)).decode()
+        return subprocess.run(['wg', 'pubkey'], input=private_key, capture_output=True,
+                              text=True, check=True, timeout=5).stdout.strip()
+    except (ValueError, OSError, subprocess.SubprocessError) as e:
+        logging.debug(f"Could not derive a WireGuard public key: {e}")
+        return None
+
+
+def generate_preshared_key():
+    """
+    Generates a WireGuard preshared key; equivalent to 'wg genpsk'.
+    """
+    return base64.b64encode(os.urandom(32)).decode()
+
+
+def read_setup_vars(path):
+    """
+    Parses PiVPN's setupVars.conf into a dictionary.
+    """
+    setup_vars = {}
+    with open(path, 'r') as setup_file:
+        for line in setup_file:
+            key, sep, value = line.strip().partition('=')
+            if sep and not key.startswith('#'):
+                setup_vars[key.strip()] = value.strip().strip('"\'')
+    return setup_vars
+
+
+class AddressAllocator:
+    """
+    Hands out client addresses from the VPN subnet using a free list, so
+    allocating and releasing an address are O(1).
+
+    `used` holds the addresses of peers in the server config; `reserved`
+    holds addresses handed out by allocate() or reserve() that have not been
+    written to the server config yet.
+    """
+
+    def __init__(self, network, used, reserved=()):
+        self.network = network
+        self.used = set(used)
+        self.reserved = set(reserved) - self.used
+        # The first host address belongs to the server
+        server_address = network.network_address + 1
+        self.free = deque(host for host in network.hosts()
+                          if host != server_address and host not in self.used and host not in self.reserved)
+
+    def allocate(self):
+        while self.free:
+            address = self.free.popleft()
+            if address not in self.used and address not in self.reserved:
+                self.reserved.add(address)
+                return address
+        raise ProvisioningError(f"No free addresses left in {self.network}.")
+
+    def is_client_address(self, address):
+        """
+        Returns True if `address` is a host address of the network other than
+        the server's.
+        """
+        return (address in self.network and address != self.network.network_address
+                and address != self.network.broadcast_address and address != self.network.network_address + 1)
+
+    def reserve(self, address):
+        """
+        Reserves a specific address. Returns False if it is not available.
+        """
+        if address in self.used or address in self.reserved or not self.is_client_address(address):
+            return False
+        # Its stale entry in the free list is skipped by allocate()
+        self.reserved.add(address)
+        return True
+
+    def commit(self, address):
+        """
+        Marks a reserved address as written to the server config.
+        """
+        self.reserved.discard(address)
+        self.used.add(address)
+
+    def release(self, address):
+        if address in self.reserved:
+            self.reserved.discard(address)
+            self.free.appendleft(address)
+
+
+class WireGuardProvisioner:
+    """
+    In-process alternative to 'pivpn add'.
+
+    Generates the client keypair and preshared key, allocates an address,
+    renders the client config and appends the peer to the server config
+    atomically. Every file is written where PiVPN puts it (keys/, configs/,
+    configs/clients.txt and the '### begin <name> ###' server block), so
+    'pivpn list' and 'pivpn remove' keep working on users created here. If a
+    step fails, the files written so far are removed and the server config is
+    restored, so the name can be provisioned again.
+
+    Writing under /etc/wireguard needs root, so the app uses a
+    HelperProvisioner and this class runs inside the privileged helper.
+    `client_owner` is the (uid, gid) the copy in `client_config_dir` is given
+    and `runner` runs 'wg set' (run_privileged by default).
+    """
+
+    _shared_instance = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, wireguard_dir='/etc/wireguard', setup_vars_path='/etc/pivpn/wireguard/setupVars.conf',
+                 client_config_dir=None, apply_live=True, client_owner=None, runner=None):
+        self.wireguard_dir = wireguard_dir
+        self.setup_vars_path = setup_vars_path
+        self.client_config_dir = client_config_dir
+        self.apply_live = apply_live
+        self.client_owner = client_owner
+        self.runner = runner or run_privileged
+
+        self._lock = threading.Lock()
+        self._setup_vars = None
+        self._allocator = None
+        self._server_mtime = None
+
+    @classmethod
+    def shared(cls, client_config_dir=None):
+        """
+        Returns the process-wide provisioner, so every UserManager shares one
+        address allocator.
+        """
+        with cls._shared_lock:
+            if cls._shared_instance is None:
+                cls._shared_instance = cls(client_config_dir=client_config_dir)
+            return cls._shared_instance
+
+    @property
+    def setup_vars(self):
+        if self._setup_vars is None:
+            self._setup_vars = read_setup_vars(self.setup_vars_path)
+        return self._setup_vars
+
+    @property
+    def interface(self):
+        return self.setup_vars.get('pivpnDEV', 'wg0')
+
+    @property
+    def server_config_path(self):
+        return os.path.join(self.wireguard_dir, f"{self.interface}.conf")
+
+    def provision(self, name, keys=None, address=None):
+        """
+        Creates a client profile for `name`.
+
+        `keys` may supply a pre-generated (private_key, public_key, preshared_key)
+        tuple and `address` a reserved client address; otherwise both are
+        generated here. Returns a dictionary with success status, message and
+        the client config text.
+        """
+        start = time.perf_counter()
+        try:
+            # Key generation needs no lock, so concurrent callers overlap here
+            keys = keys or (generate_keypair() + (generate_preshared_key(),))
+            with self._lock, self._server_lock():
+                config_data = self._provision_locked(name, keys, address)
+        except (ProvisioningError, OSError, subprocess.SubprocessError, KeyError) as e:
+            logging.error(f"Error provisioning VPN user '{name}': {e}")
+            return {
+                'success': False,
+                'message': f"Failed to add VPN user '{name}'."
+            }
+
+        logging.debug(f"Provisioned VPN user '{name}' in {(time.perf_counter() - start) * 1000:.1f} ms.")
+        return {
+            'success': True,
+            'message': f"User '{name}' added successfully.",
+            'config_data': config_data
+        }
+
+    def allocate_address(self):
+        """
+        Reserves the next free client address.
+        """
+        with self._lock, self._server_lock():
+            return self._get_allocator().allocate()
+
+    def reserve_address(self, address):
+        """
+        Reserves a specific client address, e.g. one persisted by a
+        ProvisioningPool. Returns False if the address is already taken.
+        """
+        with self._lock, self._server_lock():
+            return self._get_allocator().reserve(address)
+
+    def release_address(self, address):
+        """
+        Returns an address reserved with allocate_address() that was not used.
+        """
+        with self._lock:
+            if self._allocator is not None:
+                self._allocator.release(address)
+
+    def _provision_locked(self, name, keys, address):
+        configs_dir = os.path.join(self.wireguard_dir, 'configs')
+        keys_dir = os.path.join(self.wireguard_dir, 'keys')
+        config_path = os.path.join(configs_dir, f"{name}.conf")
+        if os.path.exists(config_path) or name in self._existing_clients():
+            raise ProvisioningError(f"A client named '{name}' already exists.")
+
+        private_key, public_key, preshared_key = keys
+        allocator = self._get_allocator()
+        if address is not None:
+            if not allocator.is_client_address(address):
+                raise ProvisioningError(f"{address} is not a client address in {allocator.network}.")
+            if address in allocator.used:
+                # A pooled address taken since it was reserved, e.g. by 'pivpn add'
+                logging.warning(f"Pooled address {address} is already in the server config; allocating another.")
+                address = None
+            elif address not in allocator.reserved:
+                # Not reserved beforehand, e.g. after a restart lost the reservation
+                allocator.reserve(address)
+        if address is None:
+            address = allocator.allocate()
+
+        written = []
+        original_server_config = None
+        try:
+            config_data = self._render_client_config(private_key, preshared_key, address)
+
+            # Keys and client config, private to root like PiVPN's
+            for suffix, value in (('priv', private_key), ('pub', public_key), ('psk', preshared_key)):
+                key_path = os.path.join(keys_dir, f"{name}_{suffix}")
+                write_file_atomic(key_path, value + '\n', 0o600)
+                written.append(key_path)
+            write_file_atomic(config_path, config_data, 0o600)
+            written.append(config_path)
+
+            if self.client_config_dir:
+                os.makedirs(self.client_config_dir, exist_ok=True)
+                client_copy_path = os.path.join(self.client_config_dir, f"{name}.conf")
+                shutil.copyfile(config_path, client_copy_path)
+                written.append(client_copy_path)
+                if self.client_owner is not None:
+                    os.chown(client_copy_path, *self.client_owner)
+
+            # Server peer block, appended by rewriting the whole file atomically
+            with open(self.server_config_path, 'r') as server_file:
+                server_config = server_file.read()
+            original_server_config = server_config
+            if server_config and not server_config.endswith('\n'):
+                server_config += '\n'
+            server_config += SERVER_PEER_TEMPLATE.format(
+                name=name,
+                public_key=public_key,
+                preshared_key=preshared_key,
+                allowed_ips=', '.join(self._peer_allowed_ips(address))
+            )
+            write_file_atomic(self.server_config_path, server_config, 0o600)
+            self._server_mtime = os.stat(self.server_config_path).st_mtime_ns
+            allocator.commit(address)
+
+            # Last, so 'pivpn list' never shows a client whose files are missing
+            with open(os.path.join(configs_dir, 'clients.txt'), 'a') as clients_file:
+                # PiVPN looks for free addresses by the count in the fourth field
+                clients_file.write(f"{name} {public_key} {int(time.time())} {self._address_count(address)}\n")
+        except Exception:
+            self._roll_back(name, written, original_server_config, allocator, address)
+            raise
+
+        if self.apply_live:
+            self._apply_peer(public_key, os.path.join(keys_dir, f"{name}_psk"), address)
+        return config_data
+
+    def _roll_back(self, name, written, original_server_config, allocator, address):
+        """
+        Undoes a failed _provision_locked(): removes the files it wrote,
+        restores the server config and frees the address.
+        """
+        for path in written:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Could not remove {path} after failing to provision '{name}': {e}")
+
+        if original_server_config is not None:
+            try:
+                write_file_atomic(self.server_config_path, original_server_config, 0o600)
+                self._server_mtime = os.stat(self.server_config_path).st_mtime_ns
+            except OSError as e:
+                logging.error(f"Could not restore {self.server_config_path} after failing to provision '{name}': {e}")
+                # Rebuild the allocator from whatever the file now holds
+                self._server_mtime = None
+                allocator.reserved.discard(address)
+                return
+            if address in allocator.used:
+                # Committed before the failure; the restored config no longer has it
+                allocator.used.discard(address)
+                allocator.reserved.add(address)
+        allocator.release(address)
+
+    def _render_client_config(self, private_key, preshared_key, address):
+        setup_vars = self.setup_vars
+        addresses = [f"{address}/{setup_vars.get('subnetClass', '24')}"]
+        address_v6 = self._address_v6(address)
+        if address_v6 is not None:
+            addresses.append(f"{address_v6}/{setup_vars.get('subnetClassv6', '64')}")
+
+        dns = ', '.join(value for value in (setup_vars.get('pivpnDNS1'), setup_vars.get('pivpnDNS2')) if value)
+        interface_extra = f"MTU = {setup_vars['pivpnMTU']}\n" if setup_vars.get('pivpnMTU') else ''
+        keepalive = setup_vars.get('pivpnPERSISTENTKEEPALIVE')
+        peer_extra = f"PersistentKeepalive = {keepalive}\n" if keepalive else ''
+
+        with open(os.path.join(self.wireguard_dir, 'keys', 'server_pub'), 'r') as key_file:
+            server_public_key = key_file.read().strip()
+
+        return CLIENT_TEMPLATE.format(
+            private_key=private_key,
+            address=', '.join(addresses),
+            dns=dns,
+            interface_extra=interface_extra,
+            server_public_key=server_public_key,
+            preshared_key=preshared_key,
+            endpoint=f"{setup_vars['pivpnHOST']}:{setup_vars.get('pivpnPORT', '51820')}",
+            allowed_ips=setup_vars.get('ALLOWED_IPS', '0.0.0.0/0, ::0/0'),
+            peer_extra=peer_extra
+        )
+
+    def _peer_allowed_ips(self, address):
+        allowed_ips = [f"{address}/32"]
+        address_v6 = self._address_v6(address)
+        if address_v6 is not None:
+            allowed_ips.append(f"{address_v6}/128")
+        return allowed_ips
+
+    def _address_v6(self, address):
+        """
+        Returns the IPv6 address paired with an IPv4 client address, if enabled.
+        Like PiVPN, the decimal count is appended to pivpnNETv6 as text, so
+        count 10 becomes '<prefix>::10', not '<prefix>::a'.
+        """
+        if self.setup_vars.get('pivpnenableipv6') != '1' or not self.setup_vars.get('pivpnNETv6'):
+            return None
+        return ipaddress.IPv6Address(f"{self.setup_vars['pivpnNETv6']}{self._address_count(address)}")
+
+    def _address_count(self, address):
+        """
+        Returns PiVPN's count for a client address: its offset in the network.
+        """
+        return int(address) - int(self._network().network_address)
+
+    def _network(self):
+        return ipaddress.ip_network(
+            f"{self.setup_vars['pivpnNET']}/{self.setup_vars.get('subnetClass', '24')}", strict=False)
+
+    def _get_allocator(self):
+        """
+        Returns the address allocator, rebuilding it if the server config was
+        changed by something else (e.g. 'pivpn add' or 'pivpn remove').
+        """
+        mtime = os.stat(self.server_config_path).st_mtime_ns
+        if self._allocator is None or mtime != self._server_mtime:
+            network = self._network()
+            used = []
+            with open(self.server_config_path, 'r') as server_file:
+                for line in server_file:
+                    key, _, value = line.partition('=')
+                    if key.strip().lower() == 'allowedips':
+                        for entry in value.split(','):
+                            try:
+                                ip = ipaddress.ip_interface(entry.strip()).ip
+                            except ValueError:
+                                continue
+                            if ip in network:
+                                used.append(ip)
+            # Counts PiVPN recorded in clients.txt are taken too
+            used.extend(network.network_address + count for count in self._client_counts()
+                        if count < network.num_addresses)
+            # Only reservations not yet written carry over; addresses of
+            # removed peers become free again
+            previous = self._allocator
+            self._allocator = AddressAllocator(network, used, previous.reserved if previous is not None else ())
+            self._server_mtime = mtime
+        return self._allocator
+
+    def _client_counts(self):
+        """
+        Returns the address counts in the fourth field of clients.txt.
+        """
+        counts = []
+        try:
+            with open(os.path.join(self.wireguard_dir, 'configs', 'clients.txt'), 'r') as clients_file:
+                for line in clients_file:
+                    fields = line.split()
+                    if len(fields) >= 4 and fields[3].isdigit():
+                        counts.append(int(fields[3]))
+        except FileNotFoundError:
+            pass
+        return counts
+
+    def _existing_clients(self):
+        try:
+            with open(os.path.join(self.wireguard_dir, 'configs', 'clients.txt'), 'r') as clients_file:
+                return {line.split()[0] for line in clients_file if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _server_lock(self):
+        """
+        Exclusive lock on the server config, shared with other processes.
+        """
+        return FileLock(self.server_config_path + '.lock')
+
+    def _apply_peer(self, public_key, preshared_key_path, address):
+        """
+        Adds the peer to the running interface without restarting WireGuard.
+        """
+        command = ['wg', 'set', self.interface, 'peer', public_key,
+                   'preshared-key', preshared_key_path,
+                   'allowed-ips', ','.join(self._peer_allowed_ips(address))]
+        result = self.runner(command, timeout=10)
+        if result.returncode != 0:
+            logging.error(f"Error applying WireGuard peer {public_key}: {result.stderr}")
+
+
+class HelperProvisioner:
+    """
+    WireGuardProvisioner interface backed by the privileged helper.
+
+    The helper runs a WireGuardProvisioner as root, so the app never writes
+    under /etc/wireguard itself. Keys are still generated here; addresses
+    travel as strings and come back as ipaddress objects.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def provision(self, name, keys=None, address=None):
+        keys = keys or (generate_keypair() + (generate_preshared_key(),))
+        try:
+            return call_privileged('provision', name, list(keys), str(address) if address is not None else None,
+                                   timeout=self.timeout)
+        except (OSError, HelperRefusedError, subprocess.SubprocessError) as e:
+            logging.error(f"Error provisioning VPN user '{name}' through the privileged helper: {e}")
+            return {
+                'success': False,
+                'message': f"Failed to add VPN user '{name}'."
+            }
+
+    def allocate_address(self):
+        try:
+            return ipaddress.ip_address(call_privileged('allocate_address', timeout=self.timeout))
+        except (OSError, HelperRefusedError, subprocess.SubprocessError) as e:
+            raise ProvisioningError(f"Could not allocate a client address: {e}") from e
+
+    def reserve_address(self, address):
+        try:
+            return call_privileged('reserve_address', str(address), timeout=self.timeout)
+        except (OSError, HelperRefusedError, subprocess.SubprocessError) as e:
+            logging.error(f"Could not reserve client address {address}: {e}")
+            return False
+
+    def release_address(self, address):
+        try:
+            call_privileged('release_address', str(address), timeout=self.timeout)
+        except (OSError, HelperRefusedError, subprocess.SubprocessError) as e:
+            logging.error(f"Could not release client address {address}: {e}")
+
+
+def shared_provisioner(client_config_dir=None):
+    """
+    Returns the provisioner the app should use: the in-process one when
+    running as root, otherwise one that goes through the privileged helper.
+    """
+    if os.geteuid() == 0:
+        return WireGuardProvisioner.shared(client_config_dir)
+    return HelperProvisioner()
+
+
+class FileLock:
+    """
+    Context manager holding an exclusive flock() on a lock file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def write_file_atomic(path, data, mode):
+    """
+    Writes `data` to `path` through a temporary file and os.replace(), so
+    readers never see a partially written file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise